@@ -0,0 +1,495 @@
+# asyncio driver
+#
+# AsyncMspdebug is Mspdebug with coroutines, so one event loop can drive many
+# boards at once. It shares driver.MspdebugBase (logs, caches, checking
+# commands) and the command lines in commands.py with Mspdebug, and only does
+# the talking itself:
+#
+#   async def job():
+#       async with AsyncMspdebug() as mspdebug:
+#           await mspdebug.prog(fname)
+#           return await mspdebug.run(1.0)
+#
+#   await asyncio.gather(*(job() for _ in range(n)))
+#
+# mspdebug runs on a pty (see transport.fork_pty) watched with loop.add_reader.
+# Calls into manager can block (on the status file lock, the broker, or waiting
+# for a tty), so they run in the loop's default executor.
+
+import settings
+import manager
+import transport
+import driver
+import commands
+import progdelta
+import steptrace
+import snapshot
+import utils
+
+import pexpect
+import asyncio
+import os
+import time
+
+
+class AsyncPtyTransport(object):
+    def __init__(self, argv, prompt, logfile = None):
+        self.prompt = prompt
+        self.logfile = logfile
+        self.loop = asyncio.get_running_loop()
+        self.buf = bytearray()
+        self.raw = b''
+        self.eof = False
+        self.waiter = None
+        # prompts still to come for commands sent by an iter_commands that
+        # was left part way through; see settle
+        self.owed = 0
+
+        self.pid, self.fd = transport.fork_pty(argv)
+        self.intr = transport.intr_char(self.fd)
+        self.loop.add_reader(self.fd, self.on_readable)
+
+    def log(self, data):
+        if self.logfile is not None:
+            self.logfile.write(data.decode('ascii', errors='replace'))
+            self.logfile.flush()
+
+    def wake(self):
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(None)
+
+    def on_readable(self):
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return
+        except OSError:
+            # EIO: the other end of the pty is gone
+            data = b''
+        if data:
+            self.log(data)
+            self.buf += data
+        else:
+            self.eof = True
+            self.loop.remove_reader(self.fd)
+        self.wake()
+
+    async def write(self, data):
+        self.log(data)
+        while data:
+            try:
+                n = os.write(self.fd, data)
+            except BlockingIOError:
+                writable = self.loop.create_future()
+                self.loop.add_writer(self.fd, writable.set_result, None)
+                try:
+                    await writable
+                finally:
+                    self.loop.remove_writer(self.fd)
+                continue
+            data = data[n:]
+
+    async def read_until(self, marker, timeout = transport.default_timeout):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        scanned = 0
+        while True:
+            i = self.buf.find(marker, max(0, scanned - len(marker) + 1))
+            if i >= 0:
+                end = i + len(marker)
+                self.raw = bytes(self.buf[:end])
+                del self.buf[:end]
+                return self.raw[:i]
+            scanned = len(self.buf)
+            if self.eof:
+                self.raw = bytes(self.buf)
+                raise pexpect.EOF('mspdebug exited')
+
+            self.waiter = self.loop.create_future()
+            remaining = None if deadline is None else deadline - time.monotonic()
+            try:
+                await asyncio.wait_for(self.waiter, remaining)
+            except asyncio.TimeoutError:
+                raise pexpect.TIMEOUT('timed out waiting for {}'.format(repr(marker)))
+            finally:
+                self.waiter = None
+
+    async def start(self):
+        try:
+            await self.expect_exact(self.prompt)
+        except (pexpect.EOF, pexpect.TIMEOUT):
+            await self.close()
+            raise
+
+    async def run_command(self, cmd):
+        await self.sendline(cmd)
+        return await self.expect_exact(self.prompt)
+
+    # Unlike a generator, an async generator isn't closed as soon as the loop
+    # using it stops; it's finalized later, maybe while something else is
+    # reading. So an abandoned iter_commands doesn't wait out its commands
+    # itself; whatever's sent next does it instead.
+    async def settle(self):
+        while self.owed > 0:
+            await self.expect_exact(self.prompt)
+            self.owed -= 1
+
+    async def send(self, s):
+        await self.settle()
+        await self.write(s.encode('ascii'))
+
+    async def sendline(self, line):
+        await self.settle()
+        await self.write(line.encode('ascii') + b'\n')
+
+    async def expect_exact(self, s, timeout = transport.default_timeout):
+        data = await self.read_until(s.encode('ascii'), timeout=timeout)
+        return data.decode('ascii', errors='replace')
+
+    async def sendintr(self):
+        await self.settle()
+        await self.write(self.intr)
+
+    # as transport.PtyTransport.close, waiting with asyncio.sleep
+    async def close(self):
+        if not self.eof:
+            self.loop.remove_reader(self.fd)
+        os.close(self.fd)
+        deadline = time.monotonic() + transport.close_timeout
+        while not transport.exited(self.pid):
+            if time.monotonic() >= deadline:
+                transport.kill(self.pid)
+                return
+            await asyncio.sleep(transport.close_poll)
+
+
+# transport.iter_commands, for AsyncPtyTransport. While it's waiting on the
+# caller, the commands it has sent are owed to conn, so if the caller stops
+# early they're waited for before anything else goes out (see settle).
+async def iter_commands(conn, cmds, prompt, window, depth = None):
+    pipeline = transport.Pipeline(cmds, window, depth=depth)
+    while not pipeline.finished():
+        chunk = pipeline.to_send()
+        if chunk:
+            await conn.send(chunk)
+        output = await conn.expect_exact(prompt)
+        pipeline.received()
+        conn.owed = pipeline.outstanding()
+        yield output
+        conn.owed = 0
+
+async def run_commands(conn, cmds, prompt, window):
+    return [output async for output in iter_commands(conn, cmds, prompt, window)]
+
+
+class AsyncMspdebug(driver.MspdebugBase):
+    async def manager_call(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(None, fn, *args)
+
+    async def start(self):
+        while self.conn is None:
+            tty = await self.manager_call(manager.get_tty, self.timeout, self.priority)
+            if tty is None:
+                raise driver.NoTTYError
+            await self.connect(tty)
+
+    # as Mspdebug.connect
+    async def connect(self, tty):
+        self.tty = tty
+        self.open_log()
+
+        C = AsyncPtyTransport(self.mspargs(), settings.mspdebug_prompt, logfile=self.log)
+        try:
+            await C.start()
+            await self.manager_call(manager.claim_tty, self.tty, C.pid)
+            self.conn = C
+            return True
+        except pexpect.EOF:
+            if self.note_failure() in settings.errors_to_mark:
+                await self.manager_call(manager.mark_tty, self.tty)
+            return False
+
+    async def close(self):
+        try:
+            await self.flush_cache()
+            await self.conn.run_command('exit')
+        except pexpect.EOF:
+            await self.manager_call(manager.release_tty, self.tty)
+        else:
+            print('failed to release tty {}'.format(repr(self.tty)))
+        await self.conn.close()
+        self.close_log()
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is not None:
+            self.log.error()
+        await self.close()
+
+    # raw text api
+
+    async def run_command(self, cmd):
+        cleaned, error = self.check_command(cmd)
+        if cleaned is None:
+            return error
+        else:
+            await self.sync_cache([cleaned])
+            output = await self.conn.run_command(cleaned)
+            self.note_regs(cleaned, output)
+            return output
+
+    async def run_commands(self, cmds):
+        checked = [self.check_command(cmd) for cmd in cmds]
+        to_send = [cleaned for cleaned, error in checked if cleaned is not None]
+        await self.sync_cache(to_send)
+        sent_outputs = await run_commands(self.conn, to_send, settings.mspdebug_prompt,
+                                          settings.pipeline_window)
+        for cmd, output in zip(to_send, sent_outputs):
+            self.note_regs(cmd, output)
+        outputs = iter(sent_outputs)
+        return [next(outputs) if cleaned is not None else error for cleaned, error in checked]
+
+    def batch(self):
+        return AsyncBatch(self)
+
+    async def run_continue(self):
+        await self.sync_cache(['run'])
+        self.reg_cache = None
+        await self.conn.sendline('run')
+        return await self.conn.expect_exact('Running. Press Ctrl+C to interrupt...')
+
+    async def wait_for_stop(self, timeout = None, halt = False):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        poll = settings.halt_poll_min
+        while True:
+            await self.run_continue()
+            remaining = None if deadline is None else max(0, deadline - time.monotonic())
+            wait = remaining
+            if halt:
+                wait = poll if remaining is None else min(poll, remaining)
+            try:
+                output = await self.conn.expect_exact(settings.mspdebug_prompt, timeout=wait)
+                self.note_regs('run', output)
+                return output
+            except pexpect.TIMEOUT:
+                output = await self.interrupt()
+            if await self.resync():
+                return output
+            if deadline is not None and time.monotonic() >= deadline:
+                return output
+            if halt and await self.halted(utils.parse_regs(output)):
+                return output
+            poll = min(poll * 2, settings.halt_poll_max)
+
+    async def resync(self):
+        await self.conn.sendline('regs')
+        skipped = False
+        while True:
+            regs = driver.full_regs(await self.conn.expect_exact(settings.mspdebug_prompt))
+            if regs is not None:
+                self.reg_cache = regs
+                return skipped
+            skipped = True
+
+    async def halted(self, regs):
+        return driver.is_halted(regs, await self.read_mem(regs[0], 2))
+
+    async def interrupt(self):
+        await self.conn.sendintr()
+        output = await self.conn.expect_exact(settings.mspdebug_prompt)
+        self.note_regs('run', output)
+        return output
+
+    # snapshots
+
+    async def snapshot(self, ranges = None):
+        if ranges is None:
+            ranges = settings.snapshot_ranges
+        regs = self.reg_cache
+        outputs = await self.run_commands(snapshot.snapshot_commands(ranges, regs))
+        return snapshot.parse_snapshot(ranges, outputs, regs)
+
+    async def restore(self, snap):
+        current = await self.snapshot(snap.ranges())
+        cmds, regs = snapshot.restore_commands(current, snap)
+        if cmds:
+            await self.run_commands(cmds)
+        self.reg_cache = regs
+        return len(cmds)
+
+    # memory cache
+
+    async def flush_cache(self):
+        if self.cache is not None:
+            runs = self.cache.flush_runs()
+            if runs:
+                await self.write_mem(runs)
+                self.cache.flushed(runs)
+
+    async def sync_cache(self, cmds):
+        if self.cache is not None:
+            await self.flush_cache()
+            self.invalidate_cache(cmds)
+
+    # Device access underneath the cache.
+
+    async def read_mem(self, addr, size):
+        raw_output = await self.conn.run_command(commands.md(addr, size))
+        return commands.parse_md(raw_output, addr, size)
+
+    async def write_mem(self, runs):
+        cmds = [commands.mw(addr, data) for addr, data in runs]
+        await run_commands(self.conn, cmds, settings.mspdebug_prompt, settings.pipeline_window)
+
+    # standard python-level api
+
+    async def reset(self):
+        await self.run_command('reset')
+        return (await self.regs())[0]
+
+    async def prog(self, fname):
+        progdelta.forget(self.tty)
+        raw_output = await self.run_command(commands.prog(fname))
+        imgsize = utils.parse_prog(raw_output)
+        if imgsize is None:
+            return raw_output.strip()
+        else:
+            return (await self.regs())[0]
+
+    async def prog_delta(self, fname):
+        hashes, delta = self.plan_delta(fname)
+        if hashes is None:
+            return await self.prog(fname)
+        if delta is None:
+            return await self.prog_record(fname, hashes)
+
+        cmds, expected = delta
+        await self.run_commands(cmds)
+        outputs = await self.run_commands([commands.md(addr, len(data)) for addr, data in expected])
+        if not self.check_delta(expected, outputs):
+            return await self.prog_record(fname, hashes)
+
+        progdelta.save_record(self.tty, hashes)
+        return (await self.regs())[0]
+
+    async def prog_record(self, fname, hashes):
+        result = await self.prog(fname)
+        if isinstance(result, int):
+            progdelta.save_record(self.tty, hashes)
+        return result
+
+    async def mw(self, addr, pattern):
+        if self.cache is not None:
+            self.cache.write(addr, pattern)
+        elif len(pattern) > settings.mw_max_bytes:
+            await self.write_bulk(addr, pattern)
+        else:
+            await self.run_command(commands.mw(addr, pattern))
+
+    async def write_bulk(self, addr, data):
+        await self.sync_cache(['mw'])
+        await run_commands(self.conn, commands.mw_chunks(addr, data), settings.mspdebug_prompt,
+                           settings.pipeline_window)
+
+    async def fill(self, addr, size, pattern):
+        if self.cache is not None:
+            self.cache.fill(addr, size, pattern)
+        else:
+            await self.run_command(commands.fill(addr, size, pattern))
+
+    async def setreg(self, register, value):
+        regs = self.reg_cache
+        await self.run_command(commands.setreg(register, value))
+        self.reg_cache = self.set_cached_reg(regs, register, value)
+
+    async def md(self, addr, size):
+        if self.cache is None:
+            return await self.read_mem(addr, size)
+        span = self.cache.missing(addr, size)
+        if span is not None:
+            start, length = span
+            self.cache.fetched(start, await self.read_mem(start, length))
+        return self.cache.view(addr, size)
+
+    # as Mspdebug.md_iter, but an async generator
+    async def md_iter(self, addr, size, chunk = None):
+        if chunk is None:
+            chunk = settings.md_chunk
+        await self.flush_cache()
+        ranges = commands.md_ranges(addr, size, chunk)
+        cmds = [commands.md(a, n) for a, n in ranges]
+        outputs = iter_commands(self.conn, cmds, settings.mspdebug_prompt,
+                                settings.pipeline_window, depth=settings.md_iter_depth)
+        try:
+            i = 0
+            async for output in outputs:
+                a, n = ranges[i]
+                i += 1
+                yield commands.parse_md(output, a, n)
+        finally:
+            await outputs.aclose()
+
+    async def regs(self):
+        if self.reg_cache is not None:
+            return list(self.reg_cache)
+        raw_output = await self.run_command('regs')
+        return utils.parse_regs(raw_output)
+
+    async def step(self):
+        raw_output = await self.run_command('step')
+        return commands.parse_pc(raw_output)
+
+    async def trace(self, n_steps, sink):
+        if isinstance(sink, str):
+            with steptrace.TraceWriter(sink) as writer:
+                return await self.trace(n_steps, writer)
+
+        await self.sync_cache(['step'])
+        self.reg_cache = None
+        regs = None
+        for done in range(0, n_steps, settings.trace_batch):
+            n = min(settings.trace_batch, n_steps - done)
+            outputs = await run_commands(self.conn, ['step'] * n, settings.mspdebug_prompt,
+                                         settings.pipeline_window)
+            rows = [utils.parse_regs(output) for output in outputs]
+            sink.write(rows)
+            regs = rows[-1]
+        if regs is None:
+            return None
+        self.reg_cache = list(regs)
+        return regs[0]
+
+    async def run_until(self, pc = None, timeout = None, halt = False):
+        if pc is not None:
+            await self.run_command(commands.setbreak(pc, settings.run_until_break))
+        try:
+            raw_output = await self.wait_for_stop(timeout=timeout, halt=halt)
+        finally:
+            if pc is not None:
+                await self.run_command(commands.delbreak(settings.run_until_break))
+        return commands.parse_pc(raw_output)
+
+    async def run(self, interval = 0.5):
+        await self.run_continue()
+        await asyncio.sleep(interval)
+        raw_output = await self.interrupt()
+        return commands.parse_pc(raw_output)
+
+
+# driver.Batch, run with await:
+#
+#   async with mspdebug.batch() as b:
+#       b.md(0x1c00, 3)
+#   bytes(b.results[0])
+class AsyncBatch(driver.Batch):
+    async def run(self):
+        return self.results_from(await self.mspdebug.run_commands(self.cmds))
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            await self.run()
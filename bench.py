@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+
+# Rough benchmarks for the slow paths in py-mspdebug. These don't need any
+# boards attached, though the numbers are more interesting if they are.
+
+import settings
+import manager
+import transport
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+def timeit(fn, reps):
+    start = time.perf_counter()
+    for _ in range(reps):
+        fn()
+    return (time.perf_counter() - start) / reps
+
+def report(name, t_old, t_new):
+    print('{:24s} old {:10.3f} ms   new {:10.3f} ms   speedup {:8.1f}x'.format(
+        name, t_old * 1000, t_new * 1000, t_old / t_new if t_new > 0 else float('inf')))
+
+# Compare the fuser/ps/lsof probes against the /proc scanner, asking the same
+# questions check() asks about every tty.
+def bench_probe(ttys, reps):
+    if not ttys:
+        ttys = manager.lstty()
+    if not ttys:
+        # nothing plugged in; probe some made-up ports so there's still work to do
+        ttys = ['{}{:d}'.format(settings.tty_name, i) for i in range(8)]
+    pid = os.getpid()
+    print('probing {:d} ttys, {:d} reps'.format(len(ttys), reps))
+
+    def old():
+        for tty in ttys:
+            manager.psname_ps(pid)
+            manager.hasopen_lsof(pid, tty)
+            manager.suser_fuser(tty)
+
+    def new():
+        procs = manager.ProcIndex()
+        for tty in ttys:
+            procs.psname(pid)
+            procs.hasopen(pid, tty)
+            procs.suser(tty)
+
+    report('probe', timeit(old, reps), timeit(new, reps))
+
+# Compare status.json against the memory-mapped table, for a read (check_tty)
+# and a write (release_tty), with a made-up rack of ttys.
+def bench_status(ttys, reps):
+    if not ttys:
+        ttys = ['{}{:d}'.format(settings.tty_name, i) for i in range(48)]
+    reps *= 100
+    print('{:d} ttys, {:d} reps'.format(len(ttys), reps))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        settings.status_dir = tmp
+        settings.status_path = os.path.join(tmp, settings.status_fname)
+        settings.status_table_path = os.path.join(tmp, settings.status_table_fname)
+
+        times = {}
+        for store in ['json', 'table']:
+            settings.status_store = store
+            with manager.status_store() as s:
+                for tty in ttys:
+                    s.set(tty, None)
+            times[store] = (timeit(lambda: manager.check_tty(ttys[-1]), reps),
+                            timeit(lambda: manager.release_tty(ttys[-1]), reps))
+
+    report('status read', times['json'][0], times['table'][0])
+    report('status write', times['json'][1], times['table'][1])
+
+fake_mspdebug = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fakemspdebug.py')]
+
+# Per-command overhead of each transport, talking to fakemspdebug.py, so the
+# device itself takes no time at all.
+def bench_transport(reps):
+    reps *= 100
+    cmds = ['regs', 'md 0x200 256']
+    print('{:d} reps of {}'.format(reps, cmds))
+
+    times = {}
+    for kind in ['pexpect', 'pty']:
+        conn = transport.spawn(kind, fake_mspdebug, settings.mspdebug_prompt)
+        def run():
+            for cmd in cmds:
+                conn.run_command(cmd)
+        times[kind] = timeit(run, reps) / len(cmds)
+        conn.sendline('exit')
+        conn.close()
+
+    report('transport', times['pexpect'], times['pty'])
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('bench', choices=['probe', 'status', 'transport'],
+                        help='which benchmark to run')
+    parser.add_argument('-t', '--ttys', default='', metavar='TTYS',
+                        help='comma-separated list of ttys to use')
+    parser.add_argument('-n', '--reps', type=int, default=3,
+                        help='number of repetitions')
+
+    args = parser.parse_args()
+    ttys = [tty for tty in args.ttys.strip().split(',') if tty]
+
+    if args.bench == 'probe':
+        bench_probe(ttys, args.reps)
+    elif args.bench == 'status':
+        bench_status(ttys, args.reps)
+    elif args.bench == 'transport':
+        bench_transport(args.reps)
+
+    exit(0)
@@ -0,0 +1,415 @@
+#!/usr/bin/env python
+
+# tty broker
+#
+# A long-lived process that keeps tty status in memory and serves the manager
+# API over a unix socket at settings.broker_path. While it's running, manager
+# sends it requests instead of locking and rewriting the status file. State is
+# read from the status store at startup, and every change is written through
+# to it (see Broker.sync) before anyone is told about it, so if the broker
+# dies, even with SIGKILL, clients can carry on with the store.
+#
+# The broker also watches settings.tty_dir (see hotplug.py), adding and removing
+# ttys as boards come and go.
+#
+# Each client process holds connections open (one per request it has in
+# flight). When a connection drops, any ttys it reserved and never released
+# pass to another connection from the same process, or are freed if it was the
+# last one (say, because the client crashed). Ttys held by pids that have exited (say, a killed
+# mspdebug) are reaped every settings.reap_interval seconds, and whenever a
+# get finds nothing free.
+
+import settings
+import manager
+import hotplug
+
+import os
+import sys
+import json
+import socket
+import selectors
+import heapq
+import itertools
+import signal
+import time
+
+
+class BrokerState(object):
+    def __init__(self, status, gens):
+        self.dirty = False
+        self.status = status
+        self.gens = gens
+
+    gen = manager.Status.gen
+    set = manager.Status.set
+    remove = manager.Status.remove
+    snapshot = manager.Status.snapshot
+    cas = manager.Status.cas
+    cas_remove = manager.Status.cas_remove
+
+# The state to start with, and the store's snapshot of it (see Broker.sync).
+def load_state():
+    with manager.status_store(readonly=True) as s:
+        return BrokerState(dict(s.status), dict(s.gens)), s.snapshot()
+
+
+class Client(object):
+    def __init__(self, sock, pid):
+        self.sock = sock
+        self.pid = pid
+        self.buf = b''
+        # ttys reserved through this connection that haven't been released
+        self.owned = set()
+        # (deadline, waiter entry) if blocked in get, else None
+        self.waiting = None
+        # (priority, deadline) of the last get, in case its answer is taken back
+        self.asked = None
+        # replies held until the store has caught up (see Broker.sync)
+        self.outbox = []
+
+    def send(self, reply):
+        self.outbox.append(reply)
+
+    def flush(self):
+        if not self.outbox:
+            return
+        data = b''.join(json.dumps(reply).encode('ascii') + b'\n' for reply in self.outbox)
+        self.outbox = []
+        try:
+            self.sock.sendall(data)
+        except OSError:
+            # the connection is on its way out; we'll clean up when select notices
+            pass
+
+
+class Broker(object):
+    def __init__(self):
+        self.state = None
+        # the store's snapshot as of the last sync
+        self.saved = None
+        self.sock = None
+        self.sel = None
+        self.inventory = None
+        self.clients = {}
+        # heap of [priority, seq, client, pid]; cancelled entries have client set to None
+        self.waiters = []
+        self.seq = itertools.count()
+        self.next_reap = None
+
+    def start(self):
+        if manager.broker_connect() is not None:
+            raise RuntimeError('a broker is already listening on {}'.format(repr(settings.broker_path)))
+        if os.path.exists(settings.broker_path):
+            os.unlink(settings.broker_path)
+        if not os.path.isdir(settings.status_dir):
+            os.makedirs(settings.status_dir, exist_ok=True)
+
+        self.state, self.saved = load_state()
+        self.next_reap = time.monotonic() + settings.reap_interval
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(settings.broker_path)
+        self.sock.listen()
+        self.sock.setblocking(False)
+        self.sel = selectors.DefaultSelector()
+        self.sel.register(self.sock, selectors.EVENT_READ)
+
+        self.inventory = hotplug.Inventory()
+        try:
+            self.inventory.open()
+        except OSError as e:
+            print('WARNING: broker: not watching {} for ttys: {}'.format(repr(settings.tty_dir), repr(e)))
+            self.inventory = None
+        else:
+            self.sel.register(self.inventory, selectors.EVENT_READ)
+            self.plug([tty for tty in self.inventory.ttys if tty not in self.state.status],
+                      [tty for tty in self.state.status if tty not in self.inventory.ttys])
+        self.sync()
+
+    def stop(self):
+        # stop taking connections first, so clients fall back to the file
+        self.sel.unregister(self.sock)
+        self.sock.close()
+        os.unlink(settings.broker_path)
+        for client in list(self.clients.values()):
+            if client.waiting is not None:
+                self.cancel_wait(client)
+                client.send({'result' : None})
+                client.flush()
+            self.sel.unregister(client.sock)
+            client.sock.close()
+        self.clients = {}
+        if self.inventory is not None:
+            self.sel.unregister(self.inventory)
+            self.inventory.close()
+        self.sel.close()
+        self.sync()
+
+    def serve(self):
+        while True:
+            events = self.sel.select(self.next_timeout())
+            for key, mask in events:
+                if key.fileobj is self.sock:
+                    self.accept()
+                elif key.fileobj is self.inventory:
+                    self.plug(*self.inventory.read())
+                else:
+                    self.read(self.clients[key.fileobj.fileno()])
+            self.expire()
+            if time.monotonic() >= self.next_reap:
+                self.reap()
+                self.next_reap = time.monotonic() + settings.reap_interval
+            # the store has to have a change before anyone hears about it
+            while self.sync():
+                self.dispatch()
+            for client in self.clients.values():
+                client.flush()
+
+    # Write whatever's changed since the last sync through to the status store,
+    # with the same compare-and-swap commit as everyone else, against the
+    # generations we last saw there. If an entry was changed in the store
+    # behind our back (by a client that couldn't reach us), the store's version
+    # wins, as it would for any other commit. Returns True if that happened.
+    def sync(self):
+        current = self.state.snapshot()
+        updates = {}
+        removes = {}
+        for tty in self.saved:
+            if tty not in current:
+                removes[tty] = self.saved[tty][1]
+        for tty in current:
+            if tty not in self.saved:
+                updates[tty] = (None, current[tty][0])
+            elif current[tty][0] != self.saved[tty][0]:
+                updates[tty] = (self.saved[tty][1], current[tty][0])
+        if not updates and not removes:
+            return False
+
+        with manager.status_store() as s:
+            updated = manager.apply_commit(s, updates, removes)
+            self.saved = s.snapshot()
+        lost = [tty for tty in updates if tty not in updated]
+        lost += [tty for tty in removes if tty in self.saved]
+        for tty in lost:
+            print('WARNING: broker: {} was changed in the status store, taking that'.format(repr(tty)),
+                  file=sys.stderr)
+            if tty in self.saved:
+                self.state.set(tty, self.saved[tty][0])
+            elif tty in self.state.status:
+                self.state.remove(tty)
+            for client in self.clients.values():
+                client.owned.discard(tty)
+                grant = {'result' : tty}
+                if grant in client.outbox and client.asked is not None:
+                    # it hasn't been told yet, so it can wait for another
+                    client.outbox.remove(grant)
+                    self.wait(client, *client.asked)
+        return bool(lost)
+
+    # connections
+
+    def accept(self):
+        try:
+            sock, _ = self.sock.accept()
+        except BlockingIOError:
+            return
+        sock.setblocking(True)
+        self.clients[sock.fileno()] = Client(sock, self.client_pid(sock))
+        self.sel.register(sock, selectors.EVENT_READ)
+
+    def read(self, client):
+        try:
+            data = client.sock.recv(65536)
+        except OSError:
+            data = b''
+        if not data:
+            self.drop(client)
+            return
+        client.buf += data
+        while b'\n' in client.buf:
+            line, client.buf = client.buf.split(b'\n', 1)
+            try:
+                args = json.loads(line.decode('ascii'))
+                op = args[0]
+            except Exception as e:
+                client.send({'warning' : 'broker: bad request: {}'.format(repr(e))})
+                continue
+            self.execute(client, op, args[1:])
+
+    # The client went away. If its process is still connected, the process
+    # keeps what it was holding; otherwise it's free.
+    def drop(self, client):
+        if client.waiting is not None:
+            self.cancel_wait(client)
+        self.sel.unregister(client.sock)
+        del self.clients[client.sock.fileno()]
+        client.sock.close()
+        for other in self.clients.values():
+            if other.pid == client.pid:
+                other.owned.update(client.owned)
+                return
+        for tty in client.owned:
+            if tty in self.state.status and self.state.status[tty] not in (None, settings.tty_mark):
+                self.state.set(tty, None)
+        self.dispatch()
+
+    def plug(self, added, removed):
+        hotplug.unplugged(removed)
+        updates, removes = hotplug.changes(self.state.snapshot(), added, removed)
+        manager.apply_commit(self.state, updates, removes)
+        for client in self.clients.values():
+            client.owned.difference_update(removed)
+        self.dispatch()
+
+    # requests
+
+    def execute(self, client, op, args):
+        try:
+            handler = getattr(self, 'op_' + op)
+        except AttributeError:
+            client.send({'warning' : 'broker: unknown request {}'.format(repr(op))})
+            return
+        try:
+            reply = handler(client, *args)
+        except Exception as e:
+            client.send({'warning' : 'broker: {}: {}'.format(op, repr(e))})
+            return
+        if reply is not None:
+            client.send(reply)
+
+    def op_get(self, client, timeout, priority):
+        pid = client.pid
+        deadline = None if timeout is None else time.monotonic() + timeout
+        client.asked = (priority, deadline)
+        tty = self.take(client, pid)
+        if tty is None:
+            # reaping serves the queue first, so this client only gets leftovers
+            self.reap()
+            tty = self.take(client, pid)
+        if tty is not None:
+            return {'result' : tty}
+        if timeout is not None and timeout <= 0:
+            return {'result' : None}
+        # no reply until a tty comes free or we time out
+        self.wait(client, priority, deadline)
+        return None
+
+    def op_claim(self, client, tty, pid):
+        if tty in self.state.status:
+            self.state.set(tty, pid)
+            return {'result' : None}
+        else:
+            return {'warning' : 'claim_tty: no tty {} for pid {}'.format(repr(tty), repr(pid))}
+
+    def op_release(self, client, tty):
+        if tty in self.state.status:
+            self.state.set(tty, None)
+            for other in self.clients.values():
+                other.owned.discard(tty)
+            self.dispatch()
+            return {'result' : None}
+        else:
+            return {'warning' : 'release_tty: no tty {}'.format(repr(tty))}
+
+    def op_mark(self, client, tty):
+        if tty in self.state.status:
+            self.state.set(tty, settings.tty_mark)
+            for other in self.clients.values():
+                other.owned.discard(tty)
+            return {'result' : None}
+        else:
+            return {'warning' : 'mark_tty: no tty {}'.format(repr(tty))}
+
+    def op_check(self, client, tty):
+        return {'result' : self.state.status.get(tty)}
+
+    def op_list(self, client):
+        return {'result' : self.state.status}
+
+    def op_snapshot(self, client):
+        return {'result' : self.state.snapshot()}
+
+    def op_commit(self, client, updates, removes):
+        updated = manager.apply_commit(self.state, updates, removes)
+        self.dispatch()
+        return {'result' : updated}
+
+    # maintenance
+
+    def reap(self):
+        snapshot = self.state.snapshot()
+        updates = manager.dead_sessions(snapshot)
+        if updates:
+            reaped = manager.apply_commit(self.state, updates, {})
+            manager.log_reaped({tty : snapshot[tty][0] for tty in reaped})
+            for client in self.clients.values():
+                client.owned.difference_update(reaped)
+            self.dispatch()
+
+    # waiting
+
+    # SO_PEERCRED tells us who is on the other end, so reservations are labeled
+    # with the client's pid just like get_tty does without a broker.
+    def client_pid(self, sock):
+        creds = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, 12)
+        return int.from_bytes(creds[:4], sys.byteorder, signed=True)
+
+    def take(self, client, pid):
+        for tty in self.state.status:
+            if self.state.status[tty] is None:
+                self.reserve(client, tty, pid)
+                return tty
+        return None
+
+    def reserve(self, client, tty, pid):
+        self.state.set(tty, pid)
+        client.owned.add(tty)
+
+    def wait(self, client, priority, deadline):
+        entry = [priority, next(self.seq), client, client.pid]
+        heapq.heappush(self.waiters, entry)
+        client.waiting = (deadline, entry)
+
+    def cancel_wait(self, client):
+        deadline, entry = client.waiting
+        entry[2] = None
+        client.waiting = None
+
+    def dispatch(self):
+        free_ttys = [tty for tty in sorted(self.state.status) if self.state.status[tty] is None]
+        while free_ttys and self.waiters:
+            priority, seq, client, pid = heapq.heappop(self.waiters)
+            if client is None:
+                continue
+            tty = free_ttys.pop(0)
+            client.waiting = None
+            self.reserve(client, tty, pid)
+            client.send({'result' : tty})
+
+    def next_timeout(self):
+        deadlines = [client.waiting[0] for client in self.clients.values()
+                     if client.waiting is not None and client.waiting[0] is not None]
+        return max(0, min(deadlines + [self.next_reap]) - time.monotonic())
+
+    def expire(self):
+        now = time.monotonic()
+        for client in self.clients.values():
+            if client.waiting is not None and client.waiting[0] is not None and client.waiting[0] <= now:
+                self.cancel_wait(client)
+                client.send({'result' : None})
+
+def terminate(signum, frame):
+    raise SystemExit(0)
+
+def run():
+    b = Broker()
+    b.start()
+    signal.signal(signal.SIGTERM, terminate)
+    try:
+        b.serve()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        b.stop()
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,59 @@
+# mspdebug commands
+#
+# The command lines we send mspdebug and how to read what comes back, in one
+# place for driver.Mspdebug, driver.Batch and aiodriver.AsyncMspdebug.
+
+import settings
+import utils
+
+
+def mw(addr, data):
+    return ('mw {:#x}' + (' {:#x}' * len(data))).format(addr, *data)
+
+# Any amount of data, as mw commands of at most max_len (settings.mw_max_bytes
+# by default) bytes each.
+def mw_chunks(addr, data, max_len = None):
+    if max_len is None:
+        max_len = settings.mw_max_bytes
+    return [mw(addr + i, data[i:i+max_len]) for i in range(0, len(data), max_len)]
+
+def fill(addr, size, pattern):
+    return ('fill {:#x} {:d}' + (' {:#x}' * len(pattern))).format(addr, size, *pattern)
+
+def setreg(register, value):
+    return 'set {:d} {:#x}'.format(register, value)
+
+def md(addr, size):
+    return 'md {:#x} {:d}'.format(addr, size)
+
+# size bytes from addr as (addr, size) pieces of at most chunk bytes
+def md_ranges(addr, size, chunk):
+    return [(a, min(chunk, addr + size - a)) for a in range(addr, addr + size, chunk)]
+
+def prog(fname):
+    return 'prog {:s}'.format(fname)
+
+def setbreak(addr, index):
+    return 'setbreak {:#x} {:d}'.format(addr, index)
+
+def delbreak(index):
+    return 'delbreak {:d}'.format(index)
+
+def erase_segment(addr):
+    return 'erase segment {:#x}'.format(addr)
+
+
+def parse_md(output, addr, size):
+    base_addr, data = utils.parse_mem(output, size)
+    assert base_addr == addr
+    return data
+
+# Does md output show data at addr? For checking a write, where a mismatch is
+# an answer rather than an error.
+def md_matches(output, addr, data):
+    base_addr, readback = utils.parse_mem(output, len(data))
+    return base_addr == addr and readback == bytes(data)
+
+# the pc from a register dump (regs, step, or stopping after run)
+def parse_pc(output):
+    return utils.parse_regs(output)[0]
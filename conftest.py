@@ -0,0 +1,40 @@
+import settings
+import manager
+
+import os
+
+import pytest
+
+
+# Point everything that lives on disk at a fresh directory, with fake ttys that
+# nobody has open, and a status store that knows about them.
+@pytest.fixture
+def ttys(tmp_path, monkeypatch):
+    tty_dir = tmp_path / 'dev'
+    tty_dir.mkdir()
+    names = ['ttyACM{:d}'.format(i) for i in range(4)]
+    for tty in names:
+        (tty_dir / tty).touch()
+    status_dir = tmp_path / 'status'
+    monkeypatch.setattr(settings, 'tty_dir', str(tty_dir))
+    monkeypatch.setattr(settings, 'status_dir', str(status_dir))
+    monkeypatch.setattr(settings, 'status_path', str(status_dir / 'status.json'))
+    monkeypatch.setattr(settings, 'status_table_path', str(status_dir / 'status.tbl'))
+    monkeypatch.setattr(settings, 'wait_dir', str(status_dir / 'wait'))
+    monkeypatch.setattr(settings, 'broker_path', str(status_dir / 'broker.sock'))
+    monkeypatch.setattr(settings, 'reap_log', str(status_dir / 'reaped.log'))
+    monkeypatch.setattr(settings, 'log_dir', str(tmp_path / 'logs'))
+    monkeypatch.setattr(settings, 'prog_record_dir', str(tmp_path / 'prog'))
+    manager.refresh()
+    yield names
+    with manager.broker_lock:
+        for client in manager.broker_idle:
+            client.close()
+        del manager.broker_idle[:]
+
+# Sessions get fakemspdebug.py instead of mspdebug, on the fake ttys above.
+@pytest.fixture
+def fake_mspdebug(ttys, monkeypatch):
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fakemspdebug.py')
+    monkeypatch.setattr(settings, 'mspdebug', path)
+    return path
@@ -1,172 +1,572 @@
 import settings
 import manager
+import transport
+import sessionlog
+import memcache
+import progdelta
+import elftools
+import steptrace
+import snapshot
+import commands
 import utils
 
 import pexpect
-from pexpect.replwrap import REPLWrapper
-import os
 import time
 
 
-def logpath(tty):
-    return os.path.join(settings.log_dir, tty+'.log')
-
 log_error_re = settings.make_log_error_re()
 
+def find_error(text):
+    codes = log_error_re.findall(text)
+    try:
+        error_code = int(codes[-1])
+    except Exception:
+        error_code = None
+    return error_code
+
 class NoTTYError(Exception):
     pass
 
+# a full register dump from mspdebug
+n_regs = 16
+
+# SR bits for LPM4 (CPUOFF, OSCOFF, SCG0 and SCG1), where nothing's clocked to
+# wake the target up, and the encoding of jmp $
+sr_lpm4 = 0x00f0
+jmp_self = 0x3fff
+
+# All the registers, if output is a full register dump, or None.
+def full_regs(output):
+    try:
+        regs = utils.parse_regs(output)
+    except ValueError:
+        return None
+    return regs if len(regs) == n_regs else None
 
-class Mspdebug(object):
-    def __init__(self):
+# Stopped for good, given the registers and the instruction at the pc: in LPM4,
+# or spinning on jmp $. Lighter low power modes (just CPUOFF) are only sleeping
+# until the next interrupt.
+def is_halted(regs, insn):
+    if regs[2] & sr_lpm4 == sr_lpm4:
+        return True
+    return insn[0] | (insn[1] << 8) == jmp_self
+
+
+# The parts of a session that don't talk to mspdebug: settings, the session log,
+# checking commands, and keeping the caches. Mspdebug and
+# aiodriver.AsyncMspdebug do the talking, and share the command lines and
+# parsing in commands.py.
+class MspdebugBase(object):
+    # timeout and priority are passed to manager.get_tty; by default, give up
+    # right away if there are no free ttys. log_level is one of
+    # sessionlog.log_levels, defaulting to settings.log_level. With cache,
+    # md/mw/fill go through a memcache.MemCache.
+    def __init__(self, timeout = 0, priority = 0, log_level = None, cache = False):
+        self.timeout = timeout
+        self.priority = priority
+        self.log_level = log_level
+        self.cache = memcache.MemCache() if cache else None
+        # the last full register dump we saw, if nothing has run since
+        self.reg_cache = None
         self.tty = None
-        self.log_f = None
-        self.spawn = None
-        self.repl = None
+        self.log = None
+        self.conn = None
+        # (tty, error code) for each tty mspdebug wouldn't start on
+        self.failed_ttys = []
 
     def open_log(self):
-        if not os.path.isdir(settings.log_dir):
-            os.makedirs(settings.log_dir, exist_ok=True)
-        self.log_f = open(logpath(self.tty), 'at')
-        self.log_f.write(settings.make_log_spacer())
-        self.log_f.flush()
+        self.log = sessionlog.SessionLog(self.tty, level=self.log_level)
 
-    # I don't know if pexpect does this for us, but it probably doesn't hurt.
     def close_log(self):
-        self.log_f.close()
+        self.log.close()
 
-    # This is kind of a stupid hack, but it looks like REPLWrapper blows away any
-    # info that would let us pull this out of the pexpect.spawn object directly.
-    #   Or can we just use self.spawn.before ??
+    # The transport logs all of mspdebug's output, so the last thing it said
+    # before quitting is still in the log's ring buffer.
     def get_error_from_log(self):
-        self.log_f.flush()
-        with open(logpath(self.tty), 'rb') as f:
-            try:
-                f.seek(-settings.log_error_window, 2)
-                logtail = f.read(1024).decode()
-            except OSError:
-                # Seek can fail if the file is to short, so just read the whole thing.
-                f.seek(0)
-                logtail = f.read().decode()
-        codes = log_error_re.findall(logtail)
+        return find_error(self.log.tail(settings.log_error_window))
+
+    def mspargs(self):
+        return [settings.mspdebug, settings.mspdebug_driver, '-d', self.tty]
+
+    # mspdebug wouldn't start on self.tty. Returns its error code.
+    def note_failure(self):
+        self.log.error()
+        error_code = self.get_error_from_log()
+        self.failed_ttys.append((self.tty, error_code))
+        self.close_log()
+        return error_code
+
+    # Returns the cleaned-up command, or None and the reason it can't be sent.
+    def check_command(self, cmd):
+        cleaned = cmd.strip()
+        if cleaned:
+            cmd_args = cleaned.split()
+            if cmd_args[0] in settings.mspdebug_cmd_blacklist:
+                return None, '{:s}: blacklisted!'.format(cmd_args[0])
+            else:
+                return cleaned, None
+        else:
+            return None, '{:s}: no command'.format(repr(cmd))
+
+    # register cache
+
+    # Keep the registers from any command that dumps them all (regs, step,
+    # interrupting run); anything else that could change them clears the cache.
+    def note_regs(self, cmd, output):
+        if cmd.split()[0] in settings.regcache_keep_commands:
+            return
+        self.reg_cache = full_regs(output)
+
+    # The registers from before a set, updated, or None if we can't tell.
+    # R3 is the constant generator, so there's no telling what it reads as.
+    def set_cached_reg(self, regs, register, value):
+        if regs is not None and 0 <= register < n_regs and register != 3:
+            regs[register] = value & 0xfffff
+            return regs
+        return None
+
+    # memory cache
+
+    # Anything that might change memory throws the cache away. Flush first.
+    def invalidate_cache(self, cmds):
+        if self.cache is not None:
+            if any(cmd.split()[0] not in settings.memcache_keep_commands for cmd in cmds):
+                self.cache.invalidate()
+
+    def cache_stats(self):
+        if self.cache is None:
+            return None
+        return self.cache.stats()
+
+    # prog_delta
+
+    # What prog_delta(fname) should do: (None, None) for a plain prog if fname
+    # won't load, (hashes, None) for a full prog if we don't know what's on the
+    # board, or (hashes, (cmds, expected)) to send cmds and then check that
+    # expected reads back. In the last case the record is forgotten, since it's
+    # wrong if we don't make it to the end.
+    def plan_delta(self, fname):
         try:
-            error_code = int(codes[-1])
+            blocks, _ = elftools.load(fname)
         except Exception:
-            error_code = None
-        return error_code
-            
+            return None, None
+        segments = progdelta.image_segments(progdelta.flash_blocks(blocks), settings.flash_segment_size)
+        hashes = progdelta.image_hashes(segments)
+
+        record = progdelta.load_record(self.tty)
+        if record is None:
+            return hashes, None
+        changed, removed = progdelta.diff(record, hashes)
+        if removed and not settings.prog_delta_erase:
+            return hashes, None
+
+        progdelta.forget(self.tty)
+        return hashes, progdelta.delta_commands(segments, changed, removed)
+
+    # outputs are from md-ing each of expected.
+    def check_delta(self, expected, outputs):
+        for (addr, data), output in zip(expected, outputs):
+            if not commands.md_matches(output, addr, data):
+                print('WARNING: prog_delta: readback of {:#x} failed on {}, doing a full prog'
+                      .format(addr, repr(self.tty)))
+                return False
+        return True
+
+
+class Mspdebug(MspdebugBase):
+    # transport is one of the names in transport.transports, defaulting to
+    # settings.mspdebug_transport; the rest is as for MspdebugBase.
+    def __init__(self, timeout = 0, priority = 0, transport = None, log_level = None, cache = False):
+        MspdebugBase.__init__(self, timeout=timeout, priority=priority, log_level=log_level, cache=cache)
+        self.transport = transport if transport is not None else settings.mspdebug_transport
+
     def start_repl(self):
-        repl = None
-        
-        while repl is None:
-            tty = manager.get_tty()
+        while self.conn is None:
+            tty = manager.get_tty(timeout=self.timeout, priority=self.priority)
             if tty is None:
                 raise NoTTYError
-            else:
-                self.tty = tty
+            self.connect(tty)
 
-            mspargs = [settings.mspdebug_driver, '-d', self.tty]
-            self.open_log()
+    # Start mspdebug on a tty we've already reserved. If it won't start, mark the
+    # tty if the error calls for it, and return False.
+    def connect(self, tty):
+        self.tty = tty
+        self.open_log()
 
-            try:
-                P = pexpect.spawn('mspdebug', mspargs, encoding='ascii', logfile=self.log_f)
-                R = REPLWrapper(P, settings.mspdebug_prompt, None)
-                manager.claim_tty(self.tty, P.pid)
-                spawn = P
-                repl = R
-            except pexpect.EOF:
-                error_code = self.get_error_from_log()
-                if error_code in settings.errors_to_mark:
-                    manager.mark_tty(self.tty)
-                self.close_log()
-
-        self.spawn = spawn
-        self.repl = repl
+        try:
+            C = transport.spawn(self.transport, self.mspargs(), settings.mspdebug_prompt, logfile=self.log)
+            manager.claim_tty(self.tty, C.pid)
+            self.conn = C
+            return True
+        except pexpect.EOF:
+            if self.note_failure() in settings.errors_to_mark:
+                manager.mark_tty(self.tty)
+            return False
 
     def exit_repl(self):
         try:
-            self.repl.run_command('exit')
+            self.flush_cache()
+            self.conn.run_command('exit')
         except pexpect.EOF:
             manager.release_tty(self.tty)
         else:
             print('failed to release tty {}'.format(repr(self.tty)))
+        self.conn.close()
+
+    def close(self):
+        self.exit_repl()
+        self.close_log()
 
     def __enter__(self):
         self.start_repl()
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self.exit_repl()
-        self.close_log()
-        
+        if exc_type is not None:
+            self.log.error()
+        self.close()
+
     # raw text api
-        
+
     def run_command(self, cmd):
-        cleaned = cmd.strip()
-        if cleaned:
-            cmd_args = cleaned.split()
-            if cmd_args[0] in settings.mspdebug_cmd_blacklist:
-                return '{:s}: blacklisted!'.format(cmd_args[0])
-            else:
-                return self.repl.run_command(cleaned)
+        cleaned, error = self.check_command(cmd)
+        if cleaned is None:
+            return error
         else:
-            return '{:s}: no command'.format(repr(cmd))
+            self.sync_cache([cleaned])
+            output = self.conn.run_command(cleaned)
+            self.note_regs(cleaned, output)
+            return output
+
+    # Run a list of commands pipelined, returning their outputs in order.
+    # Commands that fail check_command aren't sent; their "output" is the reason.
+    def run_commands(self, cmds):
+        checked = [self.check_command(cmd) for cmd in cmds]
+        to_send = [cleaned for cleaned, error in checked if cleaned is not None]
+        self.sync_cache(to_send)
+        sent_outputs = transport.run_commands(self.conn, to_send, settings.mspdebug_prompt,
+                                              settings.pipeline_window)
+        for cmd, output in zip(to_send, sent_outputs):
+            self.note_regs(cmd, output)
+        outputs = iter(sent_outputs)
+        return [next(outputs) if cleaned is not None else error for cleaned, error in checked]
+
+    def batch(self):
+        return Batch(self)
 
     def run_continue(self):
-        self.spawn.sendline('run')
-        self.spawn.expect_exact('Running. Press Ctrl+C to interrupt...')
-        return self.spawn.before
+        self.sync_cache(['run'])
+        self.reg_cache = None
+        self.conn.sendline('run')
+        return self.conn.expect_exact('Running. Press Ctrl+C to interrupt...')
+
+    # Keep running until mspdebug comes back with the prompt on its own, or until
+    # timeout seconds pass, then interrupt. With halt, also stop every so often
+    # to see if the target has halted (see is_halted), and return if it has.
+    def wait_for_stop(self, timeout = None, halt = False):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        poll = settings.halt_poll_min
+        while True:
+            self.run_continue()
+            remaining = None if deadline is None else max(0, deadline - time.monotonic())
+            wait = remaining
+            if halt:
+                wait = poll if remaining is None else min(poll, remaining)
+            try:
+                output = self.conn.expect_exact(settings.mspdebug_prompt, timeout=wait)
+                self.note_regs('run', output)
+                return output
+            except pexpect.TIMEOUT:
+                output = self.interrupt()
+            if self.resync():
+                # it stopped by itself just before the interrupt got there
+                return output
+            if deadline is not None and time.monotonic() >= deadline:
+                return output
+            if halt and self.halted(utils.parse_regs(output)):
+                return output
+            poll = min(poll * 2, settings.halt_poll_max)
+
+    # If the target stopped by itself between a timeout and the interrupt, the
+    # interrupt finds mspdebug already at the prompt, and there's an extra one
+    # coming. Send regs and skip prompts until its output shows up, so the next
+    # command lines up with its own output. Returns True if anything was skipped.
+    def resync(self):
+        self.conn.sendline('regs')
+        skipped = False
+        while True:
+            regs = full_regs(self.conn.expect_exact(settings.mspdebug_prompt))
+            if regs is not None:
+                self.reg_cache = regs
+                return skipped
+            skipped = True
+
+    def halted(self, regs):
+        return is_halted(regs, self.read_mem(regs[0], 2))
 
     def interrupt(self):
-        self.spawn.sendintr()
-        self.spawn.expect_exact(settings.mspdebug_prompt)
-        return self.spawn.before
+        self.conn.sendintr()
+        output = self.conn.expect_exact(settings.mspdebug_prompt)
+        self.note_regs('run', output)
+        return output
+
+    # snapshots
+
+    # Read memory (settings.snapshot_ranges, unless given other (address, size)
+    # ranges) and registers into a snapshot.Snapshot.
+    def snapshot(self, ranges = None):
+        if ranges is None:
+            ranges = settings.snapshot_ranges
+        regs = self.reg_cache
+        outputs = self.run_commands(snapshot.snapshot_commands(ranges, regs))
+        return snapshot.parse_snapshot(ranges, outputs, regs)
+
+    # Put the board back the way snap found it, writing only the memory and
+    # registers that have changed since. Returns how many commands that took.
+    def restore(self, snap):
+        current = self.snapshot(snap.ranges())
+        cmds, regs = snapshot.restore_commands(current, snap)
+        if cmds:
+            self.run_commands(cmds)
+        self.reg_cache = regs
+        return len(cmds)
+
+    # memory cache
+
+    def flush_cache(self):
+        if self.cache is not None:
+            self.cache.flush(self.write_mem)
+
+    # Raw commands see memory as it would be without the cache, and anything
+    # that might change it throws the cache away.
+    def sync_cache(self, cmds):
+        if self.cache is not None:
+            self.flush_cache()
+            self.invalidate_cache(cmds)
+
+    # Device access underneath the cache.
+
+    def read_mem(self, addr, size):
+        raw_output = self.conn.run_command(commands.md(addr, size))
+        return commands.parse_md(raw_output, addr, size)
+
+    def write_mem(self, runs):
+        cmds = [commands.mw(addr, data) for addr, data in runs]
+        transport.run_commands(self.conn, cmds, settings.mspdebug_prompt, settings.pipeline_window)
 
     # standard python-level api
 
     def reset(self):
         self.run_command('reset')
-        reg_output = self.run_command('regs')
-        regs = utils.parse_regs(reg_output)
-        return regs[0]
+        return self.regs()[0]
 
     def prog(self, fname):
-        raw_output = self.run_command('prog {:s}'.format(fname))
+        progdelta.forget(self.tty)
+        raw_output = self.run_command(commands.prog(fname))
         imgsize = utils.parse_prog(raw_output)
         if imgsize is None:
             return raw_output.strip()
         else:
-            reg_output = self.run_command('regs')
-            regs = utils.parse_regs(reg_output)
-            return regs[0]
+            return self.regs()[0]
+
+    # Like prog, but only erase and rewrite the flash segments that changed since
+    # the board was last programmed, then read them back to check. Does a full
+    # prog instead if we don't know what's on the board, or if the check fails.
+    def prog_delta(self, fname):
+        hashes, delta = self.plan_delta(fname)
+        if hashes is None:
+            return self.prog(fname)
+        if delta is None:
+            return self.prog_record(fname, hashes)
+
+        cmds, expected = delta
+        self.run_commands(cmds)
+        outputs = self.run_commands([commands.md(addr, len(data)) for addr, data in expected])
+        if not self.check_delta(expected, outputs):
+            return self.prog_record(fname, hashes)
+
+        progdelta.save_record(self.tty, hashes)
+        return self.regs()[0]
+
+    def prog_record(self, fname, hashes):
+        result = self.prog(fname)
+        if isinstance(result, int):
+            progdelta.save_record(self.tty, hashes)
+        return result
 
     def mw(self, addr, pattern):
-        self.run_command(('mw {:#x}' + (' {:#x}' * len(pattern))).format(addr, *pattern))
+        if self.cache is not None:
+            self.cache.write(addr, pattern)
+        elif len(pattern) > settings.mw_max_bytes:
+            self.write_bulk(addr, pattern)
+        else:
+            self.run_command(commands.mw(addr, pattern))
+
+    # Write any amount of data, as pipelined mw commands of at most
+    # settings.mw_max_bytes each.
+    def write_bulk(self, addr, data):
+        self.sync_cache(['mw'])
+        transport.run_commands(self.conn, commands.mw_chunks(addr, data), settings.mspdebug_prompt,
+                               settings.pipeline_window)
 
     def fill(self, addr, size, pattern):
-        self.run_command(('fill {:#x} {:d}' + (' {:#x}' * len(pattern))).format(addr, size, *pattern))
+        if self.cache is not None:
+            self.cache.fill(addr, size, pattern)
+        else:
+            self.run_command(commands.fill(addr, size, pattern))
 
     def setreg(self, register, value):
-        self.run_command('set {:d} {:#x}'.format(register, value))
+        regs = self.reg_cache
+        self.run_command(commands.setreg(register, value))
+        self.reg_cache = self.set_cached_reg(regs, register, value)
 
+    # Returns a memoryview of the size bytes at addr (see Batch).
     def md(self, addr, size):
-        raw_output = self.run_command('md {:#x} {:d}'.format(addr, size))
-        base_addr, data = utils.parse_mem(raw_output)
-        assert base_addr == addr
-        return data
+        if self.cache is not None:
+            return self.cache.read(addr, size, self.read_mem)
+        else:
+            return self.read_mem(addr, size)
+
+    # Read size bytes starting at addr, chunk bytes (settings.md_chunk by
+    # default) per md, yielding each chunk as a memoryview as soon as it's in.
+    # A few mds are kept in flight, so memory use doesn't grow with size.
+    def md_iter(self, addr, size, chunk = None):
+        if chunk is None:
+            chunk = settings.md_chunk
+        self.flush_cache()
+        ranges = commands.md_ranges(addr, size, chunk)
+        cmds = [commands.md(a, n) for a, n in ranges]
+        outputs = transport.iter_commands(self.conn, cmds, settings.mspdebug_prompt,
+                                          settings.pipeline_window, depth=settings.md_iter_depth)
+        try:
+            for (a, n), output in zip(ranges, outputs):
+                yield commands.parse_md(output, a, n)
+        finally:
+            outputs.close()
 
     def regs(self):
+        if self.reg_cache is not None:
+            return list(self.reg_cache)
         raw_output = self.run_command('regs')
         return utils.parse_regs(raw_output)
 
     def step(self):
         raw_output = self.run_command('step')
-        regs = utils.parse_regs(raw_output)
+        return commands.parse_pc(raw_output)
+
+    # Single-step n_steps times, writing the registers after every step to sink:
+    # a steptrace.TraceWriter, or the name of a trace file to create. Steps are
+    # pipelined settings.trace_batch at a time. Returns the final pc.
+    def trace(self, n_steps, sink):
+        if isinstance(sink, str):
+            with steptrace.TraceWriter(sink) as writer:
+                return self.trace(n_steps, writer)
+
+        self.sync_cache(['step'])
+        self.reg_cache = None
+        regs = None
+        for done in range(0, n_steps, settings.trace_batch):
+            n = min(settings.trace_batch, n_steps - done)
+            outputs = transport.run_commands(self.conn, ['step'] * n, settings.mspdebug_prompt,
+                                             settings.pipeline_window)
+            rows = [utils.parse_regs(output) for output in outputs]
+            sink.write(rows)
+            regs = rows[-1]
+        if regs is None:
+            return None
+        self.reg_cache = list(regs)
         return regs[0]
 
+    # Run until the pc gets to pc (using a breakpoint), the target halts by
+    # itself (if halt), or timeout seconds pass, whichever comes first; with
+    # none of those, run until mspdebug stops for some other reason. Returns
+    # the pc where it stopped.
+    def run_until(self, pc = None, timeout = None, halt = False):
+        if pc is not None:
+            self.run_command(commands.setbreak(pc, settings.run_until_break))
+        try:
+            raw_output = self.wait_for_stop(timeout=timeout, halt=halt)
+        finally:
+            if pc is not None:
+                self.run_command(commands.delbreak(settings.run_until_break))
+        return commands.parse_pc(raw_output)
+
     def run(self, interval = 0.5):
         self.run_continue()
         time.sleep(interval)
         raw_output = self.interrupt()
-        regs = utils.parse_regs(raw_output)
-        return regs[0]
+        return commands.parse_pc(raw_output)
+
+
+# Collects commands and runs them all at once, pipelined, when the with block
+# ends (or when run() is called):
+#
+#   with mspdebug.batch() as b:
+#       b.setreg(4, 0x1234)
+#       b.mw(0x1c00, [1, 2, 3])
+#       b.md(0x1c00, 3)
+#   b.results # [None, None, <memory>]
+#   bytes(b.results[2]) # b'\x01\x02\x03'
+#
+# Each call also returns the index of its result. As with Mspdebug.md, md
+# results are memoryviews, not lists or bytes. Each one has a buffer of its
+# own (with the cache, a copy), so later mds and writes don't change it and
+# it can be kept as long as you like; bytes(view) gives plain bytes.
+class Batch(object):
+    def __init__(self, mspdebug):
+        self.mspdebug = mspdebug
+        self.cmds = []
+        # (number of commands, function from their outputs to a result)
+        self.ops = []
+        self.results = None
+
+    def add(self, cmds, parse):
+        self.cmds += cmds
+        self.ops.append((len(cmds), parse))
+        return len(self.ops) - 1
+
+    def run(self):
+        return self.results_from(self.mspdebug.run_commands(self.cmds))
+
+    # Sort the outputs of self.cmds into results, and start over.
+    def results_from(self, outputs):
+        results = []
+        i = 0
+        for n, parse in self.ops:
+            results.append(parse(outputs[i:i+n]))
+            i += n
+        self.cmds = []
+        self.ops = []
+        self.results = results
+        return results
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.run()
+
+    def command(self, cmd):
+        return self.add([cmd], lambda outputs: outputs[0])
+
+    def reset(self):
+        return self.add(['reset', 'regs'], lambda outputs: commands.parse_pc(outputs[1]))
+
+    def mw(self, addr, pattern):
+        return self.add([commands.mw(addr, pattern)], lambda outputs: None)
+
+    def fill(self, addr, size, pattern):
+        return self.add([commands.fill(addr, size, pattern)], lambda outputs: None)
+
+    def setreg(self, register, value):
+        return self.add([commands.setreg(register, value)], lambda outputs: None)
+
+    def md(self, addr, size):
+        return self.add([commands.md(addr, size)], lambda outputs: commands.parse_md(outputs[0], addr, size))
+
+    def regs(self):
+        return self.add(['regs'], lambda outputs: utils.parse_regs(outputs[0]))
+
+    def step(self):
+        return self.add(['step'], lambda outputs: commands.parse_pc(outputs[0]))
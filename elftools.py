@@ -310,188 +310,188 @@ def load(fname, restore_regs = False, verbosity = 0):
     else:
         return data_blocks(loaded_memory), None
 
-# save_header = {
-#     'ei_mag'        : elf_magic,
-#     'ei_class'      : elf_msp_class,
-#     'ei_data'       : elf_msp_data,
-#     'ei_version'    : elf_version,
-#     'ei_osabi'      : 0,
-#     'ei_abiversion' : 0,
-#     'e_type'        : 2, # it's kind of a core file though (4)
-#     'e_machine'     : elf_msp_machine,
-#     'e_version'     : elf_version,
-#     'e_entry'       : None,
-#     'e_phoff'       : None,
-#     'e_shoff'       : None,
-#     'e_flags'       : 0x0,
-#     'e_ehsize'      : 52,
-#     'e_phentsize'   : 32,
-#     'e_phnum'       : None,
-#     'e_shentsize'   : 40,
-#     'e_shnum'       : None,
-#     'e_shstrndx'    : None,
-# }
-# save_prog = {
-#     'p_type'   : 1,
-#     'p_offset' : None,
-#     'p_vaddr'  : None,
-#     'p_paddr'  : None,
-#     'p_filesz' : None,
-#     'p_memsz'  : None,
-#     'p_flags'  : 0x7, # RWE
-#     'p_align'  : 2,
-# }
-# save_section = {
-#     'sh_name'      : 0,
-#     'sh_type'      : 1, # PROGBITS
-#     'sh_flags'     : 0x7, # WAX
-#     'sh_addr'      : None,
-#     'sh_offset'    : None,
-#     'sh_size'      : None,
-#     'sh_link'      : 0,
-#     'sh_info'      : 0,
-#     'sh_addralign' : 2,
-#     'sh_entsize'   : 0,
-# }
-# save_symbol = {
-#     'st_name'  : None,
-#     'st_value' : None,
-#     'st_size'  : 0,
-#     'st_info'  : 0x3, # STT_SECTION
-#     'st_other' : 0,
-#     'st_shndx' : 0xfff1, # SHN_ABS
-# }
-
-# def save(state, fname, verbosity = 0):
-#     if verbosity >= 3:
-#         print('saving state:')
-#         state.dump()
-
-#     regions = state.segments()
-#     phoff = struct.calcsize(elf_header_schem)
-#     phnum = len(regions)
-#     header = save_header.copy()
-#     header['e_phoff'] = phoff
-#     header['e_phnum'] = phnum
-#     header['e_entry'] = state.entry()
-
-#     name_strtab = '.shstrtab'
-#     name_symtab = '.symtab'
-#     s_data = b'\x00'
-#     s_data, s_name_strtab = nt_string_append(s_data, name_strtab)
-#     s_data, s_name_symtab = nt_string_append(s_data, name_symtab)
-
-#     segments = []
-#     sections = []
-#     symbols = []
-#     # section 0 and symbol 0 are null
-#     sections.append({})
-#     symbols.append({})
-
-#     offset = phoff + (phnum * struct.calcsize(elf_prog_schem))
-#     idx = 0
-#     for addr, data in regions:
-#         name = '__segment_{:d}'.format(idx)
-#         s_data, s_name = nt_string_append(s_data, name)
-
-#         if verbosity >= 1:
-#             print('saving {:5d} bytes at {:05x} [section: {:s}]...'.format(
-#                 len(data), addr, name))
-
-#         segment = save_prog.copy()
-#         segment['p_offset'] = offset
-#         segment['p_vaddr']  = addr
-#         segment['p_paddr']  = addr
-#         segment['p_filesz'] = len(data)
-#         segment['p_memsz']  = len(data)
-#         segment['data']     = bytes(data)
-#         segments.append(segment)
-
-#         section = save_section.copy()
-#         section['name']      = name
-#         section['sh_name']   = s_name
-#         section['sh_addr']   = addr
-#         section['sh_offset'] = offset
-#         section['sh_size']   = len(data)
-#         section['data']      = bytes(data)
-#         sections.append(section)
-
-#         symbol = save_symbol.copy()
-#         symbol['name']     = name
-#         symbol['st_name']  = s_name
-#         symbol['st_value'] = addr
-#         symbols.append(symbol)
-
-#         offset += len(data)
-#         idx += 1
-
-#     # registers section (for internal use mostly)
-#     registers = state.registers()
-#     regdata = b''
-#     for r in registers:
-#         regdata += struct.pack('<I', r)
-#     name_registers = '__registers'
-#     s_data, s_name_registers = nt_string_append(s_data, name_registers)
-#     regtab = save_section.copy()
-#     regtab['name']         = name_registers
-#     regtab['sh_name']      = s_name_registers
-#     regtab['sh_type']      = elf_section_registers
-#     regtab['sh_flags']     = 0x0
-#     regtab['sh_addr']      = 0
-#     regtab['sh_offset']    = offset
-#     regtab['sh_size']      = len(regdata)
-#     regtab['sh_addralign'] = 4
-#     regtab['sh_entsize']   = 4
-#     regtab['data']         = regdata
-#     sections.append(regtab)
+save_header = {
+    'ei_mag'        : elf_magic,
+    'ei_class'      : elf_msp_class,
+    'ei_data'       : elf_msp_data,
+    'ei_version'    : elf_version,
+    'ei_osabi'      : 0,
+    'ei_abiversion' : 0,
+    'e_type'        : 2, # it's kind of a core file though (4)
+    'e_machine'     : elf_msp_machine,
+    'e_version'     : elf_version,
+    'e_entry'       : None,
+    'e_phoff'       : None,
+    'e_shoff'       : None,
+    'e_flags'       : 0x0,
+    'e_ehsize'      : 52,
+    'e_phentsize'   : 32,
+    'e_phnum'       : None,
+    'e_shentsize'   : 40,
+    'e_shnum'       : None,
+    'e_shstrndx'    : None,
+}
+save_prog = {
+    'p_type'   : 1,
+    'p_offset' : None,
+    'p_vaddr'  : None,
+    'p_paddr'  : None,
+    'p_filesz' : None,
+    'p_memsz'  : None,
+    'p_flags'  : 0x7, # RWE
+    'p_align'  : 2,
+}
+save_section = {
+    'sh_name'      : 0,
+    'sh_type'      : 1, # PROGBITS
+    'sh_flags'     : 0x7, # WAX
+    'sh_addr'      : None,
+    'sh_offset'    : None,
+    'sh_size'      : None,
+    'sh_link'      : 0,
+    'sh_info'      : 0,
+    'sh_addralign' : 2,
+    'sh_entsize'   : 0,
+}
+save_symbol = {
+    'st_name'  : None,
+    'st_value' : None,
+    'st_size'  : 0,
+    'st_info'  : 0x3, # STT_SECTION
+    'st_other' : 0,
+    'st_shndx' : 0xfff1, # SHN_ABS
+}
+
+def save(state, fname, verbosity = 0):
+    if verbosity >= 3:
+        print('saving state:')
+        state.dump()
+
+    regions = state.segments()
+    phoff = struct.calcsize(elf_header_schem)
+    phnum = len(regions)
+    header = save_header.copy()
+    header['e_phoff'] = phoff
+    header['e_phnum'] = phnum
+    header['e_entry'] = state.entry()
+
+    name_strtab = '.shstrtab'
+    name_symtab = '.symtab'
+    s_data = b'\x00'
+    s_data, s_name_strtab = nt_string_append(s_data, name_strtab)
+    s_data, s_name_symtab = nt_string_append(s_data, name_symtab)
+
+    segments = []
+    sections = []
+    symbols = []
+    # section 0 and symbol 0 are null
+    sections.append({})
+    symbols.append({})
+
+    offset = phoff + (phnum * struct.calcsize(elf_prog_schem))
+    idx = 0
+    for addr, data in regions:
+        name = '__segment_{:d}'.format(idx)
+        s_data, s_name = nt_string_append(s_data, name)
+
+        if verbosity >= 1:
+            print('saving {:5d} bytes at {:05x} [section: {:s}]...'.format(
+                len(data), addr, name))
+
+        segment = save_prog.copy()
+        segment['p_offset'] = offset
+        segment['p_vaddr']  = addr
+        segment['p_paddr']  = addr
+        segment['p_filesz'] = len(data)
+        segment['p_memsz']  = len(data)
+        segment['data']     = bytes(data)
+        segments.append(segment)
+
+        section = save_section.copy()
+        section['name']      = name
+        section['sh_name']   = s_name
+        section['sh_addr']   = addr
+        section['sh_offset'] = offset
+        section['sh_size']   = len(data)
+        section['data']      = bytes(data)
+        sections.append(section)
+
+        symbol = save_symbol.copy()
+        symbol['name']     = name
+        symbol['st_name']  = s_name
+        symbol['st_value'] = addr
+        symbols.append(symbol)
+
+        offset += len(data)
+        idx += 1
+
+    # registers section (for internal use mostly)
+    registers = state.registers()
+    regdata = b''
+    for r in registers:
+        regdata += struct.pack('<I', r)
+    name_registers = '__registers'
+    s_data, s_name_registers = nt_string_append(s_data, name_registers)
+    regtab = save_section.copy()
+    regtab['name']         = name_registers
+    regtab['sh_name']      = s_name_registers
+    regtab['sh_type']      = elf_section_registers
+    regtab['sh_flags']     = 0x0
+    regtab['sh_addr']      = 0
+    regtab['sh_offset']    = offset
+    regtab['sh_size']      = len(regdata)
+    regtab['sh_addralign'] = 4
+    regtab['sh_entsize']   = 4
+    regtab['data']         = regdata
+    sections.append(regtab)
     
-#     offset += len(regdata)
-
-#     # shstrtab section
-#     strtab = save_section.copy()
-#     strtab['name']         = name_strtab
-#     strtab['sh_name']      = s_name_strtab
-#     strtab['sh_type']      = 3 # SHT_STRTAB
-#     strtab['sh_flags']     = 0x20 # SHF_STRINGS
-#     strtab['sh_addr']      = 0
-#     strtab['sh_offset']    = offset
-#     strtab['sh_size']      = len(s_data)
-#     strtab['sh_addralign'] = 1
-#     strtab['data']         = s_data
-#     sections.append(strtab)
-#     strtab_idx = len(sections) - 1
-
-#     offset += len(s_data)
-
-#     # symtab section
-#     symdata = symbols_pack(symbols)
-#     symtab = save_section.copy()
-#     symtab['name']         = name_symtab
-#     symtab['sh_name']      = s_name_symtab
-#     symtab['sh_type']      = 2 # SHT_SYMTAB
-#     symtab['sh_flags']     = 0x0
-#     symtab['sh_addr']      = 0
-#     symtab['sh_offset']    = offset
-#     symtab['sh_size']      = len(symdata)
-#     symtab['sh_link']      = strtab_idx
-#     symtab['sh_info']      = len(symbols)
-#     symtab['sh_addralign'] = 4
-#     symtab['sh_entsize']   = struct.calcsize(elf_symbol_schem)
-#     symtab['data']         = symdata
-#     sections.append(symtab)
-
-#     offset += len(symdata)    
-
-#     shoff = offset
-#     shnum = len(sections)
-#     header['e_shoff'] = shoff
-#     header['e_shnum'] = shnum
-#     header['e_shstrndx'] = strtab_idx
+    offset += len(regdata)
+
+    # shstrtab section
+    strtab = save_section.copy()
+    strtab['name']         = name_strtab
+    strtab['sh_name']      = s_name_strtab
+    strtab['sh_type']      = 3 # SHT_STRTAB
+    strtab['sh_flags']     = 0x20 # SHF_STRINGS
+    strtab['sh_addr']      = 0
+    strtab['sh_offset']    = offset
+    strtab['sh_size']      = len(s_data)
+    strtab['sh_addralign'] = 1
+    strtab['data']         = s_data
+    sections.append(strtab)
+    strtab_idx = len(sections) - 1
+
+    offset += len(s_data)
+
+    # symtab section
+    symdata = symbols_pack(symbols)
+    symtab = save_section.copy()
+    symtab['name']         = name_symtab
+    symtab['sh_name']      = s_name_symtab
+    symtab['sh_type']      = 2 # SHT_SYMTAB
+    symtab['sh_flags']     = 0x0
+    symtab['sh_addr']      = 0
+    symtab['sh_offset']    = offset
+    symtab['sh_size']      = len(symdata)
+    symtab['sh_link']      = strtab_idx
+    symtab['sh_info']      = len(symbols)
+    symtab['sh_addralign'] = 4
+    symtab['sh_entsize']   = struct.calcsize(elf_symbol_schem)
+    symtab['data']         = symdata
+    sections.append(symtab)
+
+    offset += len(symdata)    
+
+    shoff = offset
+    shnum = len(sections)
+    header['e_shoff'] = shoff
+    header['e_shnum'] = shnum
+    header['e_shstrndx'] = strtab_idx
     
-#     with open(fname, 'wb') as f:
-#         blast_header(f, header)
-#         blast_segments(f, segments, phoff, write_data=False)
-#         blast_sections(f, sections, shoff, write_data=True)
+    with open(fname, 'wb') as f:
+        blast_header(f, header)
+        blast_segments(f, segments, phoff, write_data=False)
+        blast_sections(f, sections, shoff, write_data=True)
 
 if __name__ == '__main__':
     import sys
@@ -0,0 +1,316 @@
+#!/usr/bin/env python
+
+# A stand-in for mspdebug, for benchmarks and for trying things out without any
+# boards attached. It imitates the console output that utils.py parses, on a
+# make-believe device with 64K of zeroed memory; it ignores its arguments.
+# Flash is everything from main_start up, erased in segments of segment_size.
+#
+# Given a "gdb PORT" command, it serves gdb's remote serial protocol on that
+# port instead (see GdbServer), like mspdebug's gdb command.
+
+import elftools
+
+import sys
+import io
+import signal
+import select
+import socket
+import time
+
+reg_names = ['PC', 'SP', 'SR'] + ['R{:d}'.format(i) for i in range(3, 16)]
+main_start = 0x4400
+segment_size = 512
+
+class FakeDevice(object):
+    def __init__(self):
+        self.mem = bytearray(0x10000)
+        self.regs = [0] * 16
+        self.breakpoints = {}
+        self.interrupted = False
+        self.running = False
+        self.stream = sys.stdout
+        self.reset()
+
+    def reset(self):
+        self.regs = [0] * 16
+        self.regs[0] = 0x4400
+        self.regs[1] = 0x2400
+
+    def out(self, s):
+        self.stream.write(s)
+
+    def dump_regs(self):
+        for row in range(4):
+            self.out('    ' + '  '.join('({:>3s}: {:05x})'.format(reg_names[row + 4*col], self.regs[row + 4*col])
+                                        for col in range(4)) + '\n')
+        pc = self.regs[0]
+        self.out('{:#06x}:\n    {:04x}: 31 40 00 24      MOV     #0x2400, SP\n'.format(pc, pc))
+
+    def dump_mem(self, addr, size):
+        for row in range(addr, addr + size, 16):
+            data = self.mem[row:min(row + 16, addr + size)]
+            hexes = ' '.join('{:02x}'.format(x) for x in data)
+            chars = ''.join(chr(x) if 32 <= x < 127 else '.' for x in data)
+            self.out('    {:05x}: {:48s}|{:16s}|\n'.format(row, hexes + ' ', chars))
+
+    def cmd_regs(self, args):
+        self.dump_regs()
+
+    def cmd_step(self, args):
+        n = int(args[0], 0) if args else 1
+        self.regs[0] = (self.regs[0] + 2 * n) & 0xffff
+        self.dump_regs()
+
+    def cmd_reset(self, args):
+        self.reset()
+
+    def erase(self, addr, size):
+        self.mem[addr:addr+size] = b'\xff' * size
+
+    # Loads the file if it's an elf we can read; otherwise just pretends to.
+    def cmd_prog(self, args):
+        try:
+            blocks, _ = elftools.load(args[0])
+        except Exception:
+            blocks = None
+        self.out('Erasing...\nProgramming...\n')
+        if blocks is None:
+            self.out('Writing  128 bytes at 4400...\nDone, 128 bytes total\n')
+        else:
+            self.erase(main_start, len(self.mem) - main_start)
+            for addr in sorted(blocks):
+                self.mem[addr:addr+len(blocks[addr])] = bytes(blocks[addr])
+                self.out('Writing {:4d} bytes at {:04x}...\n'.format(len(blocks[addr]), addr))
+            self.out('Done, {:d} bytes total\n'.format(sum(len(data) for data in blocks.values())))
+        self.reset()
+
+    def cmd_erase(self, args):
+        if not args or args[0] == 'all':
+            self.erase(main_start, len(self.mem) - main_start)
+        elif args[0] == 'segment':
+            addr = int(args[1], 0) & ~(segment_size - 1)
+            self.erase(addr, segment_size)
+        elif args[0] == 'segrange':
+            addr, size, segsize = (int(x, 0) for x in args[1:4])
+            self.erase(addr & ~(segsize - 1), size)
+        self.out('Erasing...\n')
+
+    def cmd_md(self, args):
+        addr = int(args[0], 0)
+        size = int(args[1], 0) if len(args) > 1 else 64
+        self.dump_mem(addr, size)
+
+    def cmd_mw(self, args):
+        addr = int(args[0], 0)
+        for i, x in enumerate(args[1:]):
+            self.mem[addr + i] = int(x, 0) & 0xff
+
+    def cmd_fill(self, args):
+        addr = int(args[0], 0)
+        size = int(args[1], 0)
+        pattern = [int(x, 0) & 0xff for x in args[2:]]
+        for i in range(size):
+            self.mem[addr + i] = pattern[i % len(pattern)]
+
+    def cmd_set(self, args):
+        self.regs[int(args[0], 0)] = int(args[1], 0) & 0xfffff
+
+    def cmd_setbreak(self, args):
+        index = int(args[1], 0) if len(args) > 1 else len(self.breakpoints)
+        self.breakpoints[index] = int(args[0], 0)
+        self.out('Set breakpoint {:d}\n'.format(index))
+
+    def cmd_delbreak(self, args):
+        if args:
+            self.breakpoints.pop(int(args[0], 0), None)
+        else:
+            self.breakpoints = {}
+
+    # Each millisecond of running executes an instruction, which moves on to the
+    # next word, unless it's in a low power mode or at a jmp $. Runs until
+    # stopped() or a breakpoint.
+    def go(self, stopped):
+        while not stopped():
+            time.sleep(0.001)
+            pc = self.regs[0]
+            if self.regs[2] & 0x10 or self.mem[pc:pc+2] == b'\xff\x3f':
+                continue
+            self.regs[0] = (pc + 2) & 0xffff
+            if self.regs[0] in self.breakpoints.values():
+                return
+
+    def cmd_run(self, args):
+        self.out('Running. Press Ctrl+C to interrupt...\n')
+        self.stream.flush()
+        self.interrupted = False
+        self.running = True
+        self.go(lambda: self.interrupted)
+        self.running = False
+        self.out('\n')
+        self.dump_regs()
+
+    # Ctrl+C at the prompt just gets a fresh prompt.
+    def interrupt(self, signum, frame):
+        self.interrupted = True
+        if not self.running:
+            self.out('\n(mspdebug) ')
+            self.stream.flush()
+
+    def execute(self, line):
+        args = line.split()
+        if not args:
+            return
+        try:
+            handler = getattr(self, 'cmd_' + args[0])
+        except AttributeError:
+            self.out('unknown command: {}\n'.format(args[0]))
+        else:
+            handler(args[1:])
+
+# Just enough of the gdb remote serial protocol for gdbdriver.GdbMspdebug.
+# Registers are sent as 4 bytes each, like 20-bit MSP430X registers.
+class GdbServer(object):
+    def __init__(self, dev, sock):
+        self.dev = dev
+        self.sock = sock
+        self.buf = b''
+        self.done = False
+
+    def recv(self):
+        data = self.sock.recv(65536)
+        if not data:
+            raise EOFError
+        self.buf += data
+
+    def read_packet(self):
+        while True:
+            start = self.buf.find(b'$')
+            end = self.buf.find(b'#', start)
+            if start >= 0 and end >= 0 and len(self.buf) >= end + 3:
+                payload = self.buf[start+1:end]
+                self.buf = self.buf[end+3:]
+                self.sock.sendall(b'+')
+                return payload
+            self.recv()
+
+    def send_packet(self, payload):
+        self.sock.sendall(b'$' + payload + b'#' + '{:02x}'.format(sum(payload) & 0xff).encode('ascii'))
+        while True:
+            while not self.buf:
+                self.recv()
+            ack, self.buf = self.buf[:1], self.buf[1:]
+            if ack == b'+':
+                return
+
+    def interrupted(self):
+        readable, _, _ = select.select([self.sock], [], [], 0)
+        if readable:
+            self.recv()
+        if b'\x03' in self.buf:
+            self.buf = self.buf.replace(b'\x03', b'', 1)
+            return True
+        return False
+
+    def serve(self):
+        while not self.done:
+            payload = self.read_packet()
+            self.send_packet(self.handle(payload))
+
+    def handle(self, payload):
+        dev = self.dev
+        op = payload[:1]
+        if payload == b'qSupported':
+            return b'PacketSize=1000'
+        elif payload.startswith(b'qRcmd,'):
+            dev.stream = io.StringIO()
+            dev.execute(bytes.fromhex(payload[6:].decode('ascii')).decode('ascii'))
+            output = dev.stream.getvalue()
+            dev.stream = sys.stdout
+            if output:
+                self.send_packet(b'O' + output.encode('ascii').hex().encode('ascii'))
+            return b'OK'
+        elif op == b'g':
+            return b''.join(r.to_bytes(4, 'little').hex().encode('ascii') for r in dev.regs)
+        elif op == b'G':
+            raw = bytes.fromhex(payload[1:].decode('ascii'))
+            dev.regs = [int.from_bytes(raw[i:i+4], 'little') & 0xfffff for i in range(0, 64, 4)]
+            return b'OK'
+        elif op == b'm':
+            addr, size = (int(x, 16) for x in payload[1:].split(b','))
+            return dev.mem[addr:addr+size].hex().encode('ascii')
+        elif op in (b'M', b'X'):
+            header, data = payload[1:].split(b':', 1)
+            addr, size = (int(x, 16) for x in header.split(b','))
+            if op == b'M':
+                data = bytes.fromhex(data.decode('ascii'))
+            else:
+                data = bytearray(data)
+                i = 0
+                while i < len(data):
+                    if data[i] == 0x7d:
+                        data[i:i+2] = bytes([data[i+1] ^ 0x20])
+                    i += 1
+            dev.mem[addr:addr+size] = data
+            return b'OK'
+        elif op in (b'Z', b'z'):
+            kind, addr, _ = payload[1:].split(b',')
+            if op == b'Z':
+                dev.breakpoints[int(addr, 16)] = int(addr, 16)
+            else:
+                dev.breakpoints.pop(int(addr, 16), None)
+            return b'OK'
+        elif op == b's':
+            dev.regs[0] = (dev.regs[0] + 2) & 0xffff
+            return b'T05'
+        elif op == b'c':
+            dev.go(self.interrupted)
+            return b'T05'
+        elif op == b'?':
+            return b'T05'
+        elif op == b'D':
+            self.done = True
+            return b'OK'
+        else:
+            return b''
+
+def gdb_main(dev, port):
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    try:
+        listener.bind(('127.0.0.1', port))
+    except OSError as e:
+        sys.stdout.write('gdb: failed to bind: {}\n'.format(e.strerror))
+        sys.stdout.flush()
+        sys.exit(1)
+    listener.listen(1)
+    sys.stdout.write('Bound to port {:d}. Now waiting for connection...\n'.format(port))
+    sys.stdout.flush()
+    sock, addr = listener.accept()
+    listener.close()
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sys.stdout.write('Client connected from {}:{:d}\n'.format(*addr))
+    sys.stdout.flush()
+    try:
+        GdbServer(dev, sock).serve()
+    except (EOFError, OSError):
+        pass
+    sock.close()
+
+def main():
+    dev = FakeDevice()
+    gdb_args = [arg.split() for arg in sys.argv[1:] if arg.startswith('gdb')]
+    if gdb_args:
+        gdb_main(dev, int(gdb_args[0][1]) if len(gdb_args[0]) > 1 else 2000)
+        return
+    signal.signal(signal.SIGINT, dev.interrupt)
+    sys.stdout.write('MSPDebug version 0.25 (fake)\n\nChip ID data:\n  fake\n\n')
+    while True:
+        sys.stdout.write('(mspdebug) ')
+        sys.stdout.flush()
+        line = sys.stdin.readline()
+        if not line or line.split()[:1] == ['exit']:
+            break
+        dev.execute(line)
+
+if __name__ == '__main__':
+    main()
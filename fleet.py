@@ -0,0 +1,162 @@
+# fleet programming
+#
+# Flash one image onto every free board at once. All the free ttys are reserved
+# through manager up front, and then each one gets its own driver.Mspdebug
+# session; at most concurrency of them run at a time.
+#
+# Ports that fail with an error in settings.errors_to_mark are marked, either by
+# the driver while connecting or here if mspdebug dies while programming. Other
+# failures just release the tty.
+
+import settings
+import manager
+import driver
+import commands
+import elftools
+import progdelta
+
+import concurrent.futures
+import time
+
+
+# Reserve every tty that's free right now.
+def reserve_all():
+    ttys = []
+    while True:
+        tty = manager.get_tty(timeout=0)
+        if tty is None:
+            return sorted(ttys)
+        ttys.append(tty)
+
+# Did what's on the board come out the way the image says? blocks should only
+# cover flash (see progdelta.flash_blocks): RAM isn't set up by prog.
+def verify(mspdebug, blocks):
+    addrs = sorted(blocks)
+    outputs = mspdebug.run_commands([commands.md(addr, len(blocks[addr])) for addr in addrs])
+    return all(commands.md_matches(output, addr, blocks[addr]) for addr, output in zip(addrs, outputs))
+
+def describe(e):
+    return '{}: {}'.format(type(e).__name__, str(e).splitlines()[0] if str(e) else '')
+
+# Program the board on tty, which we've reserved. Returns a dict describing how
+# it went; times are in seconds. Errors end up in the dict rather than being
+# raised, so one board can't take the others' results down with it.
+def prog_one(tty, fname, blocks = None, reset = False, delta = False):
+    result = {
+        'tty' : tty,
+        'ok' : False,
+        'pc' : None,
+        'error' : None,
+        'error_code' : None,
+        'marked' : [],
+        'connect_time' : None,
+        'prog_time' : None,
+        'verify_time' : None,
+        'total_time' : None,
+    }
+    start = time.perf_counter()
+    try:
+        prog_board(tty, fname, blocks, reset, delta, result)
+    except Exception as e:
+        result['ok'] = False
+        result['error'] = describe(e)
+    result['total_time'] = time.perf_counter() - start
+    return result
+
+def prog_board(tty, fname, blocks, reset, delta, result):
+    start = time.perf_counter()
+    mspdebug = driver.Mspdebug()
+    try:
+        connected = mspdebug.connect(tty)
+    except Exception:
+        # connect didn't get as far as claiming it, or mspdebug is gone
+        manager.release_tty(tty)
+        raise
+    result['connect_time'] = time.perf_counter() - start
+    if not connected:
+        error_code = mspdebug.failed_ttys[-1][1]
+        result['error'] = 'mspdebug did not start'
+        result['error_code'] = error_code
+        if error_code in settings.errors_to_mark:
+            result['marked'].append(tty)
+        else:
+            manager.release_tty(tty)
+        return
+
+    try:
+        t = time.perf_counter()
+        if delta:
+            pc = mspdebug.prog_delta(fname)
+        else:
+            pc = mspdebug.prog(fname)
+        result['prog_time'] = time.perf_counter() - t
+        if not isinstance(pc, int):
+            result['error'] = pc
+        else:
+            if blocks is not None:
+                t = time.perf_counter()
+                verified = verify(mspdebug, blocks)
+                result['verify_time'] = time.perf_counter() - t
+                if not verified:
+                    result['error'] = 'verify failed'
+            if result['error'] is None:
+                if reset:
+                    pc = mspdebug.reset()
+                result['pc'] = pc
+                result['ok'] = True
+    except Exception as e:
+        result['error'] = describe(e)
+    finally:
+        try:
+            mspdebug.close()
+        except Exception:
+            pass
+
+    if not result['ok']:
+        error_code = mspdebug.get_error_from_log()
+        result['error_code'] = error_code
+        # after close, so releasing the tty doesn't undo the mark
+        if error_code in settings.errors_to_mark:
+            manager.mark_tty(tty)
+            result['marked'].append(tty)
+
+# Program every free board with fname, concurrency at a time
+# (settings.fleet_concurrency if None). With verify, read the image back from each board afterwards; with
+# reset, reset them when done; with delta, use Mspdebug.prog_delta. Returns
+# one result per board (see prog_one), sorted by tty.
+def prog_all(fname, concurrency = None, verify = False, reset = False, delta = False):
+    blocks = None
+    if verify:
+        blocks, _ = elftools.load(fname)
+        blocks = progdelta.flash_blocks(blocks)
+    ttys = reserve_all()
+    if not ttys:
+        return []
+    if concurrency is None:
+        concurrency = settings.fleet_concurrency
+    if concurrency is None:
+        concurrency = len(ttys)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [executor.submit(prog_one, tty, fname, blocks=blocks, reset=reset, delta=delta)
+                   for tty in ttys]
+        return [future.result() for future in futures]
+
+def report(results):
+    def fmt(t):
+        return '{:7.2f}s'.format(t) if t is not None else '       -'
+    for result in results:
+        if result['ok']:
+            status = 'ok, pc {:#06x}'.format(result['pc'])
+        else:
+            status = 'FAILED: {}'.format(result['error'])
+            if result['error_code'] is not None:
+                status += ' (error = {:d})'.format(result['error_code'])
+        print('{:9s} : connect {} prog {} verify {} total {}   {}'.format(
+            result['tty'], fmt(result['connect_time']), fmt(result['prog_time']), fmt(result['verify_time']),
+            fmt(result['total_time']), status))
+    marked = sorted(set(tty for result in results for tty in result['marked']))
+    ok = sum(1 for result in results if result['ok'])
+    print('{:d} of {:d} boards programmed'.format(ok, len(results)))
+    if marked:
+        print('marked: {}'.format(', '.join(marked)))
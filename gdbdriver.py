@@ -0,0 +1,387 @@
+# gdb remote serial protocol driver
+#
+# GdbMspdebug has the same python-level api as driver.Mspdebug, but instead of
+# scraping mspdebug's console it runs "mspdebug <driver> -d <tty> 'gdb <port>'"
+# and talks to it over a local socket in gdb's remote serial protocol (RSP).
+# Memory goes back and forth as hex (m) or raw binary (X), registers come in a
+# single packet (g), and stopping is reported with a stop reply rather than by
+# noticing the prompt came back.
+#
+# Commands that have no RSP equivalent (reset, prog, and the raw text api) are
+# sent as monitor commands (qRcmd), which mspdebug runs through its own command
+# processor and answers with console output.
+#
+# The console is still on a pty: it's where mspdebug says it's ready (or why it
+# couldn't start), and its output goes to the session log as usual.
+
+import settings
+import manager
+import transport
+import driver
+import commands
+import utils
+
+import pexpect
+import os
+import select
+import signal
+import socket
+import threading
+
+
+class GdbError(Exception):
+    pass
+
+def rsp_checksum(payload):
+    return '{:02x}'.format(sum(payload) & 0xff).encode('ascii')
+
+# Binary data in packets escapes the characters that mean something to RSP.
+rsp_special = b'#$}*'
+
+def rsp_escape(data):
+    if not any(c in data for c in rsp_special):
+        return bytes(data)
+    out = bytearray()
+    for b in data:
+        if b in rsp_special:
+            out += bytes([0x7d, b ^ 0x20])
+        else:
+            out.append(b)
+    return bytes(out)
+
+# Undo escaping and run-length encoding in a received packet.
+def rsp_decode(payload):
+    if b'}' not in payload and b'*' not in payload:
+        return bytes(payload)
+    out = bytearray()
+    i = 0
+    while i < len(payload):
+        b = payload[i]
+        if b == 0x7d:
+            out.append(payload[i+1] ^ 0x20)
+            i += 2
+        elif b == 0x2a:
+            out += bytes([out[-1]]) * (payload[i+1] - 29)
+            i += 2
+        else:
+            out.append(b)
+            i += 1
+    return bytes(out)
+
+
+class RspConnection(object):
+    def __init__(self, sock):
+        self.sock = sock
+        self.buf = bytearray()
+
+    def recv(self, timeout):
+        self.sock.settimeout(timeout)
+        try:
+            data = self.sock.recv(65536)
+        except socket.timeout:
+            raise pexpect.TIMEOUT('timed out waiting for gdb server')
+        except OSError:
+            data = b''
+        if not data:
+            raise pexpect.EOF('gdb server went away')
+        self.buf += data
+
+    def read_byte(self, timeout):
+        while not self.buf:
+            self.recv(timeout)
+        b = self.buf[0]
+        del self.buf[0]
+        return b
+
+    def send_packet(self, payload, timeout = transport.default_timeout):
+        frame = b'$' + payload + b'#' + rsp_checksum(payload)
+        while True:
+            self.sock.sendall(frame)
+            ack = self.read_byte(timeout)
+            if ack == ord('+'):
+                return
+            elif ack != ord('-'):
+                raise GdbError('expecting ack from gdb server, got {}'.format(repr(chr(ack))))
+
+    def read_packet(self, timeout = transport.default_timeout):
+        while True:
+            start = self.buf.find(b'$')
+            end = self.buf.find(b'#', start + 1) if start >= 0 else -1
+            if end >= 0 and len(self.buf) >= end + 3:
+                payload = bytes(self.buf[start+1:end])
+                checksum = bytes(self.buf[end+1:end+3])
+                del self.buf[:end+3]
+                if checksum.lower() == rsp_checksum(payload):
+                    self.sock.sendall(b'+')
+                    return rsp_decode(payload)
+                self.sock.sendall(b'-')
+                continue
+            self.recv(timeout)
+
+    def command(self, payload, timeout = transport.default_timeout):
+        self.send_packet(payload, timeout=timeout)
+        return self.read_packet(timeout=timeout)
+
+    def interrupt(self):
+        self.sock.sendall(b'\x03')
+
+    def close(self):
+        self.sock.close()
+
+
+# Copy the console to the session log until mspdebug exits, so it never blocks
+# on a full pty.
+def drain_console(fd, log):
+    while True:
+        try:
+            select.select([fd], [], [])
+            data = os.read(fd, 65536)
+        except BlockingIOError:
+            continue
+        except (OSError, ValueError):
+            return
+        if not data:
+            return
+        log.write(data.decode('ascii', errors='replace'))
+
+# A port nothing is listening on right now. Something else can still take it
+# before mspdebug binds it; GdbMspdebug.connect tries again if it does.
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind((settings.gdb_host, 0))
+        return s.getsockname()[1]
+
+
+# Logs and command checking come from driver.MspdebugBase; there's no memory
+# or register cache.
+class GdbMspdebug(driver.MspdebugBase):
+    def __init__(self, timeout = 0, priority = 0, log_level = None):
+        driver.MspdebugBase.__init__(self, timeout=timeout, priority=priority, log_level=log_level)
+        self.console = None
+        self.drain = None
+        self.packet_size = settings.gdb_packet_size
+        self.binary_writes = True
+        self.reg_size = None
+
+    def start_repl(self):
+        while self.conn is None:
+            tty = manager.get_tty(timeout=self.timeout, priority=self.priority)
+            if tty is None:
+                raise driver.NoTTYError
+            self.connect(tty)
+
+    # Start mspdebug's gdb server on a tty we've already reserved and connect
+    # to it. As in driver.Mspdebug.connect, returns False if it won't start.
+    # If connecting or negotiating fails after mspdebug has started, it's
+    # stopped and the tty released before the exception goes on up.
+    def connect(self, tty):
+        self.tty = tty
+        self.open_log()
+
+        attempt = 1
+        while True:
+            port = free_port()
+            mspargs = self.mspargs() + ['gdb {:d}'.format(port)]
+            try:
+                self.console = transport.PtyTransport(mspargs, settings.gdb_ready, logfile=self.log)
+                break
+            except pexpect.EOF:
+                if attempt < settings.gdb_bind_attempts and self.bind_failed():
+                    attempt += 1
+                    continue
+                if self.note_failure() in settings.errors_to_mark:
+                    manager.mark_tty(self.tty)
+                return False
+
+        manager.claim_tty(self.tty, self.console.pid)
+        self.drain = threading.Thread(target=drain_console, args=(self.console.fd, self.log), daemon=True)
+        self.drain.start()
+        try:
+            self.conn = RspConnection(socket.create_connection((settings.gdb_host, port)))
+            self.conn.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.negotiate()
+        except Exception:
+            self.abandon()
+            raise
+        return True
+
+    # Someone else took the port between free_port and mspdebug binding it.
+    def bind_failed(self):
+        return settings.gdb_bind_failed in self.log.tail(settings.log_error_window)
+
+    # Undo a connect that got as far as starting mspdebug. The error goes in
+    # the log once the drain thread is done, so it has mspdebug's last words.
+    def abandon(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+        # hanging up the console is left to close, once the drain thread is done with it
+        try:
+            os.kill(self.console.pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+        self.drain.join(settings.gdb_exit_timeout)
+        self.console.close()
+        manager.release_tty(self.tty)
+        self.log.error()
+        self.close_log()
+
+    def negotiate(self):
+        reply = self.conn.command(b'qSupported')
+        for feature in reply.split(b';'):
+            if feature.startswith(b'PacketSize='):
+                self.packet_size = int(feature[len(b'PacketSize='):], 16)
+
+    # Detaching ends the gdb command, and with it mspdebug.
+    def exit_repl(self):
+        try:
+            self.conn.command(b'D', timeout=settings.gdb_exit_timeout)
+        except (pexpect.EOF, pexpect.TIMEOUT, GdbError):
+            pass
+        self.conn.close()
+        self.drain.join(settings.gdb_exit_timeout)
+        if self.drain.is_alive():
+            print('failed to release tty {}'.format(repr(self.tty)))
+        else:
+            manager.release_tty(self.tty)
+        self.console.close()
+
+    def close(self):
+        self.exit_repl()
+        self.close_log()
+
+    def __enter__(self):
+        self.start_repl()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is not None:
+            self.log.error()
+        self.close()
+
+    # packets
+
+    def check_reply(self, reply):
+        if reply.startswith(b'E') and len(reply) == 3:
+            raise GdbError('gdb server returned error {}'.format(reply[1:].decode('ascii')))
+        return reply
+
+    # Run a console command with qRcmd, returning what it printed.
+    def monitor(self, cmd):
+        self.conn.send_packet(b'qRcmd,' + cmd.encode('ascii').hex().encode('ascii'))
+        output = []
+        while True:
+            reply = self.conn.read_packet()
+            if reply.startswith(b'O') and reply != b'OK':
+                output.append(bytes.fromhex(reply[1:].decode('ascii')).decode('ascii', errors='replace'))
+            else:
+                self.check_reply(reply)
+                return ''.join(output)
+
+    # Wait for a stop reply (after c or s), interrupting after timeout seconds.
+    def wait_stop(self, timeout = None):
+        try:
+            reply = self.conn.read_packet(timeout=timeout)
+        except pexpect.TIMEOUT:
+            self.conn.interrupt()
+            reply = self.conn.read_packet()
+        if reply[:1] in (b'W', b'X'):
+            raise pexpect.EOF('target exited: {}'.format(reply.decode('ascii', errors='replace')))
+        return self.check_reply(reply)
+
+    # the most memory one m or X packet can carry
+    def mem_chunk(self, encoded_per_byte):
+        return max(1, (self.packet_size - 32) // encoded_per_byte)
+
+    # raw text api
+
+    def run_command(self, cmd):
+        cleaned, error = self.check_command(cmd)
+        if cleaned is None:
+            return error
+        else:
+            return self.monitor(cleaned)
+
+    # standard python-level api
+
+    def reset(self):
+        self.monitor('reset')
+        return self.regs()[0]
+
+    def prog(self, fname):
+        raw_output = self.monitor(commands.prog(fname))
+        imgsize = utils.parse_prog(raw_output)
+        if imgsize is None:
+            return raw_output.strip()
+        else:
+            return self.regs()[0]
+
+    def mw(self, addr, pattern):
+        data = bytes(pattern)
+        # escaping can double the size of X data, so plan for hex either way
+        chunk = self.mem_chunk(2)
+        for i in range(0, len(data), chunk):
+            self.write_chunk(addr + i, data[i:i+chunk])
+
+    # Binary X if the server does it, otherwise hex M.
+    def write_chunk(self, addr, data):
+        if self.binary_writes:
+            header = 'X{:x},{:x}:'.format(addr, len(data)).encode('ascii')
+            reply = self.conn.command(header + rsp_escape(data))
+            if reply != b'':
+                self.check_reply(reply)
+                return
+            self.binary_writes = False
+        header = 'M{:x},{:x}:'.format(addr, len(data)).encode('ascii')
+        self.check_reply(self.conn.command(header + data.hex().encode('ascii')))
+
+    def fill(self, addr, size, pattern):
+        reps = -(-size // len(pattern))
+        self.mw(addr, (bytes(pattern) * reps)[:size])
+
+    def setreg(self, register, value):
+        regs = self.regs()
+        regs[register] = value
+        size = self.reg_size
+        self.check_reply(self.conn.command(b'G' + b''.join(
+            (r & ((1 << (8 * size)) - 1)).to_bytes(size, 'little').hex().encode('ascii') for r in regs)))
+
+    def md(self, addr, size):
+        data = bytearray(size)
+        chunk = self.mem_chunk(2)
+        for i in range(0, size, chunk):
+            n = min(chunk, size - i)
+            reply = self.check_reply(self.conn.command('m{:x},{:x}'.format(addr + i, n).encode('ascii')))
+            data[i:i+n] = bytes.fromhex(reply.decode('ascii'))
+        return memoryview(data)
+
+    # g gives all the registers at once, each little-endian; how wide they
+    # are depends on the server (2 bytes, or 4 for 20-bit MSP430X registers).
+    def regs(self):
+        reply = self.check_reply(self.conn.command(b'g'))
+        raw = bytes.fromhex(reply.decode('ascii'))
+        self.reg_size = len(raw) // driver.n_regs
+        return [int.from_bytes(raw[i:i+self.reg_size], 'little')
+                for i in range(0, self.reg_size * driver.n_regs, self.reg_size)]
+
+    def step(self):
+        self.conn.send_packet(b's')
+        self.wait_stop(timeout=transport.default_timeout)
+        return self.regs()[0]
+
+    def run(self, interval = 0.5):
+        self.conn.send_packet(b'c')
+        self.wait_stop(timeout=interval)
+        return self.regs()[0]
+
+    # Run until the pc gets to pc (with a breakpoint) or timeout seconds pass.
+    def run_until(self, pc = None, timeout = None):
+        if pc is not None:
+            self.check_reply(self.conn.command('Z0,{:x},2'.format(pc).encode('ascii')))
+        try:
+            self.conn.send_packet(b'c')
+            self.wait_stop(timeout=timeout)
+        finally:
+            if pc is not None:
+                self.check_reply(self.conn.command('z0,{:x},2'.format(pc).encode('ascii')))
+        return self.regs()[0]
@@ -0,0 +1,139 @@
+# tty hotplug tracking
+#
+# Watches settings.tty_dir with inotify and keeps a set of the ttys in it, so
+# boards that are plugged in or pulled out show up in the status store without
+# a manual refresh. The broker does this for itself; without a broker, run
+# watch() (main.py --watch) somewhere to keep the status file up to date.
+
+import settings
+import manager
+import progdelta
+
+import os
+import struct
+import select
+import ctypes
+import ctypes.util
+
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+watch_mask = IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO
+event_header = struct.Struct('iIII')
+
+libc = None
+
+def load_libc():
+    global libc
+    if libc is None:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    return libc
+
+def check_errno(result):
+    if result < 0:
+        e = ctypes.get_errno()
+        raise OSError(e, os.strerror(e))
+    return result
+
+def parse_events(data):
+    events = []
+    i = 0
+    while i + event_header.size <= len(data):
+        wd, mask, cookie, namelen = event_header.unpack_from(data, i)
+        i += event_header.size
+        name = data[i:i+namelen].rstrip(b'\x00').decode('ascii', errors='replace')
+        i += namelen
+        events.append((mask, name))
+    return events
+
+class Inventory(object):
+    def __init__(self):
+        self.ttys = set()
+        self.fd = None
+
+    def open(self):
+        libc = load_libc()
+        self.fd = check_errno(libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC))
+        try:
+            check_errno(libc.inotify_add_watch(self.fd, settings.tty_dir.encode(), watch_mask))
+        except OSError:
+            self.close()
+            raise
+        # list the directory after the watch is in place, so nothing slips by
+        self.ttys = set(manager.lstty())
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def fileno(self):
+        return self.fd
+
+    # Read whatever events are pending, and return the ttys that appeared and
+    # disappeared since last time.
+    def read(self):
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, 4096)
+            except BlockingIOError:
+                break
+            events += parse_events(data)
+
+        old_ttys = set(self.ttys)
+        for mask, name in events:
+            if mask & IN_Q_OVERFLOW:
+                # lost track, so look again
+                self.ttys = set(manager.lstty())
+            elif settings.tty_name not in name:
+                continue
+            elif mask & (IN_CREATE | IN_MOVED_TO):
+                self.ttys.add(name)
+            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                self.ttys.discard(name)
+        return sorted(self.ttys - old_ttys), sorted(old_ttys - self.ttys)
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+# Work out the commit (as for manager.apply_commit) that brings a status
+# snapshot in line with ttys appearing and disappearing. New ttys start out free.
+def changes(snapshot, added, removed):
+    updates = {tty : (None, None) for tty in added if tty not in snapshot}
+    removes = {tty : snapshot[tty][1] for tty in removed if tty in snapshot}
+    return updates, removes
+
+# Whatever comes back on a tty that was unplugged may be a different board, so
+# its incremental programming record (see progdelta) no longer applies.
+def unplugged(removed):
+    for tty in removed:
+        progdelta.forget(tty)
+
+def sync(added, removed):
+    unplugged(removed)
+    if added or removed:
+        updates, removes = changes(manager.status_snapshot(), added, removed)
+        manager.commit(updates, removes)
+
+# Keep the status store in line with the ttys in settings.tty_dir until interrupted.
+def watch():
+    with Inventory() as inventory:
+        snapshot = manager.status_snapshot()
+        sync([tty for tty in inventory.ttys if tty not in snapshot],
+             [tty for tty in snapshot if tty not in inventory.ttys])
+        try:
+            while True:
+                select.select([inventory], [], [])
+                sync(*inventory.read())
+        except KeyboardInterrupt:
+            pass
@@ -1,6 +1,13 @@
 import settings
+import driver
 
+import io
 import sys
+import struct
+import queue
+import threading
+
+byte_hex = ['{:#x}'.format(x) for x in range(256)]
 
 def prot_ack(f_out):
     f_out.write('\n')
@@ -33,7 +40,7 @@ def prot_execute(mspdebug, f_out, args):
     elif cmd == settings.prot_mw:
         try:
             addr = int(args[1], 16)
-            pattern = [int(x, 16) for x in args[2:]]
+            pattern = bytes(int(x, 16) for x in args[2:])
             assert len(pattern) > 0
         except Exception as e:
             f_out.write('error: {}: intput: {}'.format(settings.prot_mw, repr(e)))
@@ -44,7 +51,7 @@ def prot_execute(mspdebug, f_out, args):
         try:
             addr = int(args[1], 16)
             size = int(args[2])
-            pattern = [int(x, 16) for x in args[3:]]
+            pattern = bytes(int(x, 16) for x in args[3:])
             assert len(pattern) > 0
         except Exception as e:
             f_out.write('error: {}: intput: {}'.format(settings.prot_fill, repr(e)))
@@ -68,7 +75,7 @@ def prot_execute(mspdebug, f_out, args):
             f_out.write('error: {}: intput: {}'.format(settings.prot_md, repr(e)))
         else:
             data = mspdebug.md(addr, size)
-            f_out.write(' '.join('{:#x}'.format(x) for x in data))
+            f_out.write(' '.join(map(byte_hex.__getitem__, data)))
 
     elif cmd == settings.prot_regs:
         data = mspdebug.regs()
@@ -90,10 +97,242 @@ def prot_execute(mspdebug, f_out, args):
     else:
         f_out.write('error: unknown command {}'.format(cmd))
 
+# Binary protocol
+#
+# Sending the line settings.prot_binary instead of a command switches to binary
+# frames for the rest of the session. The line is echoed back as the last text
+# the client gets. The client can send its first frames right behind the line
+# without waiting for the echo.
+#
+# A request is a little-endian uint32 length and then that many bytes: an
+# opcode byte and its arguments, packed as below. A response is a status byte,
+# a uint32 length and the payload. On success the payload is the pc (uint32)
+# for reset/prog/step/run, the raw bytes for md, 16 uint32 registers for regs,
+# and nothing for the rest; on error it's the message, in utf-8.
+
+bin_request = struct.Struct('<I')
+bin_response = struct.Struct('<BI')
+bin_ok = 0
+bin_error = 1
+
+bin_opcodes = {
+    0 : settings.prot_reset,  # no arguments
+    1 : settings.prot_prog,   # file name, utf-8
+    2 : settings.prot_mw,     # uint32 address, data
+    3 : settings.prot_fill,   # uint32 address, uint32 size, pattern
+    4 : settings.prot_setreg, # uint32 register, uint32 value
+    5 : settings.prot_md,     # uint32 address, uint32 size
+    6 : settings.prot_regs,   # no arguments
+    7 : settings.prot_step,   # no arguments
+    8 : settings.prot_run,    # float64 interval in seconds
+}
+bin_u32 = struct.Struct('<I')
+bin_u32x2 = struct.Struct('<II')
+bin_f64 = struct.Struct('<d')
+bin_regs = struct.Struct('<16I')
+
+# Returns (status, payload).
+def prot_execute_binary(mspdebug, request):
+    if len(request) < 1:
+        return bin_error, b'no command'
+    opcode = request[0]
+    body = request[1:]
+    cmd = bin_opcodes.get(opcode)
+
+    try:
+        if cmd == settings.prot_reset:
+            return bin_ok, bin_u32.pack(mspdebug.reset())
+
+        elif cmd == settings.prot_prog:
+            data = mspdebug.prog(bytes(body).decode('utf-8'))
+            if isinstance(data, str):
+                return bin_error, data.encode('utf-8')
+            return bin_ok, bin_u32.pack(data)
+
+        elif cmd == settings.prot_mw:
+            addr, = bin_u32.unpack_from(body)
+            pattern = bytes(body[bin_u32.size:])
+            assert len(pattern) > 0
+            mspdebug.mw(addr, pattern)
+            return bin_ok, b''
+
+        elif cmd == settings.prot_fill:
+            addr, size = bin_u32x2.unpack_from(body)
+            pattern = bytes(body[bin_u32x2.size:])
+            assert len(pattern) > 0
+            mspdebug.fill(addr, size, pattern)
+            return bin_ok, b''
+
+        elif cmd == settings.prot_setreg:
+            rn, x = bin_u32x2.unpack(body)
+            mspdebug.setreg(rn, x)
+            return bin_ok, b''
+
+        elif cmd == settings.prot_md:
+            addr, size = bin_u32x2.unpack(body)
+            return bin_ok, mspdebug.md(addr, size)
+
+        elif cmd == settings.prot_regs:
+            return bin_ok, bin_regs.pack(*mspdebug.regs())
+
+        elif cmd == settings.prot_step:
+            return bin_ok, bin_u32.pack(mspdebug.step())
+
+        elif cmd == settings.prot_run:
+            interval, = bin_f64.unpack(body)
+            return bin_ok, bin_u32.pack(mspdebug.run(interval=interval))
+
+    except (struct.error, AssertionError, UnicodeDecodeError) as e:
+        return bin_error, '{}: input: {}'.format(cmd, repr(e)).encode('utf-8')
+
+    return bin_error, 'unknown opcode {:d}'.format(opcode).encode('utf-8')
+
+def protocol_binary(mspdebug, f_in, f_out):
+    while True:
+        header = f_in.read(bin_request.size)
+        if len(header) < bin_request.size:
+            return
+        length, = bin_request.unpack(header)
+        request = f_in.read(length)
+        if len(request) < length:
+            return
+        status, payload = prot_execute_binary(mspdebug, request)
+        f_out.write(bin_response.pack(status, len(payload)))
+        f_out.write(payload)
+        f_out.flush()
+
+# Pipelined protocol
+#
+# Sending the line settings.prot_multi switches to tagged requests, which can
+# go to several boards, and which don't have to wait for each other. The line
+# is echoed back to say the switch happened. Each request is
+#
+#   <id> <board> <command> <args...>
+#
+# where id is any word the client likes, and the reply is "<id> <result>",
+# with the same result as the text protocol. Replies come back as requests
+# finish, not in the order they were sent. Requests to the same board run in
+# order; each board has its own thread, so a prog or run on one board doesn't
+# hold up the others.
+#
+# The board the driver started with is settings.prot_first_board. To get
+# another one, send "<id> <name> open [seconds]" with a new name for it,
+# waiting up to seconds for a free tty (default no wait); the reply is its tty.
+# Since requests to a board run in order, the client can go on sending to the
+# new board without waiting for the reply. "<id> <board> close" gives it back.
+# Boards opened this way are closed at the end of the session.
+
+class Board(object):
+    def __init__(self, reply, mspdebug = None):
+        self.reply = reply
+        self.mspdebug = mspdebug
+        self.opened = False
+        self.requests = queue.SimpleQueue()
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+        self.thread.start()
+
+    def put(self, req_id, args):
+        self.requests.put((req_id, args))
+
+    # Stop once what's queued so far is done.
+    def stop(self):
+        self.requests.put(None)
+
+    def loop(self):
+        while True:
+            request = self.requests.get()
+            if request is None:
+                break
+            req_id, args = request
+            try:
+                self.reply(req_id, self.execute(args))
+            except Exception as e:
+                self.reply(req_id, 'error: {}: {}'.format(args[0], repr(e)))
+        if self.opened:
+            self.mspdebug.close()
+
+    def execute(self, args):
+        cmd = args[0]
+        if cmd == settings.prot_open:
+            if self.mspdebug is not None:
+                return 'error: {}: board already open on {}'.format(settings.prot_open, self.mspdebug.tty)
+            try:
+                timeout = float(args[1]) if len(args) > 1 else 0
+            except Exception as e:
+                return 'error: {}: input: {}'.format(settings.prot_open, repr(e))
+            mspdebug = driver.Mspdebug(timeout=timeout)
+            try:
+                mspdebug.start_repl()
+            except driver.NoTTYError:
+                return 'error: no available port for mspdebug'
+            self.mspdebug = mspdebug
+            self.opened = True
+            return mspdebug.tty
+        elif self.mspdebug is None:
+            return 'error: board not open'
+        elif cmd == settings.prot_close:
+            if self.opened:
+                self.mspdebug.close()
+            self.mspdebug = None
+            self.opened = False
+            return ''
+        else:
+            out = io.StringIO()
+            prot_execute(self.mspdebug, out, args)
+            return out.getvalue()
+
+def protocol_multi(mspdebug, f_in, f_out):
+    lock = threading.Lock()
+    def reply(req_id, result):
+        with lock:
+            f_out.write('{} {}'.format(req_id, result))
+            prot_ack(f_out)
+
+    boards = {settings.prot_first_board : Board(reply, mspdebug)}
+    closed = []
+    for line in f_in:
+        args = line.decode().split()
+        if len(args) < 1:
+            continue
+        elif len(args) < 3:
+            reply(args[0], 'error: expecting <id> <board> <command>')
+            continue
+        req_id, name, cmd = args[:3]
+        board = boards.get(name)
+        if cmd == settings.prot_open and board is None:
+            board = Board(reply)
+            boards[name] = board
+        elif board is None:
+            reply(req_id, 'error: no board {}'.format(name))
+            continue
+        board.put(req_id, args[2:])
+        if cmd == settings.prot_close:
+            del boards[name]
+            board.stop()
+            closed.append(board)
+
+    for board in boards.values():
+        board.stop()
+    for board in list(boards.values()) + closed:
+        board.thread.join()
+
 # start text protocol for communication with other tools
 def protocol(mspdebug, f_in = sys.stdin, f_out = sys.stdout):
+    # Lines are read from the bytes under f_in, so that nothing the client sent
+    # after switching to binary has been read ahead into f_in's text buffer.
+    f_in = f_in.buffer
     for line in f_in:
-        args = line.split()
+        args = line.decode().split()
+        if args == [settings.prot_binary]:
+            f_out.write(settings.prot_binary)
+            prot_ack(f_out)
+            protocol_binary(mspdebug, f_in, f_out.buffer)
+            return
+        elif args == [settings.prot_multi]:
+            f_out.write(settings.prot_multi)
+            prot_ack(f_out)
+            protocol_multi(mspdebug, f_in, f_out)
+            return
         prot_execute(mspdebug, f_out, args)
         prot_ack(f_out)
 
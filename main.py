@@ -1,9 +1,12 @@
 #!/usr/bin/env python
 
 import manager
+import broker
+import hotplug
 import driver
 import interface
 import elftools
+import fleet
 
 import argparse
 import sys
@@ -18,8 +21,26 @@ if __name__ == '__main__':
                         help='print current status')
     parser.add_argument('-g', '--get', default='', metavar='TTYS',
                         help='get status of a comma-separated list of ttys')
+    parser.add_argument('-k', '--reap', action='store_true',
+                        help='free ttys held by processes that have exited')
+    parser.add_argument('--leaks', action='store_true',
+                        help='print how many times each tty has been reaped')
     parser.add_argument('-i', '--interactive', action='store_true',
                         help='launch a human-usable repl')
+    parser.add_argument('-b', '--broker', action='store_true',
+                        help='run the tty broker in the foreground')
+    parser.add_argument('--watch', action='store_true',
+                        help='keep the status file up to date as ttys come and go')
+    parser.add_argument('-w', '--wait', type=float, default=0, metavar='SECONDS',
+                        help='wait up to SECONDS for a free tty (negative to wait forever)')
+    parser.add_argument('-p', '--prog-all', metavar='ELF',
+                        help='program every free board with ELF')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='program at most JOBS boards at once (with --prog-all)')
+    parser.add_argument('--verify', action='store_true',
+                        help='read the image back from each board (with --prog-all)')
+    parser.add_argument('--delta', action='store_true',
+                        help='only rewrite changed flash segments (with --prog-all)')
     parser.add_argument('-loadelf',
                         help='load an elf file (not for human consumption)')
 
@@ -43,9 +64,26 @@ if __name__ == '__main__':
             exit(1)
         exit(0)
     
+    if args.broker:
+        broker.run()
+        exit(0)
+
+    if args.watch:
+        hotplug.watch()
+        exit(0)
+
     if args.refresh:
         manager.refresh()
         go = False
+    if args.prog_all:
+        results = fleet.prog_all(args.prog_all, concurrency=args.jobs, verify=args.verify,
+                                 reset=True, delta=args.delta)
+        fleet.report(results)
+        go = False
+    if args.reap:
+        for tty in manager.reap():
+            print('reaped {:s}'.format(tty))
+        go = False
     if args.check:
         ttys = args.check.strip().split(',')
         manager.check(ttys)
@@ -57,10 +95,17 @@ if __name__ == '__main__':
     if args.list:
         manager.display()
         go = False
+    if args.leaks:
+        counts = manager.reap_stats()
+        for tty in sorted(counts):
+            print('{:9s} : {:d}'.format(tty, counts[tty]))
+        print('{:9s} : {:d}'.format('total', sum(counts.values())))
+        go = False
 
     if args.interactive or go:
         try:
-            with driver.Mspdebug() as mspdebug:
+            timeout = args.wait if args.wait >= 0 else None
+            with driver.Mspdebug(timeout=timeout) as mspdebug:
                 sys.stdout.write('{:s}\n'.format(mspdebug.tty))
                 sys.stdout.flush()
 
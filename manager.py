@@ -5,12 +5,23 @@ import subprocess
 import io
 import fcntl
 import json
+import mmap
+import struct
+import socket
+import select
+import time
+import threading
 
 def lstty():
-    ls = subprocess.check_output(['ls', settings.tty_dir]).decode()
-    return [line.strip() for line in ls.split('\n') if settings.tty_name in line]
+    return sorted(fname for fname in os.listdir(settings.tty_dir) if settings.tty_name in fname)
 
-def suser(tty):
+# process probing
+
+# The original probes fork one of fuser, ps or lsof per tty or pid. They are
+# kept around as a fallback (and as a baseline for bench.py), but everything
+# in this module goes through the /proc scanner below.
+
+def suser_fuser(tty):
     fuser = subprocess.Popen(['fuser', os.path.join(settings.tty_dir, tty)],
                              stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     stdout, stderr = fuser.communicate()
@@ -21,7 +32,7 @@ def suser(tty):
     else:
         return None
 
-def psname(pid):
+def psname_ps(pid):
     ps = subprocess.Popen(['ps', 'chp', str(pid)],
                           stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     stdout, stderr = ps.communicate()
@@ -33,7 +44,7 @@ def psname(pid):
     else:
         return None
 
-def hasopen(pid, tty):
+def hasopen_lsof(pid, tty):
     lsof = subprocess.Popen(['lsof', '-p', str(pid)],
                             stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     stdout, stderr = lsof.communicate()
@@ -44,6 +55,91 @@ def hasopen(pid, tty):
     else:
         return False
 
+def proc_comm(pid):
+    try:
+        with open(os.path.join(settings.proc_dir, str(pid), 'comm'), 'rt') as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+def proc_ttys(pid):
+    tty_prefix = os.path.join(settings.tty_dir, settings.tty_name)
+    fd_dir = os.path.join(settings.proc_dir, str(pid), 'fd')
+    ttys = set()
+    try:
+        fds = os.listdir(fd_dir)
+    except OSError:
+        # process is gone, or belongs to someone we can't inspect
+        return ttys
+    for fd in fds:
+        try:
+            target = os.readlink(os.path.join(fd_dir, fd))
+        except OSError:
+            continue
+        if target.startswith(tty_prefix):
+            ttys.add(os.path.basename(target))
+    return ttys
+
+# One pass over /proc/*/fd and /proc/*/comm, recording which processes have
+# which ttys open. Build one of these per check/refresh and ask it all the
+# questions, rather than forking a probe for every tty.
+class ProcIndex(object):
+    def __init__(self):
+        self.names = {}
+        self.opens = {}
+        self.users = {}
+
+        self.scan()
+
+    def scan(self):
+        self.names = {}
+        self.opens = {}
+        self.users = {}
+        for entry in os.listdir(settings.proc_dir):
+            if not entry.isdigit():
+                continue
+            pid = int(entry)
+            ttys = proc_ttys(pid)
+            if ttys:
+                self.opens[pid] = ttys
+                for tty in ttys:
+                    self.users.setdefault(tty, []).append(pid)
+                self.names[pid] = proc_comm(pid)
+        for tty in self.users:
+            self.users[tty].sort()
+
+    def suser(self, tty):
+        if tty in self.users:
+            return self.users[tty][0]
+        else:
+            return None
+
+    def psname(self, pid):
+        if pid not in self.names:
+            # we only record names for tty users, so look it up directly
+            self.names[pid] = proc_comm(pid)
+        return self.names[pid]
+
+    def hasopen(self, pid, tty):
+        return tty in self.opens.get(pid, ())
+
+def suser(tty, procs = None):
+    if procs is None:
+        procs = ProcIndex()
+    return procs.suser(tty)
+
+def psname(pid, procs = None):
+    if procs is None:
+        return proc_comm(pid)
+    else:
+        return procs.psname(pid)
+
+def hasopen(pid, tty, procs = None):
+    if procs is None:
+        return tty in proc_ttys(pid)
+    else:
+        return procs.hasopen(pid, tty)
+
 def status_exists():
     return os.path.isfile(settings.status_path)
 
@@ -52,16 +148,27 @@ def status_init():
     with open(settings.status_path, 'wt'):
         pass
 
-# this is slow due to many .1s calls to fuser
 def status_new():
     ttys = lstty()
-    status = {tty : suser(tty) for tty in ttys}
+    procs = ProcIndex()
+    status = {tty : procs.suser(tty) for tty in ttys}
     return status
 
 # use as a context manager to wrap flock-ed updates to a global status file
+#
+# Every entry also carries a generation number, bumped whenever the entry is
+# written. Slow updates (check, refresh) read a snapshot, work out what they
+# want to change without holding the lock, and then commit with cas(), which
+# only succeeds for entries nobody else has touched in the meantime.
+#
+# Readers should pass readonly=True: they take a shared lock and never write
+# back. Writers only rewrite the file if something actually changed.
 class Status(object):
-    def __init__(self):
+    def __init__(self, readonly = False):
+        self.readonly = readonly
+        self.dirty = False
         self.status = None
+        self.gens = None
         self.status_f = None
         
         self.open_status()
@@ -75,22 +182,69 @@ class Status(object):
         self.status_f.close()
 
     def import_status(self):        
-        fcntl.flock(self.status_f, fcntl.LOCK_EX)
+        fcntl.flock(self.status_f, fcntl.LOCK_SH if self.readonly else fcntl.LOCK_EX)
         self.status_f.seek(0, io.SEEK_SET)
         try:
-            status = json.load(self.status_f)
+            data = json.load(self.status_f)
         except json.decoder.JSONDecodeError:
-            status = status_new()
-        self.status = status
+            data = {'status' : status_new()}
+            self.dirty = True
+        if isinstance(data.get('status'), dict):
+            self.status = data['status']
+            self.gens = data.get('gens', {})
+        else:
+            # old format, with no generation numbers
+            self.status = data
+            self.gens = {}
 
     def export_status(self):
-        self.status_f.seek(0, io.SEEK_SET)
-        json.dump(self.status, self.status_f, indent=2, sort_keys=True)
-        self.status_f.write('\n')
-        self.status_f.truncate()
-        self.status_f.flush()
+        if self.dirty and not self.readonly:
+            self.status_f.seek(0, io.SEEK_SET)
+            data = {
+                'status' : self.status,
+                'gens' : {tty : self.gens[tty] for tty in self.gens if tty in self.status},
+            }
+            json.dump(data, self.status_f, indent=2, sort_keys=True)
+            self.status_f.write('\n')
+            self.status_f.truncate()
+            self.status_f.flush()
         fcntl.flock(self.status_f, fcntl.LOCK_UN)
 
+    def gen(self, tty):
+        return self.gens.get(tty, 0)
+
+    def set(self, tty, value):
+        self.status[tty] = value
+        self.gens[tty] = self.gen(tty) + 1
+        self.dirty = True
+
+    def remove(self, tty):
+        del self.status[tty]
+        self.gens.pop(tty, None)
+        self.dirty = True
+
+    # Map each tty to a (value, generation) pair, to hand to cas() later.
+    def snapshot(self):
+        return {tty : (self.status[tty], self.gen(tty)) for tty in self.status}
+
+    # Set tty to value, but only if its generation is still gen. A gen of None
+    # means the tty was not in the snapshot, and must still be absent.
+    def cas(self, tty, gen, value):
+        if gen is None:
+            if tty in self.status:
+                return False
+        elif tty not in self.status or self.gen(tty) != gen:
+            return False
+        self.set(tty, value)
+        return True
+
+    def cas_remove(self, tty, gen):
+        if tty in self.status and self.gen(tty) == gen:
+            self.remove(tty)
+            return True
+        else:
+            return False
+
     def __enter__(self):
         self.import_status()
         return self
@@ -99,94 +253,597 @@ class Status(object):
         self.export_status()
         self.close_status()
 
+# Compact status store: a fixed-size table of slots in a memory-mapped file,
+# one slot per tty, updated in place. Same interface as Status above, so the
+# primary API works with either; pick one with settings.status_store.
+
+table_magic = b'MSPT'
+table_version = 1
+table_header = struct.Struct('<4sII4x')
+table_slot = struct.Struct('<16sB3xiI4x')
+table_header_size = table_header.size
+table_slot_size = table_slot.size
+
+slot_unused = 0
+slot_free = 1
+slot_pid = 2
+slot_mark = 3
+
+def table_size(nslots):
+    return table_header_size + nslots * table_slot_size
+
+def slot_offset(i):
+    return table_header_size + i * table_slot_size
+
+def slot_encode(value):
+    if value is None:
+        return slot_free, 0
+    elif isinstance(value, int):
+        return slot_pid, value
+    else:
+        return slot_mark, 0
+
+def slot_decode(state, pid):
+    if state == slot_pid:
+        return pid
+    elif state == slot_mark:
+        return settings.tty_mark
+    else:
+        return None
+
+def table_init(f):
+    if os.fstat(f.fileno()).st_size >= table_header_size:
+        return
+    fcntl.flock(f, fcntl.LOCK_EX)
+    try:
+        f.seek(0, io.SEEK_END)
+        if f.tell() < table_header_size:
+            f.truncate(table_size(settings.status_table_slots))
+            f.seek(0)
+            # version 0 means "not populated yet"
+            f.write(table_header.pack(table_magic, 0, settings.status_table_slots))
+            f.flush()
+    finally:
+        fcntl.flock(f, fcntl.LOCK_UN)
+
+class StatusTable(object):
+    def __init__(self, readonly = False):
+        self.readonly = readonly
+        self.status = None
+        self.gens = None
+        self.slots = None
+        self.table_f = None
+        self.table = None
+
+        self.open_table()
+
+    def open_table(self):
+        if not os.path.isdir(settings.status_dir):
+            os.makedirs(settings.status_dir, exist_ok=True)
+        fd = os.open(settings.status_table_path, os.O_RDWR | os.O_CREAT, 0o644)
+        self.table_f = os.fdopen(fd, 'r+b')
+        table_init(self.table_f)
+
+    def close_table(self):
+        self.table_f.close()
+
+    def import_table(self):
+        fcntl.flock(self.table_f, fcntl.LOCK_SH if self.readonly else fcntl.LOCK_EX)
+        access = mmap.ACCESS_READ if self.readonly else mmap.ACCESS_WRITE
+        self.table = mmap.mmap(self.table_f.fileno(), 0, access=access)
+        magic, version, nslots = table_header.unpack_from(self.table, 0)
+        if magic != table_magic:
+            raise ValueError('bad magic number in status table {}'.format(repr(settings.status_table_path)))
+
+        self.status = {}
+        self.gens = {}
+        self.slots = {}
+        # the state byte sits right after the name in each slot
+        states = self.table[table_header_size + 16:table_size(nslots):table_slot_size]
+        for i in range(nslots):
+            if states[i] != slot_unused:
+                name, state, pid, gen = table_slot.unpack_from(self.table, slot_offset(i))
+                tty = name.rstrip(b'\x00').decode('ascii')
+                self.status[tty] = slot_decode(state, pid)
+                self.gens[tty] = gen
+                self.slots[tty] = i
+
+        if version == 0:
+            # fresh table, populate it the same way we would an empty status.json
+            for tty, value in status_new().items():
+                self.status[tty] = value
+                self.gens[tty] = 0
+            if not self.readonly:
+                for tty in self.status:
+                    self.write_slot(tty)
+                table_header.pack_into(self.table, 0, table_magic, table_version, nslots)
+
+    # Writes land in the shared mapping as they happen, so other processes see
+    # them as soon as we unlock; there's nothing to flush.
+    def export_table(self):
+        self.table.close()
+        fcntl.flock(self.table_f, fcntl.LOCK_UN)
+
+    def free_slot(self):
+        used = set(self.slots.values())
+        nslots = (len(self.table) - table_header_size) // table_slot_size
+        for i in range(nslots):
+            if i not in used:
+                return i
+        raise ValueError('status table {} is full ({:d} slots)'.format(
+            repr(settings.status_table_path), nslots))
+
+    def write_slot(self, tty):
+        if tty not in self.slots:
+            self.slots[tty] = self.free_slot()
+        state, pid = slot_encode(self.status[tty])
+        table_slot.pack_into(self.table, slot_offset(self.slots[tty]),
+                             tty.encode('ascii'), state, pid, self.gens[tty])
+
+    def gen(self, tty):
+        return self.gens.get(tty, 0)
+
+    def set(self, tty, value):
+        self.status[tty] = value
+        self.gens[tty] = self.gen(tty) + 1
+        self.write_slot(tty)
+
+    def remove(self, tty):
+        del self.status[tty]
+        self.gens.pop(tty, None)
+        i = self.slots.pop(tty, None)
+        if i is not None:
+            table_slot.pack_into(self.table, slot_offset(i), b'', slot_unused, 0, 0)
+
+    snapshot = Status.snapshot
+    cas = Status.cas
+    cas_remove = Status.cas_remove
+
+    def __enter__(self):
+        self.import_table()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.export_table()
+        self.close_table()
+
+def status_store(readonly = False):
+    if settings.status_store == 'table':
+        return StatusTable(readonly=readonly)
+    else:
+        return Status(readonly=readonly)
+
+def status_snapshot():
+    brokered, snapshot = broker_request('snapshot')
+    if brokered:
+        return {tty : tuple(snapshot[tty]) for tty in snapshot}
+    with status_store(readonly=True) as s:
+        return s.snapshot()
+
+# Apply changes worked out from a snapshot: updates maps each tty to a
+# (gen, value) pair and removes maps each tty to a gen, as in the snapshot.
+# Returns the ttys whose updates went through.
+def apply_commit(s, updates, removes):
+    for tty in removes:
+        s.cas_remove(tty, removes[tty])
+    updated = []
+    for tty in updates:
+        gen, value = updates[tty]
+        if s.cas(tty, gen, value):
+            updated.append(tty)
+    return updated
+
+
+# tty wait queue
+#
+# A process waiting for a tty binds a unix datagram socket in settings.wait_dir,
+# named for its priority and arrival time; the directory listing is the queue.
+# Whoever frees a tty hands it straight to the first waiter (reserving it under
+# the waiter's pid, just like get_tty would) and sends it the tty's name, so
+# nobody polls and a newcomer can't snatch a port from someone who was queued.
+# All of this happens under the status lock.
+
+# Fields are separated with '_', since priorities can be negative.
+def waiter_name(priority, pid):
+    return 'p{:d}_{:d}_{:d}.sock'.format(priority, time.monotonic_ns(), pid)
+
+def waiter_key(fname):
+    priority, stamp, pid = fname[1:-len('.sock')].split('_')
+    return int(priority), int(stamp), int(pid)
+
+def lswaiters():
+    try:
+        fnames = os.listdir(settings.wait_dir)
+    except FileNotFoundError:
+        return []
+    waiters = []
+    for fname in fnames:
+        try:
+            waiters.append((waiter_key(fname), fname))
+        except ValueError:
+            continue
+    waiters.sort()
+    return [fname for key, fname in waiters]
+
+def unlink_waiter(path):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+# Give free ttys to queued waiters, in priority and then arrival order.
+# Waiters that have gone away without cleaning up are dropped.
+def dispatch(s):
+    free_ttys = [tty for tty in sorted(s.status) if s.status[tty] is None]
+    if not free_ttys:
+        return
+    waiters = lswaiters()
+    if not waiters:
+        return
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+        for fname in waiters:
+            if not free_ttys:
+                break
+            path = os.path.join(settings.wait_dir, fname)
+            tty = free_ttys[0]
+            try:
+                sock.sendto(tty.encode('ascii'), path)
+            except OSError:
+                unlink_waiter(path)
+                continue
+            # Out of line now, so the next tty goes to the next waiter, even if
+            # this one hasn't woken up yet; the message waits in its socket.
+            unlink_waiter(path)
+            priority, stamp, pid = waiter_key(fname)
+            s.set(tty, pid)
+            free_ttys.pop(0)
+    finally:
+        sock.close()
+
+# Queue up for a tty. Must be called with the status lock held, so that no
+# release can slip in between looking for a free tty and getting in line.
+def enqueue(priority):
+    if not os.path.isdir(settings.wait_dir):
+        os.makedirs(settings.wait_dir, exist_ok=True)
+    path = os.path.join(settings.wait_dir, waiter_name(priority, os.getpid()))
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    sock.bind(path)
+    return sock, path
+
+def recv_tty(sock):
+    try:
+        return sock.recv(256).decode('ascii')
+    except BlockingIOError:
+        return None
+
+# Wait for a tty to be handed to us, giving up after timeout seconds (or never,
+# if timeout is None).
+def wait_tty(sock, path, timeout):
+    try:
+        readable, _, _ = select.select([sock], [], [], timeout)
+        if readable:
+            return recv_tty(sock)
+
+        # Timed out. Leave the queue under the lock, then check whether
+        # someone handed us a tty right before we got out of line.
+        with status_store():
+            unlink_waiter(path)
+        sock.setblocking(False)
+        return recv_tty(sock)
+    finally:
+        unlink_waiter(path)
+        sock.close()
+
+
+# broker client
+#
+# If a broker (see broker.py) is listening on settings.broker_path, the primary
+# API below talks to it instead of the status file. Connections are kept open
+# for the life of the process, and each request has one to itself: a thread
+# waiting for a tty doesn't hold up the others (which may be about to release
+# one); they take another idle connection, or open a new one. The broker
+# notices when the process's connections drop and gives back any ttys it had
+# reserved.
+
+class BrokerError(Exception):
+    pass
+
+class BrokerClient(object):
+    def __init__(self, sock):
+        self.pid = os.getpid()
+        self.sock = sock
+        self.sock_f = sock.makefile('rwb')
+
+    def close(self):
+        try:
+            self.sock_f.close()
+        except OSError:
+            pass
+        self.sock.close()
+
+    # Requests and replies are single lines of json. This blocks until the
+    # broker answers, including while waiting for a tty, so only one thread
+    # uses a connection at a time (see broker_request).
+    def request(self, op, *args):
+        try:
+            self.sock_f.write(json.dumps([op] + list(args)).encode('ascii') + b'\n')
+            self.sock_f.flush()
+            line = self.sock_f.readline()
+        except OSError as e:
+            raise BrokerError('lost connection to broker: {}'.format(repr(e)))
+        if not line:
+            raise BrokerError('lost connection to broker')
+        reply = json.loads(line.decode('ascii'))
+        if 'warning' in reply:
+            print('WARNING: {}'.format(reply['warning']))
+        return reply.get('result')
+
+# idle connections, and the pid they belong to
+broker_idle = []
+broker_pid = None
+broker_lock = threading.Lock()
+
+def broker_connect():
+    if not os.path.exists(settings.broker_path):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(settings.broker_path)
+    except OSError:
+        sock.close()
+        return None
+    return BrokerClient(sock)
+
+# Take an idle connection to the broker, or open one; None if there isn't a
+# broker running.
+def broker_client():
+    global broker_pid
+    with broker_lock:
+        if broker_pid != os.getpid():
+            # inherited across a fork; the broker thinks these belong to our parent
+            broker_idle.clear()
+            broker_pid = os.getpid()
+        if broker_idle:
+            return broker_idle.pop()
+    return broker_connect()
+
+# Send a request to the broker, if there is one. Returns (True, result) if the
+# broker handled it, or (False, None) to fall back to the status file.
+def broker_request(op, *args):
+    client = broker_client()
+    if client is None:
+        return False, None
+    try:
+        result = client.request(op, *args)
+    except BrokerError:
+        client.close()
+        return False, None
+    with broker_lock:
+        if client.pid == broker_pid:
+            broker_idle.append(client)
+    return True, result
+
+
+# stale session reaping
+#
+# A tty stays reserved under a pid until someone releases it, so a client that
+# dies between get_tty and claim_tty, or an mspdebug that gets killed, would
+# otherwise leak the tty until the next refresh. Every tty reclaimed this way
+# gets a line in settings.reap_log, so we can see how much is leaking.
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # it exists, it just isn't ours
+        return True
+    return True
+
+# Updates (as for apply_commit) freeing every tty in the snapshot held by a dead pid.
+def dead_sessions(snapshot):
+    updates = {}
+    for tty in snapshot:
+        p, gen = snapshot[tty]
+        if isinstance(p, int) and not pid_alive(p):
+            updates[tty] = (gen, None)
+    return updates
+
+def log_reaped(reaped):
+    if not reaped:
+        return
+    if not os.path.isdir(settings.status_dir):
+        os.makedirs(settings.status_dir, exist_ok=True)
+    lines = ''.join('{:.3f} {:s} {:d}\n'.format(time.time(), tty, reaped[tty]) for tty in sorted(reaped))
+    with open(settings.reap_log, 'at') as f:
+        f.write(lines)
+
+# Count reclaimed ttys, per tty, from the reap log.
+def reap_stats():
+    counts = {}
+    try:
+        with open(settings.reap_log, 'rt') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) == 3:
+                    counts[fields[1]] = counts.get(fields[1], 0) + 1
+    except FileNotFoundError:
+        pass
+    return counts
+
 
 # primary API
 
+def commit(updates, removes):
+    brokered, updated = broker_request('commit', updates, removes)
+    if brokered:
+        return updated
+    with status_store() as s:
+        updated = apply_commit(s, updates, removes)
+        dispatch(s)
+    return updated
+
+# A recorded pid is still a valid user if it's one of us or it has the tty open.
+def valid_user(procs, p, tty):
+    return isinstance(p, int) and (procs.psname(p) == settings.interpreter or procs.hasopen(p, tty))
+
 # Check a given set of ttys and update the configuration in place.
+#
+# Probing happens with no lock held; entries that changed while we were
+# probing are left alone, since whoever changed them knows better than we do.
 def check(ttys, all_ttys = None):
     if all_ttys is None:
         all_ttys = lstty()
-    with Status() as s:
-        for tty in ttys:
-            if tty in all_ttys:
-                if tty in s.status:
-                    p = s.status[tty]
-                    if isinstance(p, int) and (psname(p) == settings.interpreter or hasopen(p, tty)):
-                        # this entry appears to be a valid user; do nothing
-                        pass
-                    else:
-                        user = suser(tty)
-                        if isinstance(user, int):
-                            # there appears to be another user, add them
-                            s.status[tty] = user
-                        elif isinstance(p, int):
-                            # clear invalid label
-                            s.status[tty] = None
+    snapshot = status_snapshot()
+    procs = ProcIndex()
+
+    updates = {}
+    for tty in ttys:
+        if tty in all_ttys:
+            if tty in snapshot:
+                p, gen = snapshot[tty]
+                if valid_user(procs, p, tty):
+                    # this entry appears to be a valid user; do nothing
+                    pass
                 else:
-                    # tty exists, but is not recorded in status, so add it
-                    s.status[tty] = suser(tty)
+                    user = procs.suser(tty)
+                    if isinstance(user, int):
+                        # there appears to be another user, add them
+                        updates[tty] = (gen, user)
+                    elif isinstance(p, int):
+                        # clear invalid label
+                        updates[tty] = (gen, None)
+            else:
+                # tty exists, but is not recorded in status, so add it
+                updates[tty] = (None, procs.suser(tty))
+
+    commit(updates, {})
 
 
 # Check current configuration for consistency (quickly) and clear ttys marked
 # as not connecting to mspdebug. Intended for use after changing physical device configuration.
 def refresh():
     ttys = lstty()
+    snapshot = status_snapshot()
+    procs = ProcIndex()
+
     new_status = {tty : None for tty in ttys}
-    with Status() as s:
-        for tty in ttys:
-            if tty in s.status:
-                p = s.status[tty]
-                if isinstance(p, int) and (psname(p) == settings.interpreter or hasopen(p, tty)):
-                    new_status[tty] = p
-        s.status = new_status
+    for tty in ttys:
+        if tty in snapshot:
+            p, gen = snapshot[tty]
+            if valid_user(procs, p, tty):
+                new_status[tty] = p
+
+    updates = {}
+    removes = {}
+    for tty in snapshot:
+        if tty not in new_status:
+            removes[tty] = snapshot[tty][1]
+    for tty in new_status:
+        if tty in snapshot:
+            p, gen = snapshot[tty]
+            if p != new_status[tty]:
+                updates[tty] = (gen, new_status[tty])
+        else:
+            updates[tty] = (None, new_status[tty])
+
+    commit(updates, removes)
+
+# Free any ttys held by processes that no longer exist, and return them.
+def reap():
+    snapshot = status_snapshot()
+    updates = dead_sessions(snapshot)
+    if not updates:
+        return []
+    reaped = commit(updates, {})
+    log_reaped({tty : snapshot[tty][0] for tty in reaped})
+    return reaped
 
 def display():
-    status = None
-    with Status() as s:
-        status = s.status
+    brokered, status = broker_request('list')
+    if not brokered:
+        with status_store(readonly=True) as s:
+            status = dict(s.status)
     for tty in sorted(status):
         print('{:9s} : {}'.format(tty, repr(status[tty])))
 
+def take_tty(s):
+    for tty in s.status:
+        p = s.status[tty]
+        if p is None:
+            s.set(tty, os.getpid())
+            return tty
+    return None
+
 # Reserve the next free tty for an mspdebug session. The TTY will be labeled according to the PID
 # of the current python process.
-def get_tty():
-    free_tty = None
-    with Status() as s:
-        for tty in s.status:
-            p = s.status[tty]
-            if p is None:
-                free_tty = tty
-                s.status[tty] = os.getpid()
-                break
+#
+# If every tty is busy, wait up to timeout seconds (forever if timeout is None) for one to be
+# released. Waiters are served lowest priority value first, then in order of arrival.
+def get_tty(timeout = 0, priority = 0):
+    brokered, free_tty = broker_request('get', timeout, priority)
+    if brokered:
+        return free_tty
+
+    with status_store() as s:
+        free_tty = take_tty(s)
+    if free_tty is None:
+        # Nothing free, but maybe someone died holding a tty. Reaping hands
+        # anything it frees to the queue first, so try again before joining it.
+        reap()
+        queued = None
+        with status_store() as s:
+            free_tty = take_tty(s)
+            if free_tty is None and (timeout is None or timeout > 0):
+                queued = enqueue(priority)
+        if queued is not None:
+            sock, path = queued
+            free_tty = wait_tty(sock, path, timeout)
     return free_tty
 
 # Change the label of a tty session to the given pid, presumably an actual mspdebug process.
 def claim_tty(tty, pid):
-    with Status() as s:
+    brokered, _ = broker_request('claim', tty, pid)
+    if brokered:
+        return
+    with status_store() as s:
         if tty in s.status:
-            s.status[tty] = pid
+            s.set(tty, pid)
         else:
             print('WARNING: claim_tty: no tty {} for pid {}'.format(repr(tty), repr(pid)))
 
 # Remove the label of a tty session, presumably because the mspdebug process has exited.
 def release_tty(tty):
-    with Status() as s:
+    brokered, _ = broker_request('release', tty)
+    if brokered:
+        return
+    with status_store() as s:
         if tty in s.status:
-            s.status[tty] = None
+            s.set(tty, None)
+            dispatch(s)
         else:
             print('WARNING: release_tty: no tty {}'.format(repr(tty)))
 
 # Mark that a tty does not connect to an mspdebug controller.
 def mark_tty(tty):
-    with Status() as s:
+    brokered, _ = broker_request('mark', tty)
+    if brokered:
+        return
+    with status_store() as s:
         if tty in s.status:
-            s.status[tty] = settings.tty_mark
+            s.set(tty, settings.tty_mark)
         else:
             print('WARNING: mark_tty: no tty {}'.format(repr(tty)))
 
 # Report the current status of a single tty.
 def check_tty(tty):
-    with Status() as s:
+    brokered, status = broker_request('check', tty)
+    if brokered:
+        return status
+    with status_store(readonly=True) as s:
         if tty in s.status:
             return s.status[tty]
         else:
@@ -0,0 +1,149 @@
+# device memory cache
+#
+# A write-back cache over the device's address space for one session. Reads
+# are served from the cache where possible, and anything missing is fetched
+# with a single md covering the missing span. Writes (mw and fill) only touch
+# the cache; the dirty bytes are written to the device later, as a few mw
+# commands over contiguous runs, when the session flushes.
+#
+# The driver flushes before any command that might look at memory, and
+# invalidates whenever the device might have changed it (step, run, reset,
+# prog, or any other raw command).
+
+import settings
+
+
+class MemCache(object):
+    def __init__(self, size = None):
+        if size is None:
+            size = settings.memcache_size
+        self.size = size
+        self.data = bytearray(size)
+        self.valid = bytearray(size)
+        self.dirty = bytearray(size)
+        # bounds of everything marked valid, so invalidating doesn't clear the
+        # whole address space every time
+        self.lo = size
+        self.hi = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.bytes_fetched = 0
+        self.bytes_flushed = 0
+        self.flushes = 0
+        self.invalidations = 0
+
+    def check(self, addr, size):
+        if addr < 0 or size < 0 or addr + size > self.size:
+            raise ValueError('memory range {:#x}+{:d} is outside the cache ({:#x} bytes)'
+                             .format(addr, size, self.size))
+
+    def mark(self, addr, size):
+        self.valid[addr:addr+size] = b'\x01' * size
+        self.lo = min(self.lo, addr)
+        self.hi = max(self.hi, addr + size)
+
+    # fetch(addr, size) reads from the device and returns the bytes. Returns a
+    # memoryview of a copy, so later writes don't show through.
+    def read(self, addr, size, fetch):
+        span = self.missing(addr, size)
+        if span is not None:
+            start, length = span
+            self.fetched(start, fetch(start, length))
+        return self.view(addr, size)
+
+    # read in steps, for callers that fetch some other way (like with await):
+    # the (addr, size) span to fetch for a read, if any, then what came back
+
+    def missing(self, addr, size):
+        self.check(addr, size)
+        valid = self.valid[addr:addr+size]
+        first = valid.find(0)
+        if first < 0:
+            self.hits += 1
+            return None
+        self.misses += 1
+        last = valid.rfind(0)
+        return addr + first, last - first + 1
+
+    def fetched(self, start, data):
+        length = len(data)
+        self.bytes_fetched += length
+        valid = self.valid[start:start+length]
+        if valid.find(1) < 0:
+            self.data[start:start+length] = bytes(data)
+        else:
+            # don't clobber what we already have; it might be dirty
+            for i in range(length):
+                if not valid[i]:
+                    self.data[start+i] = data[i]
+        self.mark(start, length)
+
+    def view(self, addr, size):
+        return memoryview(self.data[addr:addr+size])
+
+    def write(self, addr, data):
+        size = len(data)
+        self.check(addr, size)
+        self.data[addr:addr+size] = bytes(data)
+        self.dirty[addr:addr+size] = b'\x01' * size
+        self.mark(addr, size)
+
+    # Like mspdebug's fill: repeat pattern over size bytes.
+    def fill(self, addr, size, pattern):
+        reps = -(-size // len(pattern))
+        self.write(addr, (bytes(pattern) * reps)[:size])
+
+    # Contiguous dirty ranges as (addr, data), at most max_len bytes each.
+    def dirty_runs(self, max_len):
+        runs = []
+        i = self.dirty.find(1, self.lo, self.hi)
+        while i >= 0:
+            end = self.dirty.find(0, i, self.hi)
+            if end < 0:
+                end = self.hi
+            for addr in range(i, end, max_len):
+                run_end = min(addr + max_len, end)
+                runs.append((addr, bytes(self.data[addr:run_end])))
+            i = self.dirty.find(1, end, self.hi)
+        return runs
+
+    # write(runs) sends [(addr, data), ...] to the device.
+    def flush(self, write):
+        runs = self.flush_runs()
+        if runs:
+            write(runs)
+            self.flushed(runs)
+
+    # flush in steps: what to write, then say it's been written
+    def flush_runs(self):
+        if self.lo >= self.hi:
+            return []
+        return self.dirty_runs(settings.mw_max_bytes)
+
+    def flushed(self, runs):
+        self.dirty[self.lo:self.hi] = bytes(self.hi - self.lo)
+        self.flushes += 1
+        self.bytes_flushed += sum(len(data) for addr, data in runs)
+
+    # Forget everything. Flush first, or dirty data is lost.
+    def invalidate(self):
+        if self.lo >= self.hi:
+            return
+        self.valid[self.lo:self.hi] = bytes(self.hi - self.lo)
+        self.dirty[self.lo:self.hi] = bytes(self.hi - self.lo)
+        self.lo = self.size
+        self.hi = 0
+        self.invalidations += 1
+
+    def stats(self):
+        reads = self.hits + self.misses
+        return {
+            'hits' : self.hits,
+            'misses' : self.misses,
+            'hit_rate' : self.hits / reads if reads > 0 else None,
+            'bytes_fetched' : self.bytes_fetched,
+            'bytes_flushed' : self.bytes_flushed,
+            'flushes' : self.flushes,
+            'invalidations' : self.invalidations,
+        }
@@ -0,0 +1,165 @@
+# session pool
+#
+# Starting mspdebug and connecting to the FET takes seconds, which is most of
+# the cost of a short job. A SessionPool keeps connected Mspdebug instances
+# alive and lends them out; returned sessions are reset rather than exited.
+
+import driver
+
+import pexpect
+import threading
+import time
+
+
+class SessionPool(object):
+    # Keep size sessions connected, starting more on demand up to max_size
+    # (or without limit if max_size is None). timeout and priority are used
+    # when starting sessions, as for driver.Mspdebug.
+    def __init__(self, size, max_size = None, timeout = 0, priority = 0):
+        self.size = size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.priority = priority
+
+        self.idle = []
+        self.busy = set()
+        self.cond = threading.Condition()
+        self.closed = False
+
+        self.hits = 0
+        self.misses = 0
+        self.spawn_times = []
+
+    def spawn(self):
+        mspdebug = driver.Mspdebug(timeout=self.timeout, priority=self.priority)
+        start = time.perf_counter()
+        mspdebug.start_repl()
+        with self.cond:
+            self.spawn_times.append(time.perf_counter() - start)
+        return mspdebug
+
+    def start(self):
+        while len(self.idle) + len(self.busy) < self.size:
+            mspdebug = self.spawn()
+            with self.cond:
+                self.idle.append(mspdebug)
+
+    def full(self):
+        return self.max_size is not None and len(self.idle) + len(self.busy) >= self.max_size
+
+    # Hand out a connected session. If none are idle, start a new one, or if the
+    # pool is full (or we're out of ttys), wait for one to come back. Raises
+    # driver.NoTTYError if a new session is needed, there are no ttys to start
+    # it on, and there's nothing out on loan to wait for.
+    def acquire(self):
+        missed = False
+        while True:
+            with self.cond:
+                while not self.idle and self.full():
+                    self.cond.wait()
+                if self.idle:
+                    mspdebug = self.idle.pop()
+                    self.busy.add(mspdebug)
+                    if not missed:
+                        self.hits += 1
+                    return mspdebug
+                if not missed:
+                    self.misses += 1
+                    missed = True
+                # hold our place while we start it up
+                placeholder = object()
+                self.busy.add(placeholder)
+
+            try:
+                mspdebug = self.spawn()
+            except driver.NoTTYError:
+                with self.cond:
+                    self.busy.discard(placeholder)
+                    self.cond.notify_all()
+                    if not self.busy:
+                        raise
+                    while not self.idle and self.busy:
+                        self.cond.wait()
+                continue
+            except Exception:
+                with self.cond:
+                    self.busy.discard(placeholder)
+                    self.cond.notify()
+                raise
+
+            with self.cond:
+                self.busy.discard(placeholder)
+                self.busy.add(mspdebug)
+            return mspdebug
+
+    # Take a session back. It's reset, and dropped from the pool if that fails
+    # or if the pool has been closed. If mspdebug went away, that's not an
+    # error; anything else that goes wrong is raised, after the session's been
+    # dropped.
+    def release(self, mspdebug):
+        ok = False
+        try:
+            mspdebug.run_command('reset')
+            ok = True
+        except (pexpect.EOF, pexpect.TIMEOUT):
+            pass
+        finally:
+            with self.cond:
+                self.busy.discard(mspdebug)
+                keep = ok and not self.closed
+                if keep:
+                    self.idle.append(mspdebug)
+                self.cond.notify()
+            if not keep:
+                self.discard(mspdebug)
+
+    def discard(self, mspdebug):
+        try:
+            mspdebug.close()
+        except (pexpect.EOF, pexpect.TIMEOUT, OSError):
+            pass
+
+    def session(self):
+        return PooledSession(self)
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            idle = self.idle
+            self.idle = []
+        for mspdebug in idle:
+            self.discard(mspdebug)
+
+    def stats(self):
+        with self.cond:
+            spawns = len(self.spawn_times)
+            return {
+                'hits' : self.hits,
+                'misses' : self.misses,
+                'idle' : len(self.idle),
+                'busy' : len(self.busy),
+                'spawns' : spawns,
+                'spawn_mean' : sum(self.spawn_times) / spawns if spawns > 0 else None,
+                'spawn_max' : max(self.spawn_times) if spawns > 0 else None,
+            }
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+# with pool.session() as mspdebug: ...
+class PooledSession(object):
+    def __init__(self, pool):
+        self.pool = pool
+        self.mspdebug = None
+
+    def __enter__(self):
+        self.mspdebug = self.pool.acquire()
+        return self.mspdebug
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.pool.release(self.mspdebug)
+        self.mspdebug = None
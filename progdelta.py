@@ -0,0 +1,119 @@
+# incremental programming
+#
+# driver.Mspdebug.prog_delta only rewrites the flash segments that changed since
+# the board was last programmed. What was programmed is recorded per tty in
+# settings.prog_record_dir, as a hash of the image's contents in each segment.
+#
+# The record only knows about programming done through the driver; if something
+# else writes to flash, do a full prog to start over. The hotplug watcher (or
+# the broker) drops a tty's record when it's unplugged, since the next board on
+# that tty may not be the same one.
+
+import settings
+import commands
+
+import os
+import json
+import hashlib
+
+
+# Just the parts of elftools.load blocks that are in flash (settings.flash_ranges
+# by default), as {addr : bytes}. Sections that only exist in RAM, like .bss,
+# aren't programmed, so there's nothing to compare them to.
+def flash_blocks(blocks, ranges = None):
+    if ranges is None:
+        ranges = settings.flash_ranges
+    flash = {}
+    for base in sorted(blocks):
+        data = bytes(blocks[base])
+        for start, size in ranges:
+            lo = max(base, start)
+            hi = min(base + len(data), start + size)
+            if lo < hi:
+                flash[lo] = data[lo-base:hi-base]
+    return flash
+
+# Split flash_blocks up by flash segment:
+# {segment address : [(addr, data), ...]}
+def image_segments(blocks, segment_size):
+    segments = {}
+    for base in sorted(blocks):
+        data = bytes(blocks[base])
+        addr = base
+        end = base + len(data)
+        while addr < end:
+            segment = addr - (addr % segment_size)
+            run_end = min(segment + segment_size, end)
+            segments.setdefault(segment, []).append((addr, data[addr-base:run_end-base]))
+            addr = run_end
+    return segments
+
+def segment_hash(runs):
+    h = hashlib.sha256()
+    for addr, data in runs:
+        h.update(addr.to_bytes(4, 'little') + len(data).to_bytes(4, 'little'))
+        h.update(data)
+    return h.hexdigest()
+
+def image_hashes(segments):
+    return {segment : segment_hash(segments[segment]) for segment in segments}
+
+# Segments to rewrite, and segments that aren't in the new image at all.
+def diff(record, hashes):
+    changed = sorted(segment for segment in hashes if record.get(segment) != hashes[segment])
+    removed = sorted(segment for segment in record if segment not in hashes)
+    return changed, removed
+
+
+# The commands that rewrite changed and clear removed segments, then reset,
+# and the (addr, data) that should read back afterwards.
+def delta_commands(segments, changed, removed):
+    cmds = []
+    if settings.prog_delta_erase:
+        cmds += [commands.erase_segment(segment) for segment in changed + removed]
+    for segment in changed:
+        for addr, data in segments[segment]:
+            cmds += commands.mw_chunks(addr, data)
+    cmds.append('reset')
+    expected = [(addr, data) for segment in changed for addr, data in segments[segment]]
+    expected += [(segment, b'\xff' * settings.flash_segment_size) for segment in removed]
+    return cmds, expected
+
+
+# records
+
+def record_path(tty):
+    return os.path.join(settings.prog_record_dir, tty + '.json')
+
+# {segment address : hash}, or None if we don't know what's on the board.
+def load_record(tty):
+    try:
+        with open(record_path(tty), 'rt') as f:
+            record = json.load(f)
+        if record['segment_size'] != settings.flash_segment_size:
+            return None
+        if record.get('flash_ranges') != [list(r) for r in settings.flash_ranges]:
+            return None
+        return {int(segment, 16) : h for segment, h in record['segments'].items()}
+    except (OSError, ValueError, KeyError):
+        return None
+
+def save_record(tty, hashes):
+    if not os.path.isdir(settings.prog_record_dir):
+        os.makedirs(settings.prog_record_dir, exist_ok=True)
+    record = {
+        'segment_size' : settings.flash_segment_size,
+        'flash_ranges' : [list(r) for r in settings.flash_ranges],
+        'segments' : {'{:#x}'.format(segment) : hashes[segment] for segment in sorted(hashes)},
+    }
+    path = record_path(tty)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wt') as f:
+        json.dump(record, f)
+    os.replace(tmp_path, path)
+
+def forget(tty):
+    try:
+        os.unlink(record_path(tty))
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,306 @@
+# session logging
+#
+# Everything that goes back and forth with mspdebug is written to a SessionLog.
+# It keeps the most recent output in memory, which is where the driver looks for
+# error codes, and depending on the session's log level copies it to a log file:
+#
+#   'off'    : nothing goes to disk
+#   'errors' : only when something goes wrong, and then just the recent output
+#   'full'   : all traffic
+#
+# All disk writes go through one background thread, which also rotates log
+# files once they get too big or too old, and compresses the rotated segments.
+
+import settings
+
+import os
+import re
+import collections
+import queue
+import threading
+import atexit
+import time
+import gzip
+import shutil
+import sys
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+log_levels = ('off', 'errors', 'full')
+
+def logpath(tty):
+    return os.path.join(settings.log_dir, tty+'.log')
+
+# The last size characters written to it, or thereabouts. Safe to write from
+# one thread (like gdbdriver's console drain) while another reads.
+class RingBuffer(object):
+    def __init__(self, size):
+        self.size = size
+        self.chunks = collections.deque()
+        self.length = 0
+        self.lock = threading.Lock()
+
+    def write(self, s):
+        with self.lock:
+            if len(s) >= self.size:
+                self.chunks.clear()
+                self.length = 0
+                s = s[-self.size:]
+            self.chunks.append(s)
+            self.length += len(s)
+            # drop old chunks as long as we'd still have at least size characters
+            while self.length - len(self.chunks[0]) >= self.size:
+                self.length -= len(self.chunks.popleft())
+
+    def tail(self, n = None):
+        with self.lock:
+            text = ''.join(self.chunks)
+        if n is None:
+            n = self.size
+        return text[-n:]
+
+    def clear(self):
+        with self.lock:
+            self.chunks.clear()
+            self.length = 0
+
+
+# rotation and compression
+
+def compress(path, method):
+    if method == 'zstd' and zstandard is None:
+        print('WARNING: sessionlog: zstandard is not installed, using gzip for {}'.format(repr(path)),
+              file=sys.stderr)
+        method = 'gzip'
+    if method == 'zstd':
+        dest = path + '.zst'
+        with open(path, 'rb') as f_in, open(dest, 'wb') as f_out:
+            zstandard.ZstdCompressor().copy_stream(f_in, f_out)
+    elif method == 'gzip':
+        dest = path + '.gz'
+        with open(path, 'rb') as f_in, gzip.open(dest, 'wb') as f_out:
+            shutil.copyfileobj(f_in, f_out)
+    else:
+        raise ValueError('unknown log compression {}'.format(repr(method)))
+    os.unlink(path)
+    return dest
+
+def rotated_segments(path):
+    dirname, basename = os.path.split(path)
+    prefix = basename + '.'
+    segments = [os.path.join(dirname, fname) for fname in os.listdir(dirname) if fname.startswith(prefix)]
+    return sorted(segments, key=lambda segment: (os.stat(segment).st_mtime_ns, segment))
+
+# Move a full log file out of the way, compress it, and throw away the oldest
+# segments if there are too many.
+def rotate(path):
+    dest = '{}.{}'.format(path, time.strftime('%Y%m%d-%H%M%S'))
+    n = 0
+    while any(os.path.exists(dest + ext) for ext in ['', '.gz', '.zst']):
+        n += 1
+        dest = '{}.{}-{:d}'.format(path, time.strftime('%Y%m%d-%H%M%S'), n)
+    os.rename(path, dest)
+    if settings.log_compress:
+        compress(dest, settings.log_compress)
+    segments = rotated_segments(path)
+    for segment in segments[:max(0, len(segments) - settings.log_keep)]:
+        os.unlink(segment)
+
+
+log_start_re = re.compile(r'<<<< (.+?) >>>>')
+
+# Every session starts with a spacer from settings.make_log_spacer, so the age of
+# a log file is in its first few lines.
+def log_started(path):
+    try:
+        with open(path, 'rt') as f:
+            head = f.read(256)
+        return time.mktime(time.strptime(log_start_re.search(head).group(1)))
+    except (OSError, AttributeError, ValueError):
+        return time.time()
+
+class LogFile(object):
+    def __init__(self, path):
+        self.path = path
+        self.started = log_started(path)
+        self.f = open(path, 'at')
+        self.size = os.fstat(self.f.fileno()).st_size
+
+    def write(self, s):
+        self.f.write(s)
+        self.f.flush()
+        self.size += len(s)
+
+    def full(self):
+        return ((settings.log_max_bytes is not None and self.size >= settings.log_max_bytes) or
+                (settings.log_max_age is not None and time.time() - self.started >= settings.log_max_age))
+
+    def close(self):
+        self.f.close()
+
+# The background writer. Requests are ('write', path, text), ('close', path, None)
+# and ('sync', None, event); a None request stops the thread.
+class LogWriter(object):
+    def __init__(self):
+        self.queue = queue.SimpleQueue()
+        self.files = {}
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.loop, daemon=True)
+                self.thread.start()
+                atexit.register(self.stop)
+
+    def write(self, path, s):
+        self.start()
+        self.queue.put(('write', path, s))
+
+    def close(self, path):
+        self.start()
+        self.queue.put(('close', path, None))
+
+    # Wait until everything queued so far has been written (or failed to be),
+    # for at most timeout seconds (settings.log_sync_timeout by default; None to
+    # wait for good). Returns False if it timed out.
+    def sync(self, timeout = None):
+        if timeout is None:
+            timeout = settings.log_sync_timeout
+        self.start()
+        event = threading.Event()
+        self.queue.put(('sync', None, event))
+        if event.wait(timeout):
+            return True
+        print('WARNING: sessionlog: timed out waiting for the log writer', file=sys.stderr)
+        return False
+
+    def stop(self):
+        with self.lock:
+            thread = self.thread
+            self.thread = None
+        if thread is not None:
+            self.queue.put(None)
+            thread.join()
+
+    def flush(self, path, pending):
+        if not pending:
+            return
+        try:
+            if path not in self.files:
+                self.files[path] = LogFile(path)
+            log = self.files[path]
+            log.write(''.join(pending))
+            if log.full():
+                log.close()
+                del self.files[path]
+                rotate(path)
+        except Exception as e:
+            # lose these writes, not the thread; start the file afresh next time
+            self.report(path, e)
+            self.drop(path)
+
+    def close_file(self, path):
+        try:
+            if path in self.files:
+                self.files.pop(path).close()
+        except Exception as e:
+            self.report(path, e)
+
+    def drop(self, path):
+        log = self.files.pop(path, None)
+        if log is not None:
+            try:
+                log.close()
+            except Exception:
+                pass
+
+    # Warnings go to stderr: stdout may be carrying the interface protocol
+    # (see main.py), and this thread could write into the middle of a frame.
+    def report(self, path, e):
+        print('WARNING: sessionlog: writing {}: {}'.format(repr(path), repr(e)), file=sys.stderr)
+
+    def loop(self):
+        while True:
+            requests = [self.queue.get()]
+            # take whatever else has piled up, so writes to a file can go out together
+            while requests[-1] is not None:
+                try:
+                    requests.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            pending = {}
+            for request in requests:
+                if request is None:
+                    break
+                op, path, arg = request
+                try:
+                    if op == 'write':
+                        pending.setdefault(path, []).append(arg)
+                    elif op == 'close':
+                        self.flush(path, pending.pop(path, None))
+                        self.close_file(path)
+                    elif op == 'sync':
+                        for pending_path in pending:
+                            self.flush(pending_path, pending[pending_path])
+                        pending = {}
+                except Exception as e:
+                    self.report(path, e)
+                finally:
+                    # whatever happened, don't leave anyone waiting
+                    if op == 'sync':
+                        arg.set()
+            for path in pending:
+                self.flush(path, pending[path])
+
+            if requests[-1] is None:
+                for path in list(self.files):
+                    self.close_file(path)
+                return
+
+writer = LogWriter()
+
+
+# Looks enough like a file for pexpect and the transports to log to.
+class SessionLog(object):
+    def __init__(self, tty, level = None):
+        if level is None:
+            level = settings.log_level
+        if level not in log_levels:
+            raise ValueError('unknown log level {}, expecting one of {}'.format(repr(level), log_levels))
+        self.tty = tty
+        self.level = level
+        self.path = logpath(tty)
+        self.ring = RingBuffer(settings.log_ring_size)
+
+        if self.level != 'off' and not os.path.isdir(settings.log_dir):
+            os.makedirs(settings.log_dir, exist_ok=True)
+        if self.level == 'full':
+            writer.write(self.path, settings.make_log_spacer())
+
+    def write(self, s):
+        self.ring.write(s)
+        if self.level == 'full':
+            writer.write(self.path, s)
+
+    def flush(self):
+        pass
+
+    def tail(self, n = None):
+        return self.ring.tail(n)
+
+    # Something went wrong; at the 'errors' level, this is when the recent
+    # output gets written out.
+    def error(self):
+        if self.level == 'errors':
+            writer.write(self.path, settings.make_log_spacer() + self.ring.tail())
+
+    def close(self):
+        if self.level != 'off':
+            writer.close(self.path)
@@ -6,8 +6,50 @@ interpreter = 'python'
 mspdebug = 'mspdebug'
 mspdebug_driver = 'tilib'
 mspdebug_prompt = '(mspdebug) '
+# how to talk to mspdebug: 'pexpect' or 'pty' (see transport.py)
+mspdebug_transport = 'pexpect'
+# most bytes of pipelined commands to have sent but not seen finish
+pipeline_window = 1024
+# most bytes to write with a single mw command
+mw_max_bytes = 64
+# Mspdebug.md_iter reads this many bytes per md, with at most md_iter_depth
+# of them outstanding
+md_chunk = 4096
+md_iter_depth = 4
+# memory cache (see memcache.py): size of the address space (20 bits for
+# MSP430X), and commands that leave memory alone, so running them doesn't
+# invalidate the cache
+memcache_size = 1 << 20
+memcache_keep_commands = {'regs', 'set', 'md', 'setbreak', 'delbreak'}
+# commands that leave registers alone, for the driver's register cache
+regcache_keep_commands = {'md', 'mw', 'fill', 'setbreak', 'delbreak'}
+# breakpoint slot used by Mspdebug.run_until
+run_until_break = 0
+# while waiting for the target to halt by itself, Mspdebug.run_until stops it to
+# look every so often, starting at halt_poll_min seconds and backing off to
+# halt_poll_max
+halt_poll_min = 0.001
+halt_poll_max = 0.1
+# steps to pipeline at once in Mspdebug.trace
+trace_batch = 256
+# (address, size) ranges saved by Mspdebug.snapshot: RAM, on an FR5969
+snapshot_ranges = [(0x1c00, 0x800)]
+# GdbMspdebug (see gdbdriver.py): where mspdebug's gdb server listens, what it
+# says once it's listening, the packet size to assume if it doesn't say, and
+# how long to wait for it to exit after detaching
+gdb_host = '127.0.0.1'
+gdb_ready = 'Now waiting for connection...'
+gdb_packet_size = 1024
+gdb_exit_timeout = 5
+# what mspdebug says when the port was taken after all, and how many ports to
+# try before giving up on the tty
+gdb_bind_failed = 'failed to bind'
+gdb_bind_attempts = 3
+# boards to program at once in fleet.prog_all (None for all of them)
+fleet_concurrency = 8
 
-# things are currently very broken with breakpoints...
+# run doesn't come back to the prompt by itself, so it can only be used
+# through Mspdebug.run and Mspdebug.run_until
 mspdebug_cmd_blacklist = {
     'alias',
     'blow_jtag_fuse',
@@ -19,12 +61,55 @@ status_dir = '/tmp/py-mspdebug-1000'
 status_fname = 'status.json'
 status_path = os.path.join(status_dir, status_fname)
 
+# 'json' keeps tty status in status.json; 'table' uses a fixed-size
+# memory-mapped table instead, which is much cheaper to read and update.
+status_store = 'json'
+status_table_fname = 'status.tbl'
+status_table_path = os.path.join(status_dir, status_table_fname)
+status_table_slots = 256
+
+# processes waiting in manager.get_tty queue up here
+wait_dir = os.path.join(status_dir, 'wait')
+
+# if a broker is listening here, manager talks to it instead of the status file
+broker_fname = 'broker.sock'
+broker_path = os.path.join(status_dir, broker_fname)
+
+# ttys freed because their holder died are logged here;
+# the broker looks for them every reap_interval seconds
+reap_log = os.path.join(status_dir, 'reaped.log')
+reap_interval = 10.0
+
 tty_name = 'ttyACM'
 tty_dir = '/dev'
 tty_mark = 'x'
 
+proc_dir = '/proc'
+
+# what was last programmed onto each tty's board, for driver.Mspdebug.prog_delta
+prog_record_dir = os.path.join(status_dir, 'prog')
+# (address, size) ranges of flash (or FRAM) that prog writes, on an FR5969;
+# anything else in an image (.bss, .noinit in RAM) isn't there after prog
+flash_ranges = [(0x4400, 0xbc00), (0x10000, 0x4000)]
+# flash is erased in segments this big; on FRAM parts, set prog_delta_erase
+# to False and just overwrite
+flash_segment_size = 512
+prog_delta_erase = True
+
 log_dir = os.path.join(status_dir, 'logs')
+# 'off', 'errors' (recent output, only when something goes wrong) or 'full'
+log_level = 'full'
+# rotate a tty's log when it gets this big or this old (in seconds), keeping
+# log_keep old segments, compressed with log_compress: None, 'gzip' or 'zstd'
+log_max_bytes = 16 * 1024 * 1024
+log_max_age = 24 * 60 * 60
+log_keep = 8
+log_compress = 'gzip'
+# recent mspdebug output kept in memory, and how much of it to search for errors
+log_ring_size = 16384
 log_error_window = 1024
+# longest to wait in sessionlog.writer.sync for queued writes to go out
+log_sync_timeout = 10.0
 errors_to_mark = {57}
 
 def make_log_spacer():
@@ -43,3 +128,12 @@ prot_md = 'md'
 prot_regs = 'regs'
 prot_step = 'step'
 prot_run = 'run'
+# handshake line that switches the protocol to binary frames (see interface.py)
+prot_binary = 'binary'
+# handshake line that switches to tagged, pipelined requests, the extra commands
+# that mode has for opening and closing boards, and the name of the board the
+# driver started with
+prot_multi = 'multi'
+prot_open = 'open'
+prot_close = 'close'
+prot_first_board = '0'
@@ -0,0 +1,99 @@
+# device snapshots
+#
+# A Snapshot is memory ranges and registers read off a board with
+# driver.Mspdebug.snapshot, to be put back later with Mspdebug.restore. It has
+# the interface elftools.save expects of a state, so it can be saved as an elf
+# core file (registers go in an elf_section_registers section) and loaded back.
+
+import settings
+import commands
+import elftools
+import utils
+
+
+class Snapshot(object):
+    # regions maps start address to bytes; regs is the 16 registers.
+    def __init__(self, regions, regs):
+        self.regions = regions
+        self.regs = regs
+
+    def ranges(self):
+        return [(addr, len(self.regions[addr])) for addr in sorted(self.regions)]
+
+    # for elftools.save
+
+    def segments(self):
+        return [(addr, self.regions[addr]) for addr in sorted(self.regions)]
+
+    def registers(self):
+        return self.regs
+
+    def entry(self):
+        return self.regs[0]
+
+    def dump(self):
+        for addr, data in self.segments():
+            print('  {:5d} bytes at {:05x}'.format(len(data), addr))
+        print('  regs: ' + ' '.join('{:05x}'.format(r) for r in self.regs))
+
+    def save(self, fname, verbosity = 0):
+        elftools.save(self, fname, verbosity=verbosity)
+
+def load(fname, verbosity = 0):
+    mem_blocks, reg_blocks = elftools.load(fname, restore_regs=True, verbosity=verbosity)
+    if reg_blocks is None:
+        raise ValueError('no registers in {}, not a snapshot?'.format(repr(fname)))
+    regions = {addr : bytes(mem_blocks[addr]) for addr in mem_blocks}
+    return Snapshot(regions, reg_blocks[0])
+
+# Commands to read ranges for a snapshot, and to read the registers too if we
+# don't already know them (regs is None).
+def snapshot_commands(ranges, regs):
+    cmds = [commands.md(addr, size) for addr, size in ranges]
+    if regs is None:
+        cmds.append('regs')
+    return cmds
+
+def parse_snapshot(ranges, outputs, regs):
+    regions = {}
+    for (addr, size), output in zip(ranges, outputs):
+        regions[addr] = bytes(commands.parse_md(output, addr, size))
+    if regs is None:
+        regs = utils.parse_regs(outputs[-1])
+    return Snapshot(regions, list(regs))
+
+# Commands to take the board from current to snap, writing only what differs,
+# and the registers it'll have afterwards.
+def restore_commands(current, snap):
+    cmds = []
+    for addr in sorted(snap.regions):
+        runs = diff_runs(current.regions[addr], snap.regions[addr], addr, settings.mw_max_bytes)
+        cmds += [commands.mw(run_addr, data) for run_addr, data in runs]
+    regs = list(snap.regs)
+    # R3 is the constant generator; leave it be
+    regs[3] = current.regs[3]
+    cmds += [commands.setreg(i, regs[i]) for i in range(len(regs)) if regs[i] != current.regs[i]]
+    return cmds, regs
+
+# Where new differs from old, as [(addr, data), ...] with base as the address
+# of the first byte. Runs closer together than gap are merged, since sending a
+# few unchanged bytes is cheaper than another command; no run is longer than
+# max_len.
+def diff_runs(old, new, base, max_len, gap = 8):
+    if old == new:
+        return []
+    runs = []
+    start = None
+    end = None
+    for i in range(len(new)):
+        if old[i] != new[i]:
+            if start is not None and i - end <= gap and i + 1 - start <= max_len:
+                end = i + 1
+            else:
+                if start is not None:
+                    runs.append((base + start, new[start:end]))
+                start = i
+                end = i + 1
+    if start is not None:
+        runs.append((base + start, new[start:end]))
+    return runs
@@ -0,0 +1,81 @@
+# single-step traces
+#
+# A trace file is a small header followed by one fixed-width record per step:
+# all 16 registers after the step, as little-endian uint32s. That makes the
+# file an array of shape (steps, 16) at a fixed offset, so it can be
+# memory-mapped straight into numpy (see read_trace).
+
+import array
+import struct
+import sys
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+trace_magic = b'MSTR'
+trace_version = 1
+trace_regs = 16
+trace_header = struct.Struct('<4sII4x')
+trace_record = struct.Struct('<{:d}I'.format(trace_regs))
+
+
+class TraceWriter(object):
+    def __init__(self, fname):
+        self.fname = fname
+        self.f = open(fname, 'wb')
+        self.f.write(trace_header.pack(trace_magic, trace_version, trace_regs))
+        self.steps = 0
+
+    # rows is a list of register lists, one per step.
+    def write(self, rows):
+        flat = array.array('I')
+        for regs in rows:
+            if len(regs) != trace_regs:
+                raise ValueError('expecting {:d} registers per step, got {:d}'.format(trace_regs, len(regs)))
+            flat.extend(regs)
+        if sys.byteorder != 'little':
+            flat.byteswap()
+        self.f.write(flat.tobytes())
+        self.steps += len(rows)
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+def check_header(f):
+    magic, version, nregs = trace_header.unpack(f.read(trace_header.size))
+    if magic != trace_magic:
+        raise ValueError('not a trace file: magic was {}, expecting {}'.format(repr(magic), repr(trace_magic)))
+    if version != trace_version:
+        raise ValueError('bad trace version: was {:d}, expecting {:d}'.format(version, trace_version))
+    if nregs != trace_regs:
+        raise ValueError('bad register count in trace: was {:d}, expecting {:d}'.format(nregs, trace_regs))
+
+# The whole trace as a read-only (steps, 16) numpy array, backed by the file.
+def read_trace(fname):
+    if numpy is None:
+        raise RuntimeError('read_trace needs numpy; use iter_trace instead')
+    with open(fname, 'rb') as f:
+        check_header(f)
+        if not f.read(1):
+            # mmap won't map nothing
+            return numpy.zeros((0, trace_regs), dtype='<u4')
+    return numpy.memmap(fname, dtype='<u4', mode='r', offset=trace_header.size).reshape(-1, trace_regs)
+
+# The same thing one step at a time, as tuples, without numpy.
+def iter_trace(fname):
+    with open(fname, 'rb') as f:
+        check_header(f)
+        while True:
+            record = f.read(trace_record.size)
+            if len(record) < trace_record.size:
+                return
+            yield trace_record.unpack(record)
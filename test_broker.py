@@ -0,0 +1,86 @@
+import manager
+import broker
+
+import os
+import signal
+import threading
+import time
+import multiprocessing
+
+import pytest
+
+
+def stored():
+    with manager.status_store(readonly=True) as s:
+        return dict(s.status)
+
+def start_broker():
+    proc = multiprocessing.Process(target=broker.run)
+    proc.start()
+    deadline = time.monotonic() + 5
+    while True:
+        client = manager.broker_connect()
+        if client is not None:
+            client.close()
+            return proc
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+@pytest.fixture
+def broker_proc(ttys):
+    proc = start_broker()
+    yield proc
+    if proc.is_alive():
+        os.kill(proc.pid, signal.SIGTERM)
+    proc.join()
+
+def test_reservations_reach_store(ttys, broker_proc):
+    tty = manager.get_tty()
+    assert manager.broker_idle
+    # no waiting for the broker to exit
+    assert stored()[tty] == os.getpid()
+    manager.release_tty(tty)
+    assert stored()[tty] is None
+
+def test_store_survives_broker_kill(ttys, broker_proc):
+    held = [manager.get_tty() for i in range(2)]
+    manager.release_tty(held[0])
+    os.kill(broker_proc.pid, signal.SIGKILL)
+    broker_proc.join()
+
+    # straight to the file from here on
+    assert manager.check_tty(held[1]) == os.getpid()
+    got = [manager.get_tty() for tty in ttys]
+    assert held[1] not in got
+    assert got.count(None) == 1
+
+def test_broker_picks_up_store(ttys):
+    tty = manager.get_tty()
+    proc = start_broker()
+    try:
+        assert manager.check_tty(tty) == os.getpid()
+        manager.release_tty(tty)
+        assert stored()[tty] is None
+    finally:
+        os.kill(proc.pid, signal.SIGTERM)
+        proc.join()
+    assert manager.get_tty() == tty
+
+def test_broker_wait_queue(ttys, broker_proc):
+    held = [manager.get_tty() for tty in ttys]
+    got = []
+    def waiter(priority, delay):
+        time.sleep(delay)
+        got.append(manager.get_tty(timeout=5, priority=priority))
+    threads = [threading.Thread(target=waiter, args=(priority, delay))
+               for priority, delay in [(1, 0), (-1, 0.1)]]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.3)
+    manager.release_tty(held[3])
+    threads[1].join()
+    assert got == [held[3]]
+    manager.release_tty(held[0])
+    threads[0].join()
+    assert got == [held[3], held[0]]
+    assert manager.get_tty(timeout=0) is None
@@ -0,0 +1,47 @@
+import settings
+import manager
+import gdbdriver
+
+import os
+import socket
+
+
+def test_rsp_escape_round_trip():
+    data = bytes(range(256))
+    escaped = gdbdriver.rsp_escape(data)
+    assert not any(c in escaped for c in b'#$*')
+    assert gdbdriver.rsp_decode(escaped) == data
+    # run-length encoding: 'a' and then 3 more
+    assert gdbdriver.rsp_decode(b'xa* b') == b'xaaaab'
+
+def test_gdb_session(fake_mspdebug):
+    with gdbdriver.GdbMspdebug() as mspdebug:
+        tty = mspdebug.tty
+        # claimed by mspdebug
+        assert manager.check_tty(tty) not in (None, os.getpid())
+        assert mspdebug.reset() == 0x4400
+        assert mspdebug.regs()[:2] == [0x4400, 0x2400]
+
+        # more than a packet, with bytes that need escaping
+        data = bytes(range(256)) * 10
+        mspdebug.mw(0x1000, data)
+        assert bytes(mspdebug.md(0x1000, len(data))) == data
+        mspdebug.fill(0x3000, 5, [0x23, 0x24])
+        assert bytes(mspdebug.md(0x3000, 5)) == b'#$#$#'
+
+        mspdebug.setreg(5, 0x1234)
+        assert mspdebug.regs()[5] == 0x1234
+        assert mspdebug.step() == mspdebug.regs()[0]
+    assert manager.check_tty(tty) is None
+
+def test_port_taken(fake_mspdebug, monkeypatch):
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as taken:
+        taken.bind((settings.gdb_host, 0))
+        taken.listen()
+        ports = [taken.getsockname()[1]]
+        free_port = gdbdriver.free_port
+        monkeypatch.setattr(gdbdriver, 'free_port', lambda: ports.pop() if ports else free_port())
+        with gdbdriver.GdbMspdebug() as mspdebug:
+            assert ports == []
+            assert mspdebug.reset() == 0x4400
+            assert settings.gdb_bind_failed in mspdebug.log.tail()
@@ -0,0 +1,86 @@
+import settings
+import driver
+import interface
+
+import io
+import struct
+
+
+# Run a whole protocol session on input, and return everything written back.
+def session(mspdebug, data):
+    f_in = io.TextIOWrapper(io.BytesIO(data))
+    out = io.BytesIO()
+    f_out = io.TextIOWrapper(out, write_through=True)
+    interface.protocol(mspdebug, f_in=f_in, f_out=f_out)
+    f_out.flush()
+    return out.getvalue()
+
+def frame(opcode, body = b''):
+    request = bytes([opcode]) + body
+    return interface.bin_request.pack(len(request)) + request
+
+def responses(data):
+    frames = []
+    while data:
+        status, length = interface.bin_response.unpack_from(data)
+        start = interface.bin_response.size
+        frames.append((status, data[start:start+length]))
+        data = data[start+length:]
+    return frames
+
+def test_text(fake_mspdebug):
+    with driver.Mspdebug(transport='pty') as mspdebug:
+        out = session(mspdebug, b'mw 2000 1 2 ff\nmd 2000 4\nbogus\nreset\n')
+    assert out.decode().split('\n') == ['', '0x1 0x2 0xff 0x0', 'error: unknown command bogus', '0x4400', '']
+
+def test_binary(fake_mspdebug):
+    requests = [
+        frame(2, struct.pack('<I', 0x2000) + bytes(range(200))),
+        frame(5, struct.pack('<II', 0x2000, 200)),
+        frame(4, struct.pack('<II', 5, 0x1234)),
+        frame(6),
+        frame(5, b'\x01'),
+        frame(42),
+    ]
+    with driver.Mspdebug(transport='pty') as mspdebug:
+        # the frames follow the switch right away, with no wait for the echo
+        out = session(mspdebug, b'regs\n' + settings.prot_binary.encode() + b'\n' + b''.join(requests))
+    text, _, frames = out.partition(settings.prot_binary.encode() + b'\n')
+    assert text.startswith(b'0x4400 ')
+    frames = responses(frames)
+    assert len(frames) == len(requests)
+    assert frames[0] == (interface.bin_ok, b'')
+    assert frames[1] == (interface.bin_ok, bytes(range(200)))
+    assert frames[2] == (interface.bin_ok, b'')
+    assert frames[3][0] == interface.bin_ok and interface.bin_regs.unpack(frames[3][1])[5] == 0x1234
+    assert frames[4][0] == interface.bin_error and frames[4][1].startswith(b'md: input:')
+    assert frames[5] == (interface.bin_error, b'unknown opcode 42')
+
+def test_multi(fake_mspdebug, ttys):
+    requests = [
+        'multi',
+        'a 0 mw 2000 12 34',
+        'b 0 md 2000 2',
+        'c 1 open',
+        'd 1 md 2000 2',
+        'e 1 close',
+        'f 1 md 2000 2',
+        'g 2 regs',
+        'h 0',
+    ]
+    with driver.Mspdebug(transport='pty') as mspdebug:
+        out = session(mspdebug, ''.join(line + '\n' for line in requests).encode())
+    lines = out.decode().split('\n')
+    assert lines[0] == settings.prot_multi and lines[-1] == ''
+    replies = dict(line.split(' ', 1) for line in lines[1:-1])
+    assert replies == {
+        'a' : '',
+        'b' : '0x12 0x34',
+        'c' : replies['c'],
+        'd' : '0x0 0x0',
+        'e' : '',
+        'f' : 'error: no board 1',
+        'g' : 'error: no board 2',
+        'h' : 'error: expecting <id> <board> <command>',
+    }
+    assert replies['c'] in ttys and replies['c'] != mspdebug.tty
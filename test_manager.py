@@ -0,0 +1,84 @@
+import settings
+import manager
+
+import os
+import threading
+import time
+
+import pytest
+
+
+@pytest.fixture(params=['json', 'table'])
+def store(request, monkeypatch):
+    monkeypatch.setattr(settings, 'status_store', request.param)
+    return request.param
+
+def test_cas_needs_same_generation(store, ttys):
+    with manager.status_store(readonly=True) as s:
+        snapshot = s.snapshot()
+    assert snapshot[ttys[0]] == (None, snapshot[ttys[0]][1])
+
+    manager.claim_tty(ttys[0], os.getpid())
+    with manager.status_store() as s:
+        # stale: someone wrote ttys[0] since the snapshot
+        assert not s.cas(ttys[0], snapshot[ttys[0]][1], 1)
+        assert s.cas(ttys[1], snapshot[ttys[1]][1], 1)
+        # new entries only go in if they're still absent
+        assert not s.cas(ttys[2], None, 1)
+        assert s.cas('ttyACM9', None, 1)
+        assert not s.cas_remove(ttys[0], snapshot[ttys[0]][1])
+        assert s.cas_remove(ttys[3], snapshot[ttys[3]][1])
+
+    with manager.status_store(readonly=True) as s:
+        assert s.status[ttys[0]] == os.getpid()
+        assert s.status[ttys[1]] == 1
+        assert s.status['ttyACM9'] == 1
+        assert ttys[3] not in s.status
+
+def test_commit_skips_changed_entries(store, ttys):
+    snapshot = manager.status_snapshot()
+    manager.release_tty(ttys[0])
+    updated = manager.commit({ttys[0] : (snapshot[ttys[0]][1], 1), ttys[1] : (snapshot[ttys[1]][1], 1)},
+                             {ttys[2] : snapshot[ttys[2]][1] + 1})
+    assert updated == [ttys[1]]
+    snapshot = manager.status_snapshot()
+    assert snapshot[ttys[0]][0] is None
+    assert snapshot[ttys[1]][0] == 1
+    assert ttys[2] in snapshot
+
+def test_wait_queue_order(store, ttys):
+    held = [manager.get_tty() for tty in ttys]
+    assert sorted(held) == ttys
+    assert manager.get_tty() is None
+
+    # queue up out of priority order; lower numbers go first, then arrival order
+    with manager.status_store():
+        queued = [manager.enqueue(priority) for priority in [3, -2, 0, -2]]
+    assert [manager.waiter_key(fname)[0] for fname in manager.lswaiters()] == [-2, -2, 0, 3]
+
+    for tty in held:
+        manager.release_tty(tty)
+    got = [manager.wait_tty(sock, path, 1) for sock, path in queued]
+    assert got == [ttys[3], ttys[0], ttys[2], ttys[1]]
+    assert manager.lswaiters() == []
+    # handed over reserved, so nobody else can take them
+    assert all(manager.check_tty(tty) == os.getpid() for tty in ttys)
+
+def test_get_tty_waits(store, ttys):
+    held = [manager.get_tty() for tty in ttys]
+    got = []
+    waiter = threading.Thread(target=lambda: got.append(manager.get_tty(timeout=5)))
+    waiter.start()
+    while not manager.lswaiters():
+        time.sleep(0.01)
+    manager.release_tty(held[2])
+    waiter.join()
+    assert got == [held[2]]
+
+def test_get_tty_times_out(store, ttys):
+    for tty in ttys:
+        manager.get_tty()
+    t0 = time.monotonic()
+    assert manager.get_tty(timeout=0.2) is None
+    assert time.monotonic() - t0 >= 0.2
+    assert manager.lswaiters() == []
@@ -0,0 +1,77 @@
+import settings
+import driver
+import memcache
+import commands
+
+import pytest
+
+
+def test_write_back_runs(monkeypatch):
+    monkeypatch.setattr(settings, 'mw_max_bytes', 4)
+    cache = memcache.MemCache(0x1000)
+    cache.write(0x100, b'\x01\x02\x03')
+    cache.fill(0x103, 7, b'\xaa\xbb')
+    cache.write(0x200, b'\x05')
+    assert cache.flush_runs() == [
+        (0x100, b'\x01\x02\x03\xaa'), (0x104, b'\xbb\xaa\xbb\xaa'), (0x108, b'\xbb\xaa'), (0x200, b'\x05'),
+    ]
+    written = []
+    cache.flush(written.extend)
+    assert len(written) == 4
+    assert cache.flush_runs() == []
+    # still valid after the flush
+    assert bytes(cache.read(0x100, 4, None)) == b'\x01\x02\x03\xaa'
+
+def test_fetch_keeps_dirty_bytes():
+    cache = memcache.MemCache(0x1000)
+    cache.write(0x102, b'\xff')
+    fetches = []
+    def fetch(addr, size):
+        fetches.append((addr, size))
+        return bytes(size)
+    assert bytes(cache.read(0x100, 4, fetch)) == b'\x00\x00\xff\x00'
+    assert fetches == [(0x100, 4)]
+    # all valid now
+    assert bytes(cache.read(0x101, 3, fetch)) == b'\x00\xff\x00'
+    assert fetches == [(0x100, 4)]
+    assert cache.stats()['hits'] == 1 and cache.stats()['misses'] == 1
+
+def test_invalidate_drops_everything():
+    cache = memcache.MemCache(0x1000)
+    cache.write(0x10, b'\x01')
+    cache.invalidate()
+    assert cache.flush_runs() == []
+    assert bytes(cache.read(0x10, 1, lambda addr, size: b'\x07')) == b'\x07'
+    with pytest.raises(ValueError):
+        cache.read(0xfff, 2, None)
+
+def test_driver_writes_back(fake_mspdebug, monkeypatch):
+    with driver.Mspdebug(transport='pty', cache=True) as mspdebug:
+        written = []
+        write_mem = mspdebug.write_mem
+        def logged_write_mem(runs):
+            written.append(runs)
+            write_mem(runs)
+        monkeypatch.setattr(mspdebug, 'write_mem', logged_write_mem)
+
+        mspdebug.mw(0x2000, b'\x01\x02')
+        mspdebug.mw(0x2002, b'\x03\x04')
+        mspdebug.fill(0x2100, 6, b'\xaa\xbb')
+        assert bytes(mspdebug.md(0x2000, 4)) == b'\x01\x02\x03\x04'
+        assert written == []
+        assert mspdebug.cache_stats()['bytes_flushed'] == 0
+
+        # stepping lets the device see memory, so the writes go out first
+        mspdebug.step()
+        assert written == [[(0x2000, b'\x01\x02\x03\x04'), (0x2100, b'\xaa\xbb\xaa\xbb\xaa\xbb')]]
+        stats = mspdebug.cache_stats()
+        assert stats['flushes'] == 1 and stats['invalidations'] == 1
+        # so this comes from the device
+        assert bytes(mspdebug.md(0x2000, 4)) == b'\x01\x02\x03\x04'
+        assert mspdebug.cache_stats()['bytes_fetched'] == 4
+
+def test_driver_flushes_before_raw_commands(fake_mspdebug):
+    with driver.Mspdebug(transport='pty', cache=True) as mspdebug:
+        mspdebug.mw(0x2000, b'\x12\x34')
+        output = mspdebug.run_command(commands.md(0x2000, 2))
+        assert bytes(commands.parse_md(output, 0x2000, 2)) == b'\x12\x34'
@@ -0,0 +1,68 @@
+import settings
+import manager
+import hotplug
+import elftools
+import progdelta
+
+
+# An image with code in flash and a .bss (NOBITS, so no data in the file) in RAM.
+def make_elf(fname, text_addr, text, bss_addr, bss_size):
+    strtab = b'\x00'
+    strtab, shstrtab_name = elftools.nt_string_append(strtab, '.shstrtab')
+    strtab, text_name = elftools.nt_string_append(strtab, '.text')
+    strtab, bss_name = elftools.nt_string_append(strtab, '.bss')
+    offset = 52
+    sections = [
+        {},
+        {'sh_name' : text_name, 'sh_type' : 1, 'sh_flags' : 0x6, 'sh_addr' : text_addr,
+         'sh_offset' : offset, 'sh_size' : len(text), 'sh_addralign' : 2, 'data' : text},
+        {'sh_name' : bss_name, 'sh_type' : 8, 'sh_flags' : 0x3, 'sh_addr' : bss_addr,
+         'sh_offset' : offset + len(text), 'sh_size' : bss_size, 'sh_addralign' : 2, 'data' : b''},
+        {'sh_name' : shstrtab_name, 'sh_type' : 3, 'sh_flags' : 0x20,
+         'sh_offset' : offset + len(text), 'sh_size' : len(strtab), 'sh_addralign' : 1, 'data' : strtab},
+    ]
+    shoff = offset + len(text) + len(strtab)
+    header = {
+        'ei_mag' : elftools.elf_magic, 'ei_class' : elftools.elf_msp_class, 'ei_data' : elftools.elf_msp_data,
+        'ei_version' : elftools.elf_version, 'e_type' : 2, 'e_machine' : elftools.elf_msp_machine,
+        'e_version' : elftools.elf_version, 'e_entry' : text_addr, 'e_phoff' : 0, 'e_phnum' : 0,
+        'e_shoff' : shoff, 'e_shnum' : len(sections), 'e_shstrndx' : len(sections) - 1,
+        'e_ehsize' : 52, 'e_phentsize' : 32, 'e_shentsize' : 40,
+    }
+    with open(fname, 'wb') as f:
+        elftools.blast_header(f, header)
+        elftools.blast_sections(f, sections, shoff)
+
+def test_bss_is_not_flash(tmp_path):
+    fname = str(tmp_path / 'bss.elf')
+    text = bytes(range(256)) * 3
+    make_elf(fname, 0x4400, text, 0x1c00, 0x100)
+
+    blocks, _ = elftools.load(fname)
+    # elftools fills .bss in with zeros
+    assert bytes(blocks[0x1c00]) == b'\x00' * 0x100
+
+    flash = progdelta.flash_blocks(blocks, ranges=[(0x4400, 0xbc00)])
+    assert flash == {0x4400 : text}
+    segments = progdelta.image_segments(flash, 512)
+    assert sorted(segments) == [0x4400, 0x4600]
+
+def test_flash_blocks_clips_to_ranges():
+    blocks = {0x4300 : b'\x01' * 0x200, 0xff00 : b'\x02' * 0x200}
+    flash = progdelta.flash_blocks(blocks, ranges=[(0x4400, 0xbc00), (0x10000, 0x4000)])
+    assert flash == {0x4400 : b'\x01' * 0x100, 0xff00 : b'\x02' * 0x100, 0x10000 : b'\x02' * 0x100}
+
+def test_record_needs_same_flash_ranges(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, 'prog_record_dir', str(tmp_path))
+    progdelta.save_record('ttyACM0', {0x4400 : 'abc'})
+    assert progdelta.load_record('ttyACM0') == {0x4400 : 'abc'}
+    monkeypatch.setattr(settings, 'flash_ranges', [(0x4400, 0x100)])
+    assert progdelta.load_record('ttyACM0') is None
+
+def test_unplug_forgets_record(ttys):
+    progdelta.save_record(ttys[0], {0x4400 : 'abc'})
+    progdelta.save_record(ttys[1], {0x4400 : 'def'})
+    hotplug.sync([], [ttys[0]])
+    assert progdelta.load_record(ttys[0]) is None
+    assert progdelta.load_record(ttys[1]) == {0x4400 : 'def'}
+    assert ttys[0] not in manager.status_snapshot()
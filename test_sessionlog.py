@@ -0,0 +1,91 @@
+import settings
+import sessionlog
+
+import os
+import gzip
+import time
+
+import pytest
+
+
+@pytest.fixture
+def log_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, 'log_dir', str(tmp_path))
+    monkeypatch.setattr(settings, 'log_max_bytes', 1000)
+    monkeypatch.setattr(settings, 'log_max_age', None)
+    monkeypatch.setattr(settings, 'log_keep', 3)
+    monkeypatch.setattr(settings, 'log_compress', 'gzip')
+    return tmp_path
+
+def segments(log_dir):
+    return sorted(fname for fname in os.listdir(str(log_dir)) if fname.startswith('ttyACM0.log.'))
+
+def test_ring_buffer_keeps_tail():
+    ring = sessionlog.RingBuffer(10)
+    for i in range(20):
+        ring.write('{:d},'.format(i))
+    assert ring.tail() == ',17,18,19,'
+    assert ring.tail(3) == '19,'
+    ring.write('x' * 25)
+    assert ring.tail() == 'x' * 10
+    ring.clear()
+    assert ring.tail() == ''
+
+def test_rotates_when_full(log_dir):
+    log = sessionlog.SessionLog('ttyACM0', level='full')
+    log.write('a' * 600)
+    assert sessionlog.writer.sync()
+    assert segments(log_dir) == []
+    log.write('b' * 600)
+    assert sessionlog.writer.sync()
+    rotated = segments(log_dir)
+    assert len(rotated) == 1 and rotated[0].endswith('.gz')
+    with gzip.open(str(log_dir / rotated[0]), 'rt') as f:
+        text = f.read()
+    assert sessionlog.log_start_re.search(text) and text.endswith('a' * 600 + 'b' * 600)
+
+    # the next write starts a fresh file
+    log.write('c')
+    log.close()
+    assert sessionlog.writer.sync()
+    with open(sessionlog.logpath('ttyACM0'), 'rt') as f:
+        assert f.read() == 'c'
+
+def test_keeps_log_keep_segments(log_dir, monkeypatch):
+    monkeypatch.setattr(settings, 'log_compress', None)
+    log = sessionlog.SessionLog('ttyACM0', level='full')
+    for i in range(5):
+        log.write('{:d}'.format(i) * 1000)
+        assert sessionlog.writer.sync()
+    log.close()
+    assert sessionlog.writer.sync()
+    rotated = segments(log_dir)
+    assert len(rotated) == settings.log_keep
+    # the oldest went first
+    contents = []
+    for fname in rotated:
+        with open(str(log_dir / fname), 'rt') as f:
+            contents.append(f.read()[-1])
+    assert sorted(contents) == ['2', '3', '4']
+
+def test_rotates_when_old(log_dir, monkeypatch):
+    monkeypatch.setattr(settings, 'log_max_age', 60)
+    path = sessionlog.logpath('ttyACM0')
+    with open(path, 'wt') as f:
+        f.write('<<<< {} >>>>\n'.format(time.ctime(time.time() - 120)))
+    log = sessionlog.SessionLog('ttyACM0', level='full')
+    log.close()
+    assert sessionlog.writer.sync()
+    assert len(segments(log_dir)) == 1
+    assert not os.path.exists(path)
+
+def test_errors_level_writes_on_error(log_dir):
+    log = sessionlog.SessionLog('ttyACM0', level='errors')
+    log.write('before\n')
+    assert sessionlog.writer.sync()
+    assert not os.path.exists(sessionlog.logpath('ttyACM0'))
+    log.error()
+    log.close()
+    assert sessionlog.writer.sync()
+    with open(sessionlog.logpath('ttyACM0'), 'rt') as f:
+        assert f.read().endswith('before\n')
@@ -0,0 +1,49 @@
+import utils
+import fakemspdebug
+
+import io
+
+
+def md_output(data, addr):
+    dev = fakemspdebug.FakeDevice()
+    dev.mem[addr:addr+len(data)] = data
+    dev.stream = io.StringIO()
+    dev.out('(mspdebug) md {:#x} {:d}\n'.format(addr, len(data)))
+    dev.dump_mem(addr, len(data))
+    dev.out('(mspdebug) ')
+    return dev.stream.getvalue()
+
+def test_parse_mem():
+    data = bytes(range(256)) + b'xyz'
+    text = md_output(data, 0x4400)
+    for size in [None, len(data)]:
+        base_addr, mem = utils.parse_mem(text, size)
+        assert base_addr == 0x4400
+        assert bytes(mem) == data
+
+def test_mem_parser_pieces():
+    data = bytes(range(200, 0, -1))
+    text = md_output(data, 0x1c00)
+    for piece in [1, 7, 50, 80]:
+        parser = utils.MemParser()
+        for i in range(0, len(text), piece):
+            parser.feed(text[i:i+piece])
+        base_addr, mem = parser.close()
+        assert base_addr == 0x1c00
+        assert bytes(mem) == data
+
+def test_mem_parser_last_row_without_newline():
+    text = md_output(b'\x01\x02\x03', 0x200)
+    # cut off the newline and the prompt after the row
+    text = text[:text.rindex('\n')]
+    parser = utils.MemParser(3)
+    parser.feed(text)
+    assert parser.close() == (0x200, memoryview(b'\x01\x02\x03'))
+
+def test_mem_parser_nothing():
+    assert utils.parse_mem('(mspdebug) ') == (None, memoryview(b''))
+
+def test_parses_are_independent():
+    _, first = utils.parse_mem(md_output(b'\xaa' * 4, 0x200), 4)
+    _, second = utils.parse_mem(md_output(b'\xbb' * 4, 0x200), 4)
+    assert bytes(first) == b'\xaa' * 4 and bytes(second) == b'\xbb' * 4
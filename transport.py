@@ -0,0 +1,258 @@
+# transports for talking to an mspdebug process
+#
+# Both of these start mspdebug on a pty and offer the same small interface to
+# driver.Mspdebug: run_command, send, sendline, expect_exact, sendintr and close.
+# They raise pexpect.EOF and pexpect.TIMEOUT either way, so callers don't need
+# to care which one they have.
+#
+# PexpectTransport is the original pexpect/REPLWrapper setup. PtyTransport talks
+# to the pty directly: non-blocking reads, select for waiting, and a plain
+# substring scan for the (fixed) prompt that only looks at new data.
+
+import pexpect
+from pexpect.replwrap import REPLWrapper
+import os
+import pty
+import termios
+import select
+import signal
+import sys
+import time
+
+default_timeout = 30
+# how long close waits for mspdebug to exit after hanging up, before killing
+# it, and how often it checks
+close_timeout = 5
+close_poll = 0.01
+
+
+# Start argv on a new pty with echo turned off, so output is just output.
+# Returns the child's pid and our (non-blocking) end of the pty.
+def fork_pty(argv):
+    pid, fd = pty.fork()
+    if pid == 0:
+        try:
+            attrs = termios.tcgetattr(0)
+            attrs[3] &= ~termios.ECHO
+            termios.tcsetattr(0, termios.TCSANOW, attrs)
+            os.execvp(argv[0], argv)
+        finally:
+            os._exit(127)
+    os.set_blocking(fd, False)
+    return pid, fd
+
+# Reap pid if it has exited, without waiting; returns whether it had.
+def exited(pid):
+    try:
+        return os.waitpid(pid, os.WNOHANG)[0] != 0
+    except ChildProcessError:
+        return True
+
+# Warns on stderr, since stdout may be carrying the interface protocol.
+def kill(pid):
+    print('WARNING: mspdebug (pid {:d}) did not exit after {}s, killing it'.format(pid, close_timeout),
+          file=sys.stderr)
+    try:
+        os.kill(pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+    try:
+        os.waitpid(pid, 0)
+    except ChildProcessError:
+        pass
+
+# Wait up to close_timeout seconds for pid to exit, then kill it.
+def reap(pid):
+    deadline = time.monotonic() + close_timeout
+    while not exited(pid):
+        if time.monotonic() >= deadline:
+            kill(pid)
+            return
+        time.sleep(close_poll)
+
+# The character that makes the pty send SIGINT, like pressing Ctrl+C.
+def intr_char(fd):
+    intr = termios.tcgetattr(fd)[6][termios.VINTR]
+    return intr if isinstance(intr, bytes) else bytes([intr])
+
+
+class PexpectTransport(object):
+    def __init__(self, argv, prompt, logfile = None):
+        self.spawn = pexpect.spawn(argv[0], argv[1:], encoding='ascii', logfile=logfile)
+        self.repl = REPLWrapper(self.spawn, prompt, None)
+        self.pid = self.spawn.pid
+
+    def run_command(self, cmd):
+        return self.repl.run_command(cmd)
+
+    def send(self, s):
+        self.spawn.send(s)
+
+    def sendline(self, line):
+        self.spawn.sendline(line)
+
+    def expect_exact(self, s, timeout = default_timeout):
+        self.spawn.expect_exact(s, timeout=timeout)
+        return self.spawn.before
+
+    def sendintr(self):
+        self.spawn.sendintr()
+
+    def close(self):
+        self.spawn.close()
+
+
+class PtyTransport(object):
+    def __init__(self, argv, prompt, logfile = None):
+        self.prompt = prompt
+        self.logfile = logfile
+        self.buf = bytearray()
+        # everything read for the last command, up to and including the prompt
+        self.raw = b''
+
+        self.pid, self.fd = fork_pty(argv)
+        self.intr = intr_char(self.fd)
+        try:
+            self.expect_exact(self.prompt)
+        except (pexpect.EOF, pexpect.TIMEOUT):
+            self.close()
+            raise
+
+    def log(self, data):
+        if self.logfile is not None:
+            self.logfile.write(data.decode('ascii', errors='replace'))
+            self.logfile.flush()
+
+    def write(self, data):
+        self.log(data)
+        while data:
+            try:
+                n = os.write(self.fd, data)
+            except BlockingIOError:
+                select.select([], [self.fd], [])
+                continue
+            data = data[n:]
+
+    # Read until marker shows up, and return (as bytes) everything before it;
+    # anything after it stays in the buffer for next time.
+    def read_until(self, marker, timeout = default_timeout):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        scanned = 0
+        while True:
+            i = self.buf.find(marker, max(0, scanned - len(marker) + 1))
+            if i >= 0:
+                end = i + len(marker)
+                self.raw = bytes(self.buf[:end])
+                del self.buf[:end]
+                return self.raw[:i]
+            scanned = len(self.buf)
+
+            if deadline is None:
+                remaining = None
+            else:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise pexpect.TIMEOUT('timed out waiting for {}'.format(repr(marker)))
+            readable, _, _ = select.select([self.fd], [], [], remaining)
+            if not readable:
+                continue
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                continue
+            except OSError:
+                # EIO: the other end of the pty is gone
+                data = b''
+            if not data:
+                raise pexpect.EOF('mspdebug exited')
+            self.log(data)
+            self.buf += data
+
+    def run_command(self, cmd):
+        self.sendline(cmd)
+        return self.expect_exact(self.prompt)
+
+    def send(self, s):
+        self.write(s.encode('ascii'))
+
+    def sendline(self, line):
+        self.write(line.encode('ascii') + b'\n')
+
+    def expect_exact(self, s, timeout = default_timeout):
+        return self.read_until(s.encode('ascii'), timeout=timeout).decode('ascii', errors='replace')
+
+    def sendintr(self):
+        self.write(self.intr)
+
+    # Closing our end hangs up on mspdebug, if it hasn't exited already; if
+    # that doesn't do it, it's killed (see reap).
+    def close(self):
+        os.close(self.fd)
+        reap(self.pid)
+
+
+# Bookkeeping for running several commands without waiting for each one to
+# finish before sending the next. At most window bytes of commands are
+# outstanding at once, so we never block writing to mspdebug while it's blocked
+# writing output we haven't read yet; depth, if given, also limits how many
+# commands are outstanding, for commands with a lot of output.
+class Pipeline(object):
+    def __init__(self, cmds, window, depth = None):
+        self.lines = [cmd + '\n' for cmd in cmds]
+        self.window = window
+        self.depth = depth
+        self.done = 0
+        self.sent = 0
+        self.in_flight = 0
+
+    def finished(self):
+        return self.done >= len(self.lines)
+
+    # What can be sent now (possibly nothing), before waiting for the next prompt.
+    def to_send(self):
+        chunk = []
+        while self.sent < len(self.lines) and (self.sent == self.done or
+                                               (self.in_flight + len(self.lines[self.sent]) <= self.window and
+                                                (self.depth is None or self.sent - self.done < self.depth))):
+            chunk.append(self.lines[self.sent])
+            self.in_flight += len(self.lines[self.sent])
+            self.sent += 1
+        return ''.join(chunk)
+
+    # One more command's output is in.
+    def received(self):
+        self.in_flight -= len(self.lines[self.done])
+        self.done += 1
+
+    def outstanding(self):
+        return self.sent - self.done
+
+# Run cmds pipelined (see Pipeline), and split the output back up at the
+# prompts. Yields each command's output as soon as it's in. If the caller stops
+# early, the commands already sent are still waited for, so conn stays in step.
+def iter_commands(conn, cmds, prompt, window, depth = None):
+    pipeline = Pipeline(cmds, window, depth=depth)
+    while not pipeline.finished():
+        chunk = pipeline.to_send()
+        if chunk:
+            conn.send(chunk)
+        output = conn.expect_exact(prompt)
+        pipeline.received()
+        try:
+            yield output
+        except GeneratorExit:
+            for _ in range(pipeline.outstanding()):
+                conn.expect_exact(prompt)
+            raise
+
+def run_commands(conn, cmds, prompt, window):
+    return list(iter_commands(conn, cmds, prompt, window))
+
+
+transports = {
+    'pexpect' : PexpectTransport,
+    'pty' : PtyTransport,
+}
+
+def spawn(kind, argv, prompt, logfile = None):
+    return transports[kind](argv, prompt, logfile=logfile)
@@ -31,17 +31,53 @@ def parse_regs(text):
             iregs[i] = int(x, 16)
     return [iregs[k] for k in sorted(iregs)]
 
-mem_re = re.compile(r'\s*([0-9A-F]+):([\s0-9A-F]+)\|.*\|', flags=re.I)
-
-def parse_mem(text):
-    rows = mem_re.findall(text)
-    base_addr = None
-    data = []
-    for addr, mem in rows:
-        if base_addr is None:
-            base_addr = int(addr, 16)
-        data += [int(x, 16) for x in mem.split()]
-    return base_addr, data
+# Decodes md output into a bytearray, one row at a time. Text can be fed in
+# whatever pieces it arrives in; a partial row waits for the rest of its line.
+# If size is given, the buffer is allocated up front.
+class MemParser(object):
+    def __init__(self, size = None):
+        self.buf = bytearray(size) if size is not None else bytearray()
+        self.base_addr = None
+        self.length = 0
+        self.partial = ''
+
+    def feed(self, text):
+        lines = (self.partial + text).split('\n')
+        self.partial = lines.pop()
+        for line in lines:
+            self.row(line)
+
+    # A row looks like "    01c00: 00 01 02 03 ... |....|"; anything else is skipped.
+    def row(self, line):
+        head, colon, rest = line.partition(':')
+        hexes, bar, _ = rest.partition('|')
+        if not (colon and bar):
+            return
+        try:
+            addr = int(head, 16)
+            data = bytes.fromhex(hexes)
+        except ValueError:
+            return
+        if self.base_addr is None:
+            self.base_addr = addr
+        offset = addr - self.base_addr
+        end = offset + len(data)
+        if end > len(self.buf):
+            self.buf.extend(bytes(end - len(self.buf)))
+        self.buf[offset:end] = data
+        self.length = max(self.length, end)
+
+    # Returns the address of the first row, and a memoryview of the data.
+    def close(self):
+        if self.partial:
+            self.row(self.partial)
+            self.partial = ''
+        return self.base_addr, memoryview(self.buf)[:self.length]
+
+def parse_mem(text, size = None):
+    parser = MemParser(size)
+    parser.feed(text)
+    return parser.close()
 
 prog_re = re.compile(r'Done, ([0-9]+) bytes total', flags=re.I)
 